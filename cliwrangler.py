@@ -10,503 +10,5572 @@
 #
 
 import paramiko
-import paramikoe
+# paramiko-expect's module used to be called paramikoe.
+try:
+    import paramikoe
+except ImportError:
+    import paramiko_expect as paramikoe
 import re
+import os
+import sys
+import mmap
+import json
+import socket
+import struct
+import inspect
+import array
+import base64
+import hashlib
+import hmac
+import math
+import bisect
+import random
+import tempfile
+import threading
 import yaml
 import time
+import codecs
+import select
+import functools
+import contextlib
+import collections
+import asyncio
+import traceback
+from concurrent import futures
 
-class CLIWrangler:
+# asyncssh is only needed for AsyncCLIWrangler, so don't insist on it.
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+# numpy is only needed for Table.to_numpy().
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# A string that we don't expect to get from any command output. We type this
+# at the prompt after every command so we know when the output is finished.
+# See _expect_output() for the gory details.
+UNIQUE_STRING = 'RRRR'
+
+# Characters that a prompt can end with.
+END_OF_PROMPT_CHARS = ['>', '#', '$', '%']
+
+# If any of these show up in the output of a command, we treat it as an error.
+ERROR_PATTERNS = ['^% Invalid', '^% Incomplete', '^ERROR: ', '^Cannot make changes', 'Command fail. Return code',
+                  '^%Error']
+
+# Here's a big collection of strings to look for. If we find one of these
+# strings in the output of an identification command, we add its
+# identifiers to the identification list, and we learn the facts that go
+# with it (vendor, os, model and version, or anything else you like). A
+# "regex" gets matched where the string was found, and its named groups
+# become facts too. When more than one string tells us the same fact, the
+# longest string wins, because it's the most specific.
+#
+# Strings only match whole words, so "IOS" doesn't match "BIOS" or "FortiOS".
+# Set "partial: true" on an entry if you want it to match anywhere.
+#
+# This is the built-in catalog. It's going to get huge, so you can add to
+# it with your own file; see identification_catalog().
+IDENTIFICATION_CATALOG = r"""
+- {match: 'Cisco', identifiers: [Cisco], vendor: Cisco}
+- {match: 'cisco', identifiers: [Cisco], vendor: Cisco}
+- {match: 'CISCO', identifiers: [Cisco], vendor: Cisco}
+- {match: 'IOS', identifiers: [IOS], os: IOS}
+- {match: 'IOS XE', identifiers: [IOS-XE], os: IOS-XE}
+- {match: 'IOS-XE', identifiers: [IOS-XE], os: IOS-XE}
+- {match: 'Cisco IOS Software', regex: 'Cisco IOS Software.*?, Version (?P<version>[^\s,]+)'}
+- {match: 'Cisco IOS XE Software', regex: 'Cisco IOS XE Software, Version (?P<version>[^\s,]+)'}
+- {match: 'Model number', regex: 'Model number\s*: (?P<model>\S+)'}
+- {match: 'Model Number', regex: 'Model Number\s*: (?P<model>\S+)'}
+- {match: 'C3750', identifiers: [C3750]}
+- {match: 'WS-C6509-E', identifiers: [C6509-E], model: WS-C6509-E}
+- {match: 'Adaptive Security Appliance', identifiers: [ASA], vendor: Cisco, os: ASA,
+   regex: 'Adaptive Security Appliance Software Version (?P<version>\S+)'}
+- {match: 'ASA5520', identifiers: [ASA5520], model: ASA5520}
+- {match: 'FWSM Firewall', identifiers: [FWSM], os: FWSM}
+- {match: 'FWSM Firewall Version', identifiers: [Cisco], vendor: Cisco,
+   regex: 'FWSM Firewall Version (?P<version>\S+)'}
+- {match: 'FortiOS', identifiers: [Fortinet], vendor: Fortinet, os: FortiOS}
+- {match: 'FortiGate', identifiers: [FortiGate, Fortinet], vendor: Fortinet, os: FortiOS}
+- {match: 'FortiGate-1000C', identifiers: [1000C]}
+- {match: 'Version: FortiGate', regex: 'Version: (?P<model>FortiGate-\S+) v(?P<version>[^\s,]+)'}
+- {match: 'Nexus Operating', identifiers: [Nexus], os: NX-OS}
+- {match: 'NX-OS', identifiers: [NX-OS], os: NX-OS}
+- {match: 'Nexus5548', identifiers: [Nexus5548], model: Nexus5548}
+- {match: 'system:', regex: 'system:\s+version (?P<version>\S+)'}
+"""
+
+# The commands we run to identify a device, in order. We stop at the first
+# one that works.
+IDENTIFICATION_COMMANDS = [
+    'show version', # Cisco IOS
+    'get system status', # Fortinet FortiOS
+]
+
+# The command that turns off paging on most things. We send it before we
+# identify the device, so that a long "show version" doesn't depend on us
+# hitting the space bar enough times.
+PAGER_OFF_COMMAND = 'terminal length 0'
+
+# paramiko-expect strips these terminal escape sequences out of the output,
+# and so do we when we're doing the reading ourselves.
+ANSI_ESCAPE_REGEX = re.compile(r'\x1b\[([0-9,A-Z]{1,2}(;[0-9]{1,2})?(;[0-9]{3})?)?[m|K]?|\?(1049|2004)[hl]')
+
+
+class _Readiness:
+    """Decides how long to wait after sending a command before we type
+    anything else, which is a thing we have to do because IOS-XE throws away
+    keystrokes for a moment after it gets a command.
+
+    The modes are:
+    sleep - Always sleep for "wait" seconds. This is the old behavior.
+    none - Never wait.
+    adaptive - Don't wait at all on devices we've identified as something
+               other than IOS-XE. Otherwise, wait until the device echoes the
+               command back, then wait for a "settle" time that we learn for
+               this device. If the device eats our unique string anyway, we
+               notice (we end up sitting at a bare prompt with nothing coming
+               back), type it again and double the settle time. It never gets
+               longer than "wait".
+    """
+
+    MODES = ('sleep', 'none', 'adaptive')
+
+    def __init__(self, mode, wait):
+        if mode not in self.MODES:
+            raise Exception("Unknown readiness mode %r, try one of %s" % (mode, ', '.join(self.MODES)))
+        self.mode = mode
+        self.wait = wait
+        # A smoothed round trip time and its variance, TCP style.
+        self.rtt = None
+        self.rttvar = None
+        # How long to wait after the echo, and how many times we got it wrong.
+        self.settle = 0.0
+        self.drops = 0
+
+    def copy(self):
+        """A new _Readiness that starts from what we've learned so far. Each
+        shell needs its own, since they're used from different threads."""
+
+        readiness = _Readiness(self.mode, self.wait)
+        readiness.rtt = self.rtt
+        readiness.rttvar = self.rttvar
+        readiness.settle = self.settle
+        return readiness
+
+    def needs_echo(self, identifiers):
+        """True if we should wait for the command echo before going on."""
+
+        if self.mode != 'adaptive':
+            return False
+        # Until we know what we're talking to, assume the worst.
+        return not identifiers or 'IOS-XE' in identifiers
+
+    def observe(self, sample):
+        """Fold a measured command echo round trip into our estimate."""
+
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.rtt - sample)
+            self.rtt = 0.875 * self.rtt + 0.125 * sample
+
+    def settle_time(self, echoed):
+        """How long to wait once the echo is in (or once we gave up on it)."""
+
+        if self.mode == 'sleep':
+            return self.wait
+        if self.mode == 'none' or not echoed:
+            return 0
+        return self.settle
+
+    def probe_timeout(self):
+        """How long we sit at a bare prompt before deciding that the device
+        ate our unique string."""
+
+        if self.rtt is None:
+            return self.wait
+        return max(0.05, 2 * (self.rtt + 4 * self.rttvar))
+
+    def dropped(self):
+        """The device ate some keystrokes, so wait longer from now on."""
+
+        self.drops += 1
+        self.settle = min(self.wait, max(2 * self.settle, self.rtt or 0.01))
+
+    def delivered(self):
+        """A command went through without anything getting eaten. Shave a
+        little off the settle time, so one bad moment doesn't stick forever."""
+        self.settle *= 0.98
+
+
+def _echo_target(command):
+    """The part of a command's echo that we wait for. Long commands can get
+    mangled by line wrapping, so we only look for the tail end."""
+    return command.strip()[-16:]
+
+
+def _expect_regexes(prompt_prefix):
+    """Return the list of regexes that match a prompt followed by our unique
+    string, which is how we know a command's output is over."""
+
+    if prompt_prefix:
+        # If your hostname is longer than 20 characters, IOS will cut off
+        # anything after character 20 when you enter expect mode. So let's
+        # also look for a cut-off version of that just in case.
+        prompt_and_unique_string = "%s.*%s" % (prompt_prefix, UNIQUE_STRING)
+        truncated_prompt_and_unique_string = "%s.*%s" % (prompt_prefix[:20], UNIQUE_STRING)
+        return [prompt_and_unique_string, truncated_prompt_and_unique_string]
+
+    # If we don't have a prompt prefix, at least expect something sane.
+    # Unfortunately, this is a bit more complex, because we have to define
+    # sanity. It should be "something kind of prompty" followed by an allowed
+    # end-of-prompt character followed by the unique string we typed.
+    # A prompt, simply, is 3 or more [a-z0-9/-] characters, plus maybe an
+    # extension of other things, with an end_of_prompt_char at the end, and
+    # maybe some whitespace after that. You can thank the FWSM for using the
+    # forward slash in a prompt.
+    general_prompt_regex_template = r'[a-zA-Z0-9/-]{3,}\s*%s\s*%s'
+    # Create a regex for each char in the list above.
+    return [general_prompt_regex_template % (re.escape(char), UNIQUE_STRING) for char in END_OF_PROMPT_CHARS]
+
+
+def _prompt_regex(prompt_prefix):
+    """Return a regex that matches a prompt where our unique string hasn't
+    shown up yet, or only some of it has."""
+
+    end_of_prompt = '[%s]' % (re.escape(''.join(END_OF_PROMPT_CHARS)))
+    partial = '|'.join(re.escape(UNIQUE_STRING[:length]) for length in range(len(UNIQUE_STRING)))
+    if prompt_prefix:
+        return "%s.*%s\\s*(?:%s)" % (prompt_prefix[:20], end_of_prompt, partial)
+    return '[a-zA-Z0-9/-]{3,}\\s*%s\\s*(?:%s)' % (end_of_prompt, partial)
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_line_regexes(regexes):
+    """Compile a tuple of regexes that have to match a whole line. We only
+    do this once per set of regexes, rather than on every read."""
+    return tuple(re.compile('(?:%s)$' % (regex), re.DOTALL) for regex in regexes)
+
+
+class _PromptMatcher:
+    """Watches output go by, a chunk at a time, and notices when the last
+    line matches one of a set of regexes. This is how we find the prompt at
+    the end of a command's output.
+
+    paramiko-expect re-splits the whole output into lines after every read
+    to find the last one, which gets quadratic on a big "show tech". We only
+    look at the new text and keep the current last line, which is all a
+    prompt can be. A line longer than WINDOW characters isn't a prompt, so
+    we stop keeping it. If we know the prompt has to end with some string
+    (our unique string, usually), we don't even run the regexes until the
+    line ends with it. So the matching cost stays linear in the output size.
+    """
+
+    # Prompts are short. A line longer than this can't be one.
+    WINDOW = 512
+
+    def __init__(self, regexes, suffix=None):
+        """Arguments:
+        regexes - A list of regexes, one of which has to match the whole last line.
+        suffix - A string the last line has to end with before we bother
+                 with the regexes, or None.
+        """
+
+        self.regexes = list(regexes)
+        self.compiled = _compile_line_regexes(tuple(self.regexes))
+        self.suffix = suffix
+        # The last line we've seen so far, and whether it got too long.
+        self.line = ''
+        self.overflowed = False
+        # The index of the regex that matched, once one has.
+        self.index = None
+
+    def feed(self, text):
+        """Take in some more output."""
+
+        newline = text.rfind('\n')
+        if newline == -1:
+            if self.overflowed:
+                return
+            line = self.line + text
+        else:
+            line = text[newline + 1:]
+            self.overflowed = False
+
+        if len(line) > self.WINDOW:
+            line = ''
+            self.overflowed = True
+        self.line = line
+
+    def match(self):
+        """Return the index of the regex that matches the last line, or None."""
+
+        if self.overflowed:
+            return None
+        if self.suffix is not None and not self.line.endswith(self.suffix):
+            return None
+        for index, regex in enumerate(self.compiled):
+            if regex.match(self.line):
+                self.index = index
+                return index
+        return None
+
+    def line_matches(self, regex):
+        """True if the last line matches the given regex (a string) too."""
+
+        if self.overflowed:
+            return False
+        return _compile_line_regexes((regex,))[0].match(self.line) is not None
+
+
+def _split_batch_output(output, commands, prompt_prefix):
+    """Split the combined output of a batch of commands into the output of
+    each one. See CLIWrangler.send_batch() for how the batch gets typed.
+
+    Between each command and the next, the device prints a bare prompt for
+    the empty line we typed, then the prompt again with the next command
+    echoed after it. So that's what we look for. Each piece comes back
+    looking like the output of send(), starting with the command echo."""
+
+    end_of_prompt = '[%s]' % (re.escape(''.join(END_OF_PROMPT_CHARS)))
+    if prompt_prefix:
+        marker = re.compile("%s.*%s\\s*$" % (prompt_prefix[:20], end_of_prompt))
+    else:
+        marker = re.compile('[a-zA-Z0-9/-]{3,}\\s*%s\\s*$' % (end_of_prompt))
+
+    lines = output.splitlines(True)
+    pieces = []
+    start = 0
+    position = 0
+
+    for command in commands[1:]:
+        echo = command.strip()
+        while True:
+            if position + 1 >= len(lines):
+                raise Exception("Couldn't find where the output of %r starts in the batch output:\n%s" % (command, output))
+            if marker.match(lines[position].rstrip('\n')) and lines[position + 1].rstrip('\n').endswith(echo):
+                break
+            position += 1
+
+        pieces.append(''.join(lines[start:position]))
+
+        # Lose the prompt in front of the command echo.
+        echo_line = lines[position + 1]
+        lines[position + 1] = echo_line[echo_line.rfind(echo):] if echo else '\n'
+
+        start = position + 1
+        position = start
+
+    pieces.append(''.join(lines[start:]))
+    return pieces
+
+
+def _prompt_from_output(output_raw):
+    """Find the prompt at the end of some raw output that ends with our
+    unique string."""
+
+    # Strip the extra stuff we created off the end. If we had to type the
+    # unique string more than once, it's in there more than once.
+    output = output_raw.rstrip(UNIQUE_STRING)
+    # Take the last line. That's our prompt.
+    return output.splitlines()[-1]
+
+
+def _prompt_prefix_from_prompt(prompt):
+    """Get the prompt prefix from a prompt, or None if it doesn't look like
+    there is one. We keep track of this in case the prompt gets suffixes
+    tacked onto it by mode changes. If we don't do this, we'll trip up when a
+    prompt-ending character is found at the end of a line of command output."""
+
+    m = re.match('^([a-zA-Z0-9-]{3,})', prompt)
+    if m is not None:
+        return m.group(1)
+    return None
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == '_'
+
+
+class IdentificationCatalog:
+    """A catalog of strings that identify devices, compiled into an
+    Aho-Corasick automaton, so that one pass over the output of "show
+    version" finds every string in the catalog, no matter how many
+    thousands of them there are. See IDENTIFICATION_CATALOG for what an
+    entry looks like.
+
+    You probably want the process-wide one from identification_catalog()
+    rather than making your own.
+    """
+
+    # The keys in an entry that aren't facts.
+    RESERVED_KEYS = ('match', 'identifiers', 'regex', 'partial')
+
+    def __init__(self, entries=None):
+        self.entries = []
+        self.lock = threading.Lock()
+        # The automaton, which we build the first time we need it.
+        self.automaton = None
+        if entries:
+            self.add(entries)
+
+    def add(self, entries):
+        """Add some entries: a list of dicts, or a YAML string of one. The
+        old format, a dict of {'string': 'identifier'}, works too."""
+
+        if isinstance(entries, str):
+            entries = yaml.safe_load(entries) or []
+        if isinstance(entries, dict):
+            entries = [{'match': string, 'identifiers': [identifier]} for string, identifier in entries.items()]
+
+        compiled = []
+        for entry in entries:
+            if not isinstance(entry, dict) or not entry.get('match'):
+                raise Exception("Identification catalog entry has no 'match': %r" % (entry,))
+            entry = dict(entry)
+            entry['match'] = str(entry['match'])
+            entry['identifiers'] = [str(identifier) for identifier in entry.get('identifiers') or []]
+            if entry.get('regex'):
+                entry['regex'] = re.compile(entry['regex'])
+            entry['facts'] = dict((key, str(value)) for key, value in entry.items()
+                                  if key not in self.RESERVED_KEYS and key != 'facts')
+            compiled.append(entry)
+
+        with self.lock:
+            self.entries.extend(compiled)
+            self.automaton = None
+
+    def load(self, path):
+        """Add the entries in a YAML file."""
+
+        with open(path) as f:
+            self.add(f.read())
+
+    def _build(self):
+        """Build the Aho-Corasick automaton: a trie of all the strings, plus
+        a failure link from each node to the longest proper suffix of it
+        that's also in the trie. Each node's outputs are the entries that
+        end there, including the ones we'd find by following the failure
+        links, so scanning never has to follow them more than once per
+        character."""
+
+        goto = [{}]
+        outputs = [[]]
+        for index, entry in enumerate(self.entries):
+            node = 0
+            for char in entry['match']:
+                if char not in goto[node]:
+                    goto.append({})
+                    outputs.append([])
+                    goto[node][char] = len(goto) - 1
+                node = goto[node][char]
+            outputs[node].append(index)
+
+        fail = [0] * len(goto)
+        queue = collections.deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                outputs[child] = outputs[child] + outputs[fail[child]]
+
+        return goto, fail, outputs
+
+    def scan(self, output):
+        """Look for every entry in the output in one pass. Returns a list
+        of identifiers (in catalog order) and a dict of facts."""
+
+        with self.lock:
+            if self.automaton is None:
+                self.automaton = self._build()
+            goto, fail, outputs = self.automaton
+            entries = self.entries
+
+        found = {}
+        node = 0
+        for position, char in enumerate(output):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in outputs[node]:
+                entry = entries[index]
+                start = position - len(entry['match']) + 1
+                if not entry.get('partial'):
+                    # Only whole words count.
+                    if start > 0 and _is_word_char(entry['match'][0]) and _is_word_char(output[start - 1]):
+                        continue
+                    if (position + 1 < len(output) and _is_word_char(entry['match'][-1])
+                            and _is_word_char(output[position + 1])):
+                        continue
+                if index not in found:
+                    found[index] = start
+
+        identifiers = []
+        facts = {}
+        lengths = {}
+        for index in sorted(found):
+            entry = entries[index]
+            for identifier in entry['identifiers']:
+                # Don't add it if it's already there. More than one might match.
+                if identifier not in identifiers:
+                    identifiers.append(identifier)
+
+            entry_facts = dict(entry['facts'])
+            if entry.get('regex') is not None:
+                m = entry['regex'].match(output, found[index])
+                if m is not None:
+                    entry_facts.update((key, value) for key, value in m.groupdict().items() if value is not None)
+
+            # The longest string wins.
+            for key, value in entry_facts.items():
+                if len(entry['match']) > lengths.get(key, -1):
+                    facts[key] = value
+                    lengths[key] = len(entry['match'])
+
+        return identifiers, facts
+
+
+# The process-wide identification catalog. See identification_catalog().
+_IDENTIFICATION_CATALOG = None
+_IDENTIFICATION_CATALOG_LOCK = threading.Lock()
+
+
+def identification_catalog():
+    """Return the identification catalog that every session uses. The
+    first time we need it, we load the built-in catalog, plus your own
+    entries from the file named by the CLIWRANGLER_IDENTIFICATION
+    environment variable, or ~/.cliwrangler_identification.yaml if that
+    exists. It's a YAML list of entries like the ones in
+    IDENTIFICATION_CATALOG. To add more as you go, call add() or load() on
+    what this returns."""
+
+    global _IDENTIFICATION_CATALOG
+    with _IDENTIFICATION_CATALOG_LOCK:
+        if _IDENTIFICATION_CATALOG is None:
+            catalog = IdentificationCatalog(IDENTIFICATION_CATALOG)
+            path = os.environ.get('CLIWRANGLER_IDENTIFICATION')
+            if path is None:
+                path = os.path.join(os.path.expanduser('~'), '.cliwrangler_identification.yaml')
+                if not os.path.exists(path):
+                    path = None
+            if path is not None:
+                catalog.load(path)
+            _IDENTIFICATION_CATALOG = catalog
+        return _IDENTIFICATION_CATALOG
+
+
+def _identify_output(output, identifiers, facts):
+    """If any of the identification strings are found in the output, stick
+    them into the identifiers list, and what we learned into the facts."""
+
+    found, found_facts = identification_catalog().scan(output)
+    for identifier in found:
+        if identifier not in identifiers:
+            identifiers.append(identifier)
+    facts.update(found_facts)
+    return identifiers
+
+
+def _batch_results(commands, outputs, graceful, driver):
+    """Check each output of a batch for errors, the way send() does."""
+
+    results = []
+    for command, output in zip(commands, outputs):
+        if driver.find_error(output):
+            if not graceful:
+                raise Exception("Found error string in the output of %r! \n%s" % (command, output))
+            output = None
+        results.append(output)
+    return results
+
+
+def _config_lines(config):
+    """If it seems like we were passed a string, split it into a list."""
+
+    # If this is a list, the split will raise an exception, which is fine.
+    try:
+        # This will transform a string into a list, even if it's just one
+        # item. Very classy.
+        config = config.split('\n')
+    except:
+        pass
+    return config
+
+
+def _config_key(line):
+    """How we compare config lines: without the indentation, and without
+    caring how many spaces are between the words."""
+    return ' '.join(line.split())
+
+
+class ConfigTree:
+    """A config, parsed into a tree by indentation, the way IOS shows it:
+    each line is a child of the closest line above it that's indented less.
+    Each node's children are indexed by their (normalized) text, so finding
+    out whether a line is already in a section doesn't mean reading the
+    whole section.
+
+    The root node has no line. Comments ("!"), blank lines and the
+    "Building configuration..." chatter from "show running-config" are
+    left out.
+    """
+
+    # Lines that aren't really config.
+    SKIP_REGEX = re.compile('^(?:!|Building configuration|Current configuration|end$)')
+
+    def __init__(self, lines=None, line=None):
+        """Arguments:
+        lines - A list of config lines (or a string) to parse.
+        line - The line for this node, as it was written.
+        """
+
+        self.line = line
+        self.children = collections.OrderedDict()
+        if lines is not None:
+            self.parse(lines)
+
+    def parse(self, lines):
+        """Add some config lines to the tree."""
+
+        # (indentation, node) for each section we're in.
+        stack = [(-1, self)]
+        for line in _config_lines(lines):
+            line = line.rstrip()
+            text = line.strip()
+            if not text or self.SKIP_REGEX.match(text):
+                continue
+            indent = len(line) - len(line.lstrip())
+            while stack[-1][0] >= indent:
+                stack.pop()
+            node = stack[-1][1].add(line)
+            stack.append((indent, node))
+        return self
+
+    def add(self, line):
+        """Add a child line, unless it's already there, and return its node."""
+
+        key = _config_key(line)
+        node = self.children.get(key)
+        if node is None:
+            node = ConfigTree(line=line)
+            self.children[key] = node
+        return node
+
+    def get(self, line):
+        """Return the node for a child line, or None."""
+        return self.children.get(_config_key(line))
+
+    def __contains__(self, line):
+        return _config_key(line) in self.children
+
+    def __len__(self):
+        return len(self.children)
+
+    def lines(self):
+        """Yield this node's line and everything under it, in order."""
+
+        if self.line is not None:
+            yield self.line
+        for child in self.children.values():
+            for line in child.lines():
+                yield line
+
+
+class ConfigDiff:
+    """The difference between some config and the running config: which
+    lines need to be sent, and which are already there. You get one of
+    these from diff_config() or apply_config(config, diff=True).
+
+    Attributes:
+    commands - The commands to type in config mode to add the missing
+               lines, including the section headers (like "interface
+               Gi1/0/1") they need to go under, and any "exit"s it takes to
+               get from one section to the next.
+    applied - The lines that weren't in the running config.
+    skipped - The lines that were already in the running config.
+    sent - True once the commands have been sent to the device.
+    """
+
+    def __init__(self):
+        self.commands = []
+        self.applied = []
+        self.skipped = []
+        self.sent = False
+
+    @property
+    def changed(self):
+        """True if anything needed (or needs) to be sent."""
+        return len(self.applied) > 0
+
+    def __repr__(self):
+        return "<ConfigDiff %d applied, %d skipped, %d commands>" % (
+            len(self.applied), len(self.skipped), len(self.commands))
+
+
+def _diff_config(desired, running, exit_command='exit'):
+    """Compare two ConfigTrees and return a ConfigDiff with the smallest set
+    of commands that adds what's in "desired" but not in "running".
+
+    A line that's already there gets skipped, but we still look inside it,
+    since its section might be missing some lines. A line that isn't there
+    gets sent along with everything under it. To send a line, we need to
+    be in the right section first. We keep track of where we are, and only
+    type a section's header (and go back up with "exit") when we have to.
+    """
+
+    diff = ConfigDiff()
+    # The section headers we've typed to get where we are.
+    context = []
+
+    def enter(path, header):
+        common = 0
+        while common < min(len(context), len(path)) and context[common] == path[common]:
+            common += 1
+        # Typing a top-level section header gets us there from anywhere, but
+        # to go up a level inside a section, or back to the top for a line
+        # that isn't a section header, we have to exit.
+        if common > 0 or not (path or header):
+            for level in range(len(context) - common):
+                diff.commands.append(exit_command)
+            del context[common:]
+        else:
+            del context[:]
+        for line in path[len(context):]:
+            diff.commands.append(line)
+            context.append(line)
+
+    def walk(want, have, path):
+        for key, child in want.children.items():
+            existing = have.children.get(key) if have is not None else None
+            if existing is not None:
+                diff.skipped.append(child.line)
+                walk(child, existing, path + [child.line])
+                continue
+
+            enter(path, len(child.children) > 0)
+            for line in child.lines():
+                diff.applied.append(line)
+                diff.commands.append(line)
+            # Typing that left us in the last section it opened.
+            context.extend(_last_section(child))
+
+    walk(desired, running, [])
+    return diff
+
+
+def _last_section(node):
+    """The section headers we end up under after typing a node and
+    everything under it."""
+
+    sections = []
+    while node.children:
+        sections.append(node.line)
+        node = next(reversed(node.children.values()))
+    return sections
+
+
+# The typecode we store IPv4 addresses with. It has to be 4 bytes, and
+# array doesn't promise that for any of them, so look.
+_IPV4_TYPECODE = [typecode for typecode in ('I', 'L') if array.array(typecode).itemsize == 4][0]
+
+# How many lines of streamed output we parse at a time. See TableParser.parse().
+TABLE_BATCH_LINES = 8192
+
+
+def _table_int(value, scale=1):
+    """Turn a number (or a time like "00:01:43") from a table into an int,
+    times "scale". Things like "-" or "All" mean we don't know, so -1."""
+
+    if value.isdigit():
+        return int(value) * scale
+    if ':' in value:
+        seconds = 0
+        for part in value.split(':'):
+            if not part.isdigit():
+                return -1
+            seconds = seconds * 60 + int(part)
+        return seconds * scale
+    return -1
+
+
+class Column:
+    """One column of a Table, stored as an array instead of a list of
+    Python objects. What's in the array depends on the kind of column:
+
+    int - Numbers, as 8 byte ints, with -1 where there wasn't one.
+    minutes - A number of minutes in the output, stored as seconds.
+    seconds - A number of seconds, or a time like "00:01:43", as seconds.
+    mac - MAC addresses, as 48-bit numbers in 8 byte ints.
+    ipv4 - IPv4 addresses, as 32-bit numbers.
+    text - Anything else, dictionary encoded: "values" is a list of the
+           different strings, and the array holds the index of each row's
+           string in that list. A column of 100,000 port names that only
+           has 48 different ones costs 48 strings and 400k of codes.
+
+    Indexing a column (or looping over it) gives you the values back the
+    way the device printed them, more or less: ints, strings, and MAC and
+    IP addresses as strings. "data" is the array itself, if you'd rather
+    do the work on numbers.
+    """
+
+    KINDS = ('int', 'minutes', 'seconds', 'mac', 'ipv4', 'text')
+
+    def __init__(self, name, kind='text'):
+        if kind not in self.KINDS:
+            raise Exception("Unknown column kind %r, try one of %s" % (kind, ', '.join(self.KINDS)))
+        self.name = name
+        self.kind = kind
+        if kind == 'mac':
+            self.data = array.array('Q')
+        elif kind == 'ipv4':
+            self.data = array.array(_IPV4_TYPECODE)
+        elif kind == 'text':
+            self.data = array.array('I')
+        else:
+            self.data = array.array('q')
+        # For text columns, the strings, and the code for each one.
+        self.values = [] if kind == 'text' else None
+        self.codes = {} if kind == 'text' else None
+
+    def __repr__(self):
+        return "<Column %s (%s), %d rows>" % (self.name, self.kind, len(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return self.decode(self.data[index])
+
+    def __iter__(self):
+        for raw in self.data:
+            yield self.decode(raw)
+
+    def decode(self, raw):
+        """Turn a number from the array back into a value."""
+
+        if self.kind == 'text':
+            return self.values[raw]
+        if self.kind == 'mac':
+            return '%04x.%04x.%04x' % (raw >> 32, (raw >> 16) & 0xffff, raw & 0xffff)
+        if self.kind == 'ipv4':
+            return '%d.%d.%d.%d' % (raw >> 24, (raw >> 16) & 255, (raw >> 8) & 255, raw & 255)
+        return raw
+
+    def encode(self, value):
+        """Turn a value into what the array would hold for it, or None if
+        it isn't anywhere in a text column."""
+
+        if self.kind == 'text':
+            return self.codes.get(value)
+        if self.kind == 'mac':
+            return int(re.sub('[^0-9a-fA-F]', '', value), 16)
+        if self.kind == 'ipv4':
+            return int.from_bytes(socket.inet_aton(value), 'big')
+        return value
+
+    def extend(self, values):
+        """Add a batch of values, as the strings we found in the output.
+        This is where the work happens, so we do as much of it as we can a
+        whole batch at a time instead of a value at a time."""
+
+        if self.kind == 'text':
+            # Give the strings we haven't seen before the next codes, then
+            # look them all up at once.
+            codes = self.codes
+            for value in dict.fromkeys(values):
+                if value not in codes:
+                    codes[value] = len(codes)
+                    self.values.append(value)
+            self.data.extend(map(codes.__getitem__, values))
+        elif self.kind in ('mac', 'ipv4'):
+            # Pack the whole batch into one string of bytes, in network
+            # order, and let array read it. A MAC gets two zero bytes in
+            # front, to fill up 8 bytes.
+            if not values:
+                return
+            if self.kind == 'mac':
+                packed = bytes.fromhex(('0000' + '0000'.join(values)).replace('.', '').replace(':', '').replace('-', ''))
+            else:
+                packed = b''.join(map(socket.inet_aton, values))
+            batch = array.array(self.data.typecode)
+            batch.frombytes(packed)
+            if sys.byteorder == 'little':
+                batch.byteswap()
+            self.data.extend(batch)
+        else:
+            # Usually they're all plain numbers. If they aren't, do it the
+            # slow way.
+            scale = 60 if self.kind == 'minutes' else 1
+            try:
+                batch = array.array('q', map(int, values))
+            except ValueError:
+                self.data.extend([_table_int(value, scale) for value in values])
+                return
+            if scale != 1:
+                batch = array.array('q', [value * scale for value in batch])
+            self.data.extend(batch)
+
+    def indexes(self, value):
+        """Return a list of the rows where this column is "value"."""
+
+        raw = self.encode(value)
+        if raw is None:
+            return []
+        return [index for index, found in enumerate(self.data) if found == raw]
+
+    def nbytes(self):
+        """Roughly how much memory the column takes."""
+
+        size = self.data.itemsize * len(self.data)
+        if self.values is not None:
+            size += sum(sys.getsizeof(value) for value in self.values)
+        return size
+
+    def to_numpy(self):
+        """Return the column as a numpy array, without copying it. Text
+        columns give you their codes; the strings are in "values"."""
+
+        if numpy is None:
+            raise Exception("to_numpy() needs the numpy library. Try 'pip install numpy'.")
+        return numpy.frombuffer(self.data, dtype=self.data.typecode)
+
+
+class Table:
+    """The rows of a table from a "show" command, stored a column at a time,
+    which is a lot smaller and quicker to build than a list of dicts. You
+    get one of these from send_table() or TableParser.parse().
+
+    len() is the number of rows, and table['mac'] is a Column. You can
+    still get rows as dicts with row(index), or by looping over the table,
+    if that's what you want; they're made as you ask for them.
+    """
+
+    def __init__(self, name, columns):
+        """Arguments:
+        name - The kind of table, like 'mac_address_table'.
+        columns - A list of Columns.
+        """
+
+        self.name = name
+        self.columns = collections.OrderedDict((column.name, column) for column in columns)
+
+    def __repr__(self):
+        return "<Table %s, %d rows: %s>" % (self.name, len(self), ', '.join(self.columns))
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.row(index)
+
+    def row(self, index):
+        """Return one row as a dict."""
+        return dict((name, column[index]) for name, column in self.columns.items())
+
+    def where(self, name, value):
+        """Yield each row (as a dict) where the column "name" is "value"."""
+
+        for index in self.columns[name].indexes(value):
+            yield self.row(index)
+
+    def nbytes(self):
+        """Roughly how much memory the table takes."""
+        return sum(column.nbytes() for column in self.columns.values())
+
+    def to_numpy(self):
+        """Return a dict of numpy arrays, one per column. See Column.to_numpy()."""
+        return dict((name, column.to_numpy()) for name, column in self.columns.items())
+
+
+# Things we look for a lot in tables.
+MAC_REGEX = r'[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}\.[0-9a-fA-F]{4}'
+COLON_MAC_REGEX = r'[0-9a-fA-F]{2}(?::[0-9a-fA-F]{2}){5}'
+IPV4_REGEX = r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}'
+# What "show interfaces status" says about a port. NX-OS cuts some of them off.
+PORT_STATUS_REGEX = (r'connected|notconnec\w*|disabled|err-disabled|errDisabl\w*|inactive|monitor\w*|'
+                     r'sfpAbsent|xcvrAbsen\w*|noOperMem|suspend\w*|suspnd|linkFlapE\w*|channelDo\w*|down')
+
+
+class TableParser:
+    """How to turn the output of one kind of "show" command on one platform
+    into a Table. Drivers keep theirs in the "tables" dict, by name.
+
+    A regex matches a whole row, with a group for each column. Instead of
+    going through the output line by line, we let the regex find all of
+    the rows in a big block of output at once, then hand each column its
+    whole batch of values. That keeps the Python-level work per row down
+    to almost nothing.
+
+    Arguments:
+    name - The kind of table, like 'mac_address_table'. The same kind of
+           table should have the same column names on every platform.
+    command - The command that prints the table.
+    regex - A regex that matches one row. It's matched with re.MULTILINE,
+            against a block of lines, so be careful that it can't run
+            over into the next line: use " +" instead of "\\s+". A column
+            that might not be there should be an optional group.
+    columns - A list of (name, kind) tuples, one per group in the regex.
+              See Column for the kinds.
+    """
+
+    def __init__(self, name, command, regex, columns):
+        self.name = name
+        self.command = command
+        self.regex = re.compile(regex, re.MULTILINE)
+        self.columns = list(columns)
+        if self.regex.groups != len(self.columns):
+            raise Exception("The %s regex has %d groups, but there are %d columns" % (
+                name, self.regex.groups, len(self.columns)))
+
+    def __repr__(self):
+        return "<TableParser %s: %s>" % (self.name, self.command)
+
+    def new_table(self):
+        """An empty Table with our columns."""
+        return Table(self.name, [Column(name, kind) for name, kind in self.columns])
+
+    def feed(self, table, text):
+        """Parse the rows in a block of output and add them to the table."""
+
+        rows = self.regex.findall(text)
+        if not rows:
+            return table
+        for column, values in zip(table.columns.values(), zip(*rows)):
+            # An optional group that didn't match gives us None.
+            column.extend([value or '' for value in values] if None in values else values)
+        return table
+
+    def parse(self, output, batch_lines=TABLE_BATCH_LINES):
+        """Parse some output into a Table. "output" can be a string, or
+        anything that gives you lines, like send_iter() or a SpooledOutput,
+        in which case we parse it "batch_lines" lines at a time as it comes,
+        and never have the whole thing in memory."""
+
+        # Even when we have it all in one string, going a batch at a time is
+        # quicker: findall() on the whole thing makes hundreds of thousands
+        # of little strings at once, and the garbage collector goes through
+        # all of them, over and over, while we're making them.
+        if isinstance(output, str):
+            output = output.splitlines()
+
+        table = self.new_table()
+        batch = []
+        for line in output:
+            batch.append(line)
+            if len(batch) >= batch_lines:
+                self.feed(table, '\n'.join(batch))
+                batch = []
+        if batch:
+            self.feed(table, '\n'.join(batch))
+        return table
+
+
+# The tables that Cisco IOS and NX-OS both print the same way.
+IOS_MAC_ADDRESS_TABLE = TableParser(
+    'mac_address_table', 'show mac address-table',
+    r'^ *(\d+|All) +(%s) +(\S+)(?: +(\S+))? *$' % (MAC_REGEX),
+    [('vlan', 'int'), ('mac', 'mac'), ('type', 'text'), ('ports', 'text')])
+IOS_ARP = TableParser(
+    'arp', 'show ip arp',
+    r'^Internet +(%s) +(\d+|-) +(%s) +\S+(?: +(\S+))? *$' % (IPV4_REGEX, MAC_REGEX),
+    [('address', 'ipv4'), ('age', 'minutes'), ('mac', 'mac'), ('interface', 'text')])
+IOS_INTERFACES_STATUS = TableParser(
+    'interfaces_status', 'show interfaces status',
+    r'^(\S+) +(.*?) *\b(%s) +(\S+) +(\S+) +(\S+) *(.*?) *$' % (PORT_STATUS_REGEX),
+    [('port', 'text'), ('name', 'text'), ('status', 'text'), ('vlan', 'text'), ('duplex', 'text'),
+     ('speed', 'text'), ('type', 'text')])
+
+
+class Driver:
+    """Everything we know about driving one kind of device: how to spot it,
+    how to set up a session on it, what its errors, pager prompts and
+    prompts look like, and how to change and save its config.
+
+    This one is the generic driver, which we use until we know what we're
+    talking to, or if we never figure it out. It guesses at the prep and
+    recognizes everybody's errors. Platform drivers subclass it and fill in
+    the class variables. The regexes get compiled once, when the driver is
+    created, not every time we use them.
+
+    To add a platform, subclass Driver and pass an instance of your class
+    to register_driver().
+    """
+
+    # A name for humans.
+    name = 'generic'
+    # The driver applies to a device if every identifier in any one of these
+    # tuples was found on it. See _identify_steps().
+    match = ()
+    # A regex for the SSH server's version string, if it gives away the
+    # platform before we've run a single command.
+    banner = None
+    # The commands that identify this platform, in the order to try them.
+    identify_commands = ()
+    # The commands that set a session up, or None if we have to guess.
+    prepare = None
+    # Commands to run once we're enabled.
+    enable_commands = ()
+    # The commands that turn off paging. Until one of them works, we keep
+    # hitting the space bar after every command.
+    pager_off_commands = ('terminal length 0', 'terminal pager 0', 'set output standard')
+    # If any of these show up in the output of a command, it's an error.
+    error_patterns = ERROR_PATTERNS
+    # What's left of a "--More--" prompt after we hit the space bar.
+    pager_patterns = (' ?--More-- ?(?:\x08+ +\x08+)?',
+                      '<--- More --->(?: {14})?')
+    # What an enabled prompt, and a prompt in config mode, look like.
+    enabled_prompt = r'^.*#\s*$'
+    config_prompt = r'\(.*\)\s*[%s]\s*$' % (re.escape(''.join(END_OF_PROMPT_CHARS)))
+    # How to get into and out of config mode. If config_command is None, we
+    # don't know how to apply config to this platform.
+    config_command = None
+    config_exit = 'exit'
+    end_command = 'end'
+    # The command that shows the running config, or None if we can't diff
+    # config on this platform. See apply_config().
+    running_config_command = None
+    # For pushing config as a file (see apply_config()): where we upload
+    # the file, the command that merges it into the running config, the
+    # question that command might ask (we answer it with a return), and the
+    # command that deletes the file afterwards. %(path)s is the file. If
+    # upload_path is None, we can't do it on this platform.
+    upload_path = None
+    merge_command = 'copy %(path)s running-config'
+    merge_question = r'Destination filename \[running-config\]\?\s*$'
+    delete_command = None
+    # The command that saves the config, and whether the platform saves it
+    # on its own so we don't need one.
+    write_command = None
+    writes_automatically = False
+    # The command whose output tells us whether this is the active device
+    # in an HA pair. See ha_status().
+    ha_command = None
+    # How many shells we'll have open at once on one SSH connection,
+    # counting the first one. See open_channel(). Plenty of SSH servers
+    # allow ten, but network devices tend to be stingier, so we don't push it.
+    max_channels = 4
+    # The tables we know how to parse on this platform, as TableParsers
+    # by name. See send_table().
+    tables = {}
+
+    def __init__(self):
+        self.error_regex = re.compile('|'.join('(?:%s)' % (pattern) for pattern in self.error_patterns), re.MULTILINE)
+        self.pager_regex = re.compile('|'.join('(?:%s)' % (pattern) for pattern in self.pager_patterns))
+        self.enabled_regex = re.compile(self.enabled_prompt)
+        self.config_regex = re.compile(self.config_prompt)
+        self.banner_regex = re.compile(self.banner) if self.banner else None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.__class__.__name__, self.name)
+
+    def matches(self, identifiers):
+        """True if this driver is the right one for these identifiers."""
+
+        for required in self.match:
+            if all(identifier in identifiers for identifier in required):
+                return True
+        return False
+
+    def prepare_commands(self, identify_output):
+        """Return the list of commands that set up a session, given the
+        output of the command that identified the device, or None if we
+        have to guess."""
+
+        if self.prepare is None:
+            return None
+        return list(self.prepare)
+
+    def find_error(self, output):
+        """Return the text that looks like an error in the output, or None."""
+
+        m = self.error_regex.search(output)
+        if m is None:
+            return None
+        return m.group(0)
+
+    def strip_pager(self, output):
+        """Take pager prompts out of some output."""
+        return self.pager_regex.sub('', output)
+
+    def looks_enabled(self, prompt):
+        """True if the prompt looks like an enabled prompt."""
+        return self.enabled_regex.match(prompt) is not None
+
+    def in_config_mode(self, prompt):
+        """True if the prompt looks like we're somewhere in config mode."""
+        return self.config_regex.search(prompt) is not None
+
+    def check_apply_config(self):
+        """Raise an exception if we don't know how to apply config here."""
+
+        if self.config_command is None:
+            raise Exception("Don't know how to apply config on %s devices yet!" % (self.name))
+
+    def table_parser(self, name):
+        """Return the TableParser for a kind of table, or raise an exception
+        if we can't parse that table on this platform."""
+
+        if name not in self.tables:
+            raise Exception("Don't know how to parse %s on %s devices yet! Try one of: %s" % (
+                name, self.name, ', '.join(sorted(self.tables)) or 'nothing, sorry'))
+        return self.tables[name]
+
+    def check_push_config(self):
+        """Raise an exception if we don't know how to push config as a file."""
+
+        if self.upload_path is None:
+            raise Exception("Don't know how to push a config file to %s devices yet!" % (self.name))
+
+    def push_path(self):
+        """Where to upload the file for one config push. Every push gets its
+        own file name (like "flash:/cliwrangler-1f2e3d4c.cfg"), because two
+        sessions pushing to the same box at once would otherwise overwrite
+        each other's file halfway through."""
+
+        self.check_push_config()
+        base, dot, extension = self.upload_path.rpartition('.')
+        if not dot:
+            base, extension = self.upload_path, ''
+        return '%s-%s%s%s' % (base, os.urandom(4).hex(), dot, extension)
+
+    def write_config_command(self):
+        """Return the command that writes the config, or None if the device
+        doesn't need one. Raise an exception if we don't know."""
+
+        if self.write_command is None and not self.writes_automatically:
+            raise Exception("Don't know how to write config on %s devices yet!" % (self.name))
+        return self.write_command
+
+    def ha_status(self, output):
+        """Given the output of ha_command (or None if there isn't one),
+        return True if this device is safe to change, False if it's the
+        standby half of an HA pair, or None if we can't tell."""
+        return None
+
+
+class CiscoIOSDriver(Driver):
+    name = 'Cisco IOS'
+    match = (('Cisco', 'IOS'),)
+    banner = 'Cisco'
+    identify_commands = ('show version',)
+    prepare = ('terminal length 0', 'terminal no monitor', 'terminal no editing')
+    error_patterns = ERROR_PATTERNS + ['^% Ambiguous command']
+    pager_patterns = (' ?--More-- ?(?:\x08+ +\x08+)?',)
+    config_prompt = r'\(config[^)]*\)#\s*$'
+    config_command = 'configure terminal'
+    running_config_command = 'show running-config'
+    upload_path = 'flash:/cliwrangler.cfg'
+    delete_command = 'delete /force %(path)s'
+    write_command = 'write memory'
+    tables = {'mac_address_table': IOS_MAC_ADDRESS_TABLE, 'arp': IOS_ARP, 'interfaces_status': IOS_INTERFACES_STATUS}
+
+    def ha_status(self, output):
+        # We'll always give a green light for Cisco routers and switches.
+        return True
+
+
+class CiscoDriver(Driver):
+    # For a Cisco device we couldn't narrow down any further. We don't know
+    # how to set it up or configure it, but it still gets a green light.
+    name = 'Cisco'
+    match = (('Cisco',),)
+
+    def ha_status(self, output):
+        return True
+
+
+class CiscoIOSXEDriver(CiscoIOSDriver):
+    name = 'Cisco IOS-XE'
+    match = (('Cisco', 'IOS-XE'),)
+
+
+class CiscoNXOSDriver(Driver):
+    name = 'Cisco NX-OS'
+    match = (('NX-OS',), ('Nexus',))
+    identify_commands = ('show version',)
+    prepare = ('terminal length 0',)
+    error_patterns = ERROR_PATTERNS + ['^% Invalid command', '^% Permission denied']
+    pager_patterns = (' ?--More-- ?(?:\x08+ +\x08+)?',)
+    config_prompt = r'\(config[^)]*\)#\s*$'
+    upload_path = 'bootflash:/cliwrangler.cfg'
+    delete_command = 'delete %(path)s no-prompt'
+    write_command = 'copy running-config startup-config'
+    tables = {
+        # The first column is a flag, like "*" for a primary entry.
+        'mac_address_table': TableParser(
+            'mac_address_table', 'show mac address-table',
+            r'^[*+GROCV]? *(\d+|-) +(%s) +(\S+) +\S+ +\S+ +\S+ +(\S+) *$' % (MAC_REGEX),
+            [('vlan', 'int'), ('mac', 'mac'), ('type', 'text'), ('ports', 'text')]),
+        'arp': TableParser(
+            'arp', 'show ip arp',
+            r'^(%s) +([\d:]+|-) +(%s) +(\S+)' % (IPV4_REGEX, MAC_REGEX),
+            [('address', 'ipv4'), ('age', 'seconds'), ('mac', 'mac'), ('interface', 'text')]),
+        'interfaces_status': TableParser(
+            'interfaces_status', 'show interface status', IOS_INTERFACES_STATUS.regex.pattern,
+            IOS_INTERFACES_STATUS.columns),
+    }
+
+    def ha_status(self, output):
+        return True
+
+
+class CiscoASADriver(Driver):
+    name = 'Cisco ASA'
+    match = (('ASA',),)
+    banner = 'Cisco'
+    identify_commands = ('show version',)
+    # ASAs don't let you run "terminal pager 0" until you've enabled.
+    prepare = ()
+    enable_commands = ('terminal pager 0',)
+    pager_patterns = ('<--- More --->(?: {14})?',)
+    config_prompt = r'\(config[^)]*\)#\s*$'
+    upload_path = 'disk0:/cliwrangler.cfg'
+    delete_command = 'delete /noconfirm %(path)s'
+    write_command = 'write memory'
+    ha_command = 'show failover'
+    tables = {
+        'arp': TableParser(
+            'arp', 'show arp',
+            r'^[ \t]*(\S+) +(%s) +(%s) +(\d+|-) *$' % (IPV4_REGEX, MAC_REGEX),
+            [('interface', 'text'), ('address', 'ipv4'), ('mac', 'mac'), ('age', 'seconds')]),
+    }
+
+    def ha_status(self, output):
+        # This has to be graceful about errors, because "show failover"
+        # requires the failover license.
+        if re.search('Command requires failover license', output):
+            return True
+        elif 'Failover Off' in output:
+            return True
+        elif re.search('This host:.*- Active', output):
+            return True
+        elif re.search('This host:.*- Standby', output):
+            return False
+        return None
+
+
+class CiscoFWSMDriver(CiscoASADriver):
+    name = 'Cisco FWSM'
+    match = (('FWSM',),)
+    # There's no flash to upload to.
+    upload_path = None
+
+    def ha_status(self, output):
+        if 'Failover Off' in output:
+            return True
+        elif 'This context: Active' in output:
+            return True
+        elif re.search('This Host:.*- Active', output):
+            return True
+        elif 'This context: Standby' in output:
+            return False
+        elif re.search('This Host:.*- Standby', output):
+            return False
+        return None
+
+
+class FortiOSDriver(Driver):
+    name = 'FortiOS'
+    match = (('Fortinet',), ('FortiGate',))
+    banner = 'Forti'
+    identify_commands = ('get system status',)
+    pager_patterns = ('--More-- ?(?: {9})?',)
+    enabled_prompt = r'^.*#\s*$'
+    config_prompt = r'\) #\s*$'
+    # FortiGate devices automatically write their config when you leave
+    # edit mode.
+    writes_automatically = True
+    ha_command = 'get system status'
+    tables = {
+        'arp': TableParser(
+            'arp', 'get system arp',
+            r'^(%s) +(\d+) +(%s) +(\S+) *$' % (IPV4_REGEX, COLON_MAC_REGEX),
+            [('address', 'ipv4'), ('age', 'minutes'), ('mac', 'mac'), ('interface', 'text')]),
+    }
+
+    def prepare_commands(self, identify_output):
+        # This is horribly dirty because FortiOS CLI is terrible. With vdoms,
+        # the console settings live under "config global".
+        if 'Virtual domain configuration: disable' in (identify_output or ''):
+            return ['config system console', 'set output standard', 'end']
+        return ['config global', 'config system console', 'set output standard', 'end', 'end']
+
+    def ha_status(self, output):
+        # This probably won't always work, but it works for FortiOS 5.x so far.
+        if 'Current HA mode: a-p, master' in output:
+            return True
+        elif 'Current HA mode: standalone' in output:
+            return True
+        elif 'Current HA mode: a-p, backup' in output:
+            return False
+        return None
+
+
+# The generic driver, for devices we can't identify.
+GENERIC_DRIVER = Driver()
+
+# The drivers we know about, in the order we try them. The more specific
+# ones have to come first.
+DRIVERS = [CiscoIOSXEDriver(), CiscoNXOSDriver(), CiscoFWSMDriver(), CiscoASADriver(), FortiOSDriver(),
+           CiscoIOSDriver(), CiscoDriver()]
+
+
+def register_driver(driver):
+    """Add a driver (an instance of a Driver subclass). It gets tried before
+    the built-in ones, so you can also use this to replace one of them."""
+
+    DRIVERS.insert(0, driver)
+
+
+def find_driver(identifiers):
+    """Return the driver for a device with these identifiers."""
+
+    for driver in DRIVERS:
+        if driver.matches(identifiers):
+            return driver
+    return GENERIC_DRIVER
+
+
+def _pager_off_first(server_version):
+    """Whether to send PAGER_OFF_COMMAND before we identify the device.
+    Unless the SSH server's version string says it's a platform that won't
+    know the command (like a FortiGate), it's worth a try."""
+
+    drivers = [driver for driver in DRIVERS
+               if driver.banner_regex is not None and server_version and driver.banner_regex.search(server_version)]
+    return not drivers or any(PAGER_OFF_COMMAND in (driver.prepare or ()) for driver in drivers)
+
+
+def _identification_commands(server_version):
+    """The commands to identify a device with, in the order to try them. If
+    the SSH server's version string gives the platform away, we start with
+    that platform's commands, so we don't waste a round trip on the others."""
+
+    commands = []
+    for driver in DRIVERS:
+        if driver.banner_regex is not None and server_version and driver.banner_regex.search(server_version):
+            commands.extend(driver.identify_commands)
+    commands.extend(IDENTIFICATION_COMMANDS)
+
+    # Only try each one once.
+    ordered = []
+    for command in commands:
+        if command not in ordered:
+            ordered.append(command)
+    return ordered
+
+
+def _host_key_fingerprint(key_blob):
+    """Turn a host key (in SSH wire format) into a fingerprint the way
+    OpenSSH prints them, like "SHA256:nThbg6kXUpJWGl7E1IGOCspRomTxdCARLviKw6E5SY8"."""
+
+    digest = hashlib.sha256(key_blob).digest()
+    return 'SHA256:' + base64.b64encode(digest).decode('ascii').rstrip('=')
+
+
+class HostKeyStore:
+    """The SSH host keys we know about, read from known_hosts files once and
+    shared by every session, instead of every connect() reading and parsing
+    the whole file again. It's safe to use from any number of threads.
+
+    Reading a file only indexes the lines by hostname. We don't decode a key
+    until a session needs it, and we remember what we found for each host.
+    Hashed hostnames ("|1|salt|hash") can only be found by hashing the name
+    we're after with each salt, so the first lookup of a host costs a pass
+    over those, and after that it's free.
+
+    A device whose key doesn't match the one we know gets refused with a
+    paramiko.BadHostKeyException. A device we've never seen gets accepted,
+    the way it always has, and we remember its key (in memory, not in the
+    file) for the rest of the process.
+
+    Arguments:
+    paths - A list of known_hosts files to read. By default, that's
+            ~/.ssh/known_hosts, which is what paramiko reads. Files that
+            don't exist are fine.
+    """
+
+    def __init__(self, paths=None):
+        if paths is None:
+            paths = [os.path.join(os.path.expanduser('~'), '.ssh', 'known_hosts')]
+        self.paths = list(paths)
+        self.lock = threading.Lock()
+        # The known_hosts lines for each plain hostname, and the hashed ones
+        # as (salt, hash, line).
+        self.plain = {}
+        self.hashed = []
+        # The keys we've already looked up, and the ones we accepted from
+        # devices we'd never seen, as {hostname: {keytype: key}}.
+        self.found = {}
+        self.accepted = {}
+
+        for path in self.paths:
+            self.load(path)
+
+    def load(self, path):
+        """Read another known_hosts file, if it exists."""
+
+        try:
+            f = open(path)
+        except (IOError, OSError):
+            return
+        plain = {}
+        hashed = []
+        with f:
+            for line in f:
+                fields = line.split()
+                # Skip comments, and markers like @cert-authority that
+                # paramiko doesn't do anything with either.
+                if len(fields) < 3 or fields[0][0] in '#@':
+                    continue
+                for name in fields[0].split(','):
+                    if name.startswith('|1|'):
+                        try:
+                            salt, digest = name[3:].split('|')
+                            hashed.append((base64.b64decode(salt), base64.b64decode(digest), line))
+                        except ValueError:
+                            continue
+                    else:
+                        plain.setdefault(name, []).append(line)
+
+        with self.lock:
+            for name, lines in plain.items():
+                self.plain.setdefault(name, []).extend(lines)
+            self.hashed.extend(hashed)
+            self.found = {}
+
+    def lookup(self, hostname):
+        """Return the keys we know for a host as {keytype: key}, or None if
+        we don't know it. The hostname looks like "[host]:port" if the port
+        isn't 22, the way known_hosts has it."""
+
+        with self.lock:
+            if hostname in self.found:
+                return self.found[hostname]
+            lines = list(self.plain.get(hostname, ()))
+            hashed = self.hashed
+            accepted = self.accepted.get(hostname, {})
+
+        name = hostname.encode('utf-8')
+        for salt, digest, line in hashed:
+            if hmac.new(salt, name, hashlib.sha1).digest() == digest:
+                lines.append(line)
+
+        keys = {}
+        for line in lines:
+            # A key type paramiko can't read is as good as not being there.
+            try:
+                entry = paramiko.hostkeys.HostKeyEntry.from_line(line)
+            except Exception:
+                continue
+            if entry is not None and entry.key is not None:
+                keys.setdefault(entry.key.get_name(), entry.key)
+        keys.update(accepted)
+        keys = keys or None
+
+        with self.lock:
+            self.found[hostname] = keys
+        return keys
+
+    def add(self, hostname, key):
+        """Remember a key for a host, for the rest of the process."""
+
+        with self.lock:
+            self.accepted.setdefault(hostname, {})[key.get_name()] = key
+            self.found.pop(hostname, None)
+
+    def check(self, hostname, key):
+        """Make sure a device's key is the one we know. If we don't know
+        one, remember this one. Raises paramiko.BadHostKeyException if
+        it's different."""
+
+        keys = self.lookup(hostname)
+        if keys is None or key.get_name() not in keys:
+            self.add(hostname, key)
+            return True
+        expected = keys[key.get_name()]
+        if expected.asbytes() != key.asbytes():
+            raise paramiko.BadHostKeyException(hostname, key, expected)
+        return True
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(lines) for lines in self.plain.values()) + len(self.hashed)
+
+
+class _HostKeyPolicy(paramiko.MissingHostKeyPolicy):
+    """Checks every host key against a HostKeyStore. Our SSHClients don't
+    load any host keys of their own, so paramiko asks us about every one."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def missing_host_key(self, client, hostname, key):
+        self.store.check(hostname, key)
+
+
+# The process-wide host key store. See host_key_store().
+_HOST_KEY_STORE = None
+_HOST_KEY_STORE_LOCK = threading.Lock()
+
+
+def host_key_store():
+    """Return the HostKeyStore that sessions use unless they're given
+    their own. It reads ~/.ssh/known_hosts the first time we need it."""
+
+    global _HOST_KEY_STORE
+    with _HOST_KEY_STORE_LOCK:
+        if _HOST_KEY_STORE is None:
+            _HOST_KEY_STORE = HostKeyStore()
+        return _HOST_KEY_STORE
+
+
+def _scp_file_name(path):
+    """The file name at the end of a path like "flash:/cliwrangler.cfg"."""
+    return re.split('[/:]', path)[-1]
+
+
+def _scp_reply(reply, message=b''):
+    """Check the byte an SCP sink answers with: 0 is OK, and anything else
+    comes with an error message."""
+
+    if reply == b'\x00':
+        return
+    if not reply:
+        raise Exception("The device hung up during the SCP upload")
+    raise Exception("SCP upload failed: %s" % (message.decode('utf-8', 'ignore').strip()))
+
+
+def _scp_upload(transport, data, path, timeout):
+    """Copy some bytes to a file on the device with SCP. SCP is just "scp -t
+    <path>" running on the other end, and a very small protocol: it says
+    OK, we tell it the file's mode, size and name, it says OK, we send the
+    file and a zero byte, and it says OK one last time."""
+
+    def reply():
+        answer = channel.recv(1)
+        message = b''
+        if answer not in (b'', b'\x00'):
+            while not message.endswith(b'\n'):
+                char = channel.recv(1)
+                if not char:
+                    break
+                message += char
+        _scp_reply(answer, message)
+
+    channel = transport.open_session(timeout=timeout)
+    try:
+        channel.settimeout(timeout)
+        channel.exec_command('scp -t %s' % (path))
+        reply()
+        channel.sendall(('C0644 %d %s\n' % (len(data), _scp_file_name(path))).encode('utf-8'))
+        reply()
+        channel.sendall(data)
+        channel.sendall(b'\x00')
+        reply()
+    finally:
+        channel.close()
+
+
+class ProfileCache:
+    """Remembers what we learned about each device the last time we
+    connected to it, so that next time we can skip most of the work in
+    connect(). A profile has the device's identifiers and facts, its prompt
+    prefix and the prep commands that worked on it. With one of those in hand, connect()
+    just sends the prep commands and doesn't have to try the ones that
+    don't work or run "show version" again.
+
+    Profiles are kept in a JSON file, keyed by the device, the port and the
+    fingerprint of the device's host key. If the device gets replaced (or
+    reinstalled), the host key changes and we start over. The same goes if
+    the prompt doesn't look like it did last time, or if one of the prep
+    commands stops working.
+
+    The file is rewritten atomically, so several processes can share one.
+    If two of them write at once, one of the updates gets lost, which just
+    means that device gets profiled again next time.
+    """
+
+    def __init__(self, path=None, ttl=7 * 24 * 3600):
+        """Arguments:
+        path - The file to keep the profiles in. The default is
+               ~/.cliwrangler_profiles.json.
+        ttl - How many seconds a profile is good for, or None for forever.
+        """
+
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.cliwrangler_profiles.json')
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+    def _key(self, device, port, fingerprint):
+        return '%s:%s %s' % (device, port, fingerprint)
+
+    def _expired(self, profile):
+        return self.ttl is not None and time.time() - profile['saved'] > self.ttl
+
+    def _load(self):
+        """Read all the profiles from the file. A missing or broken file is
+        the same as an empty one."""
+
+        try:
+            with open(self.path) as f:
+                profiles = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(profiles, dict):
+            return {}
+        return profiles
+
+    def _save(self, profiles):
+        """Write all the profiles to a temporary file next to the real one,
+        then move it into place."""
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix='.cliwrangler-profiles-', dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(profiles, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, device, port, fingerprint):
+        """Return the profile for this device and host key, or None if we
+        don't have one or it's too old."""
+
+        with self.lock:
+            profile = self._load().get(self._key(device, port, fingerprint))
+        if profile is None or self._expired(profile):
+            return None
+        return profile
+
+    def put(self, device, port, fingerprint, identifiers, prompt_prefix, prepare, facts=None):
+        """Save a profile for this device and host key.
+
+        Arguments:
+        device - The device name or address we connected to.
+        port - The SSH port.
+        fingerprint - The fingerprint of the device's host key.
+        identifiers - The device's identifiers, like ['Cisco', 'IOS', 'C3750'].
+        prompt_prefix - The device's prompt prefix.
+        prepare - The list of prep commands that worked.
+        facts - What we know about the device, like {'vendor': 'Cisco'}.
+        """
+
+        with self.lock:
+            profiles = self._load()
+            # Throw out anything that's expired while we're here.
+            for key in list(profiles.keys()):
+                if self._expired(profiles[key]):
+                    del profiles[key]
+            profiles[self._key(device, port, fingerprint)] = {
+                'device': device,
+                'port': port,
+                'fingerprint': fingerprint,
+                'identifiers': list(identifiers),
+                'prompt_prefix': prompt_prefix,
+                'prepare': list(prepare),
+                'facts': dict(facts or {}),
+                'saved': time.time(),
+            }
+            self._save(profiles)
+
+    def invalidate(self, device=None, port=None):
+        """Forget the profiles for a device (on any port, unless you say
+        which one), or for every device if you don't give one."""
+
+        with self.lock:
+            profiles = self._load()
+            for key in list(profiles.keys()):
+                profile = profiles[key]
+                if device is not None and profile.get('device') != device:
+                    continue
+                if port is not None and profile.get('port') != port:
+                    continue
+                del profiles[key]
+            self._save(profiles)
+
+    def usable(self, profile, prompt_prefix):
+        """True if a profile still looks right for a device, given the
+        prompt prefix we just saw on it. If it doesn't, we forget it."""
+
+        if profile['prompt_prefix'] == prompt_prefix:
+            return True
+        self.invalidate(profile['device'], profile['port'])
+        return False
+
+
+# The commands whose results ResultCache will keep by default. These are
+# regexes, and the commands they match had better not change anything.
+CACHEABLE_COMMANDS = ['^show ', '^get ']
+
+
+class ResultCache:
+    """Remembers the output of read-only commands like "show version" for a
+    little while, so that when several parts of a job ask a device the same
+    question, only the first one has to wait for the answer.
+
+    Results are keyed by the device, the port, the prompt (which tells us
+    the mode we were in, like enabled, config mode or a FortiOS vdom) and
+    the command. Only commands that match one of the "commands" regexes get
+    cached, and only if they worked and didn't change the prompt. Anything
+    else we send to a device might have changed it, so it makes us forget
+    everything we knew about that device, and so does apply_config(),
+    write_config() or a change of prompt.
+
+    Give one to a single session, or share one between all your sessions
+    (even in different threads), since the device is part of the key.
+    """
+
+    def __init__(self, ttl=60, max_entries=256, commands=CACHEABLE_COMMANDS):
+        """Arguments:
+        ttl - How many seconds a result is good for, or None for forever.
+        max_entries - How many results to keep. When there are more, the
+                      least recently used ones get thrown out.
+        commands - A list of regexes for the commands we're allowed to cache.
+        """
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.command_regex = re.compile('|'.join('(?:%s)' % (command) for command in commands))
+        self.lock = threading.Lock()
+        # (device, port, prompt, command) -> (saved, output, output_raw),
+        # with the most recently used at the end.
+        self.entries = collections.OrderedDict()
+        # How many times we did and didn't have an answer.
+        self.hits = 0
+        self.misses = 0
+
+    def cacheable(self, command):
+        """True if we're allowed to cache this command's output."""
+        return self.command_regex.search(command.strip()) is not None
+
+    def get(self, device, port, prompt, command):
+        """Return (output, output_raw) for this command, or None if we
+        don't have a fresh result for it."""
+
+        key = (device, port, prompt, command.strip())
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, device, port, prompt, command, output, output_raw):
+        """Save the result of a command."""
+
+        key = (device, port, prompt, command.strip())
+        with self.lock:
+            self.entries[key] = (time.time(), output, output_raw)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, device=None, port=None):
+        """Forget the results for a device (on any port, unless you say
+        which one), or for every device if you don't give one."""
+
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if device is not None and key[0] != device:
+                    continue
+                if port is not None and key[1] != port:
+                    continue
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# paramiko 2.12 and up let us hand SSHClient our own Transport class, which
+# is how we time the key exchange separately from logging in, and how we get
+# to reorder the algorithms before the key exchange starts.
+_TRANSPORT_FACTORY = 'transport_factory' in inspect.signature(paramiko.SSHClient.connect).parameters
+
+# The ssh_options that pick which algorithms we'd rather use, and the
+# paramiko security options they reorder.
+PREFERENCE_OPTIONS = {'ciphers': 'ciphers', 'kex': 'kex', 'macs': 'digests', 'host_key_types': 'key_types'}
+
+
+class _TimedTransport(paramiko.Transport):
+    """A paramiko Transport that notes how long the SSH handshake took,
+    and puts the algorithms we prefer at the front of the list it offers.
+
+    Arguments:
+    sock - The socket, like for any Transport.
+    preferences - A dict like {'ciphers': ['aes128-ctr']}, keyed by the
+                  names in PREFERENCE_OPTIONS. The algorithms we don't
+                  mention are still offered, after these.
+    """
+
+    handshake_seconds = None
+
+    def __init__(self, sock, preferences=None, **kwargs):
+        paramiko.Transport.__init__(self, sock, **kwargs)
+        options = self.get_security_options()
+        for name, preferred in (preferences or {}).items():
+            attribute = PREFERENCE_OPTIONS[name]
+            offered = getattr(options, attribute)
+            unknown = [algorithm for algorithm in preferred if algorithm not in offered]
+            if unknown:
+                raise Exception("paramiko doesn't support these %s: %s" % (name, ', '.join(unknown)))
+            setattr(options, attribute, tuple(preferred) + tuple(a for a in offered if a not in preferred))
+
+    def start_client(self, event=None, timeout=None):
+        started = time.time()
+        try:
+            return paramiko.Transport.start_client(self, event=event, timeout=timeout)
+        finally:
+            self.handshake_seconds = time.time() - started
+
+
+class _Histogram:
+    """A Prometheus-style histogram: a count of observations in each bucket,
+    plus the sum and count of all of them."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return (upper bound, count of observations at or below it) for
+        each bucket, ending with "+Inf"."""
+
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """Collects timings from any number of sessions. Give one of these to
+    CLIWrangler(metrics=...), and the session times each phase of its life
+    and each command it runs. Share one across all your sessions to get
+    histograms for the whole sweep.
+
+    The phases are "queue" (waiting for a ConnectionScheduler to let us log
+    in), "tcp" (the TCP connection), "handshake" (the SSH key exchange),
+    "auth" (logging in), "shell" (opening a shell and finding the first
+    prompt), "prepare" and "identify" (see connect()), plus "wait"
+    (waiting for the device to be ready for more typing after a command) and
+    "expect" (waiting for the rest of a command's output).
+
+    For each command, we keep the bytes received, the number of reads, the
+    time to the first byte, the time spent waiting, the time spent
+    expecting and the total time until the prompt came back.
+
+    If you register callbacks, each one gets called with a dict for every
+    phase and every command as it happens, in the session's thread.
+    """
+
+    # Bucket upper bounds, in seconds.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, buckets=None):
+        """Arguments:
+        buckets - The histogram bucket upper bounds in seconds, if you don't
+                  like ours.
+        """
+
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.lock = threading.Lock()
+        self.callbacks = []
+        # Histograms of phase times keyed by phase, and of command times
+        # keyed by stage (total, ttfb, wait, expect).
+        self.phases = {}
+        self.commands = {}
+        self.counters = {'commands': 0, 'received_bytes': 0, 'reads': 0}
+
+    def add_callback(self, callback):
+        """Call callback(event) for every phase and command from now on."""
+        self.callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def _observe(self, histograms, key, value):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = _Histogram(self.buckets)
+        histogram.observe(value)
+
+    def phase(self, session, phase, seconds):
+        """Record that a session spent "seconds" in a phase."""
+
+        with self.lock:
+            self._observe(self.phases, phase, seconds)
+        for callback in self.callbacks:
+            callback({'type': 'phase', 'device': session.device, 'phase': phase, 'seconds': seconds})
+
+    def command(self, session, timing):
+        """Record the timing of a command. See CLIWrangler.command_timing."""
+
+        with self.lock:
+            self._observe(self.commands, 'total', timing['seconds'])
+            self._observe(self.commands, 'wait', timing['wait'])
+            self._observe(self.commands, 'expect', timing['expect'])
+            if timing['ttfb'] is not None:
+                self._observe(self.commands, 'ttfb', timing['ttfb'])
+            self.counters['commands'] += 1
+            self.counters['received_bytes'] += timing['bytes']
+            self.counters['reads'] += timing['reads']
+
+        if self.callbacks:
+            event = dict(timing)
+            event['type'] = 'command'
+            event['device'] = session.device
+            for callback in self.callbacks:
+                callback(event)
+
+    def as_dict(self):
+        """Everything we've collected, as a dict of plain old data."""
+
+        def histograms(collection):
+            return dict((key, {'count': histogram.count,
+                               'sum': histogram.sum,
+                               'buckets': [[bound, count] for bound, count in histogram.cumulative()]})
+                        for key, histogram in collection.items())
+
+        with self.lock:
+            return {'phase_seconds': histograms(self.phases),
+                    'command_seconds': histograms(self.commands),
+                    'counters': dict(self.counters)}
+
+    def to_json(self):
+        """Everything we've collected, as JSON."""
+        return json.dumps(self.as_dict(), sort_keys=True)
+
+    def to_prometheus(self):
+        """Everything we've collected, in the Prometheus text format."""
+
+        data = self.as_dict()
+        lines = []
+
+        for name, label, description in (('phase_seconds', 'phase', 'Time spent in each phase of a session.'),
+                                         ('command_seconds', 'stage', 'Time spent on each stage of a command.')):
+            metric = 'cliwrangler_%s' % (name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s histogram' % (metric))
+            for key, histogram in sorted(data[name].items()):
+                for bound, count in histogram['buckets']:
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (metric, label, key, bound, count))
+                lines.append('%s_sum{%s="%s"} %r' % (metric, label, key, histogram['sum']))
+                lines.append('%s_count{%s="%s"} %d' % (metric, label, key, histogram['count']))
+
+        for name, description in (('commands', 'Commands run.'),
+                                  ('received_bytes', 'Bytes of output received.'),
+                                  ('reads', 'Reads from the SSH channel.')):
+            metric = 'cliwrangler_%s_total' % (name)
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s counter' % (metric))
+            lines.append('%s %d' % (metric, data['counters'][name]))
+
+        return '\n'.join(lines) + '\n'
+
+
+class SpooledOutput:
+    """The output of a command that send() wrote to a file instead of
+    keeping in memory. You get one of these back when you call send() with
+    "spool". The file holds exactly what send() would have returned
+    otherwise: the cleaned output, starting with the command echo and
+    without the prompt at the end.
+
+    The file is memory-mapped, so you can search it, slice it and pull
+    lines out of it without reading the whole thing into Python. Lines
+    come back as strings without line endings, like splitlines() would
+    give you. We only find where the lines start the first time you ask
+    for one by number.
+
+    Call close() when you're done, or use it in a "with" statement. If we
+    spooled to a temporary file, close() deletes it.
+    """
+
+    def __init__(self, spool):
+        """Open the file to spool into.
+
+        Arguments:
+        spool - A filename, or True to use a temporary file.
+        """
+
+        if spool is True:
+            fd, self.path = tempfile.mkstemp(prefix='cliwrangler-', suffix='.txt')
+            self.file = os.fdopen(fd, 'w+b')
+            self.temporary = True
+        else:
+            self.path = spool
+            self.file = open(spool, 'w+b')
+            self.temporary = False
+
+        # The size of the output in bytes.
+        self.size = 0
+        # The memory-mapped file, once we're done writing. An empty file
+        # can't be mapped, so in that case it's just an empty bytes object,
+        # which works the same as far as we're concerned.
+        self.mmap = None
+        # Where each line starts, built the first time it's needed.
+        self._offsets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return "<SpooledOutput %s (%d bytes)>" % (self.path, self.size)
+
+    def __str__(self):
+        return self.read()
+
+    def __len__(self):
+        """The number of lines."""
+        return len(self.offsets())
+
+    def __iter__(self):
+        return self.lines()
+
+    def __getitem__(self, index):
+        """Get a line by number, or a list of lines with a slice."""
+
+        if isinstance(index, slice):
+            return [self.line(i) for i in range(*index.indices(len(self)))]
+        return self.line(index)
+
+    def __contains__(self, text):
+        return self.mmap.find(text.encode('utf-8')) != -1
+
+    def write(self, text):
+        """Add some output to the end of the file."""
+
+        data = text.encode('utf-8')
+        self.file.write(data)
+        self.size += len(data)
+
+    def finish(self, tail):
+        """We're done writing. Chop the prompt off the end (it's the last
+        "tail" characters we wrote) and map the file."""
+
+        self.size -= len(tail.encode('utf-8'))
+        self.file.truncate(self.size)
+        self.file.flush()
+
+        if self.size:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mmap = b''
+
+    def close(self):
+        """Unmap and close the file, and delete it if it's a temporary one."""
+
+        try:
+            self.mmap.close()
+        except:
+            pass
+        self.file.close()
+        if self.temporary and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def read(self):
+        """Read the whole thing into a string. This is what we were trying
+        to avoid, but sometimes you need it."""
+        return self.mmap[:].decode('utf-8', 'ignore')
+
+    def offsets(self):
+        """Return an array of the byte offset where each line starts."""
+
+        if self._offsets is None:
+            offsets = array.array('Q')
+            start = 0
+            while start < self.size:
+                offsets.append(start)
+                end = self.mmap.find(b'\n', start)
+                if end == -1:
+                    break
+                start = end + 1
+            self._offsets = offsets
+        return self._offsets
+
+    def line(self, index):
+        """Return line number "index", counting from zero."""
+
+        offsets = self.offsets()
+        start = offsets[index]
+        end = self.mmap.find(b'\n', start)
+        if end == -1:
+            end = self.size
+        return self.mmap[start:end].decode('utf-8', 'ignore')
+
+    def lines(self):
+        """Yield each line in turn."""
+
+        start = 0
+        while start < self.size:
+            end = self.mmap.find(b'\n', start)
+            if end == -1:
+                end = self.size
+            yield self.mmap[start:end].decode('utf-8', 'ignore')
+            start = end + 1
+
+    def grep(self, pattern, flags=0):
+        """Yield each line that the regex matches somewhere in, like grep.
+        "^" and "$" match at the start and end of lines."""
+
+        regex = re.compile(pattern.encode('utf-8'), flags | re.MULTILINE)
+        position = 0
+        while position < self.size:
+            m = regex.search(self.mmap, position)
+            if m is None:
+                break
+            start = self.mmap.rfind(b'\n', 0, m.start()) + 1
+            end = self.mmap.find(b'\n', m.end())
+            if end == -1:
+                end = self.size
+            yield self.mmap[start:end].decode('utf-8', 'ignore')
+            # One line per match, like grep.
+            position = end + 1
+
+    def find_error(self, error_patterns=ERROR_PATTERNS):
+        """Return the first line that looks like an error, or None. This is
+        the same check send() does on its output."""
+
+        for error in error_patterns:
+            for line in self.grep(error):
+                return line
+        return None
+
+
+# Recordings start with this, so we know what we're reading.
+RECORDING_MAGIC = b'CLIWREC1\n'
+
+# Every record in a recording starts with this header: the kind of record,
+# which shell it's about, the seconds since the session started, and how
+# many bytes of data follow it.
+_RECORD_HEADER = struct.Struct('<cHdI')
+
+# The kinds of records.
+_RECORD_SESSION = b'M'      # A session starts. The data is JSON.
+_RECORD_CONNECTED = b'K'    # The SSH connection is up. The data is JSON.
+_RECORD_OPEN = b'O'         # A shell opened.
+_RECORD_SENT = b'S'         # We sent something to a shell.
+_RECORD_RECEIVED = b'R'     # We got something from a shell.
+_RECORD_CLOSED = b'C'       # A shell closed.
+
+
+def _wait_readable(channel, timeout):
+    """Wait up to "timeout" seconds for a channel to have something for us to
+    read, and return True if it does. A paramiko Channel works with select(),
+    but a ReplayChannel isn't a real socket, so it does its own waiting."""
+
+    wait = getattr(channel, 'wait_readable', None)
+    if wait is not None:
+        return wait(timeout)
+    readable, _, _ = select.select([channel], [], [], timeout)
+    return bool(readable)
+
+
+class SessionRecorder:
+    """Writes down every byte a session sends and receives, with the time it
+    happened, so that we can play the session back later without the device.
+    CLIWrangler(record=...) makes one of these for you.
+
+    A recording is a file of records, each with a small binary header and
+    then its data, which we only ever append to. That keeps recording cheap,
+    and one file can hold as many sessions as you like, one after another.
+    If we die partway through a record, load_recordings() stops before it.
+
+    Everything goes in, including our unique string and the backspaces we
+    type over it, except passwords that we type at the device (like the
+    enable password), which are written down as asterisks. The login
+    password is part of the SSH handshake, so it's never in there at all.
+
+    Arguments:
+    path - The file to record to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(RECORDING_MAGIC)
+        self.started = time.time()
+        # How many shells we've recorded so far, which numbers the next one.
+        self.shells = 0
+        # Things we type that we don't want written down.
+        self.secrets = set()
+        # The shells from send_parallel() all record from their own threads.
+        self.lock = threading.Lock()
+
+    def _write(self, kind, shell, data=b'', when=None):
+        with self.lock:
+            if self.file is None:
+                return
+            seconds = (when or time.time()) - self.started
+            self.file.write(_RECORD_HEADER.pack(kind, shell, seconds, len(data)))
+            self.file.write(data)
+
+    def start(self, device, port, username):
+        """Start recording a session."""
+        info = {'device': device, 'port': port, 'username': username, 'started': self.started}
+        self._write(_RECORD_SESSION, 0, json.dumps(info).encode('utf-8'))
+
+    def connected(self, transport):
+        """Write down what we learned from the SSH handshake, which is what
+        connect() wants to know about the connection."""
+        info = {'server_version': transport.remote_version,
+                'host_key': base64.b64encode(transport.get_remote_server_key().asbytes()).decode('ascii')}
+        self._write(_RECORD_CONNECTED, 0, json.dumps(info).encode('utf-8'))
+
+    def channel(self, channel, requested=None):
+        """Start recording a shell, and return a channel to use in place of
+        the real one. "requested" is when we asked for the shell, so that
+        the time it took to open is part of the recording."""
+        with self.lock:
+            self.shells += 1
+            shell = self.shells
+        self._write(_RECORD_OPEN, shell, when=requested)
+        return _RecordingChannel(channel, self, shell)
+
+    def sent(self, shell, data):
+        for secret in self.secrets:
+            data = data.replace(secret, b'*' * len(secret))
+        self._write(_RECORD_SENT, shell, data)
+
+    def received(self, shell, data):
+        self._write(_RECORD_RECEIVED, shell, data)
+
+    def closed(self, shell):
+        self._write(_RECORD_CLOSED, shell)
+
+    def close(self):
+        """Finish the recording."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class _RecordingChannel:
+    """A paramiko Channel that tells a SessionRecorder about everything that
+    goes through it. Anything else gets passed through to the real one."""
+
+    def __init__(self, channel, recorder, shell):
+        self.channel = channel
+        self.recorder = recorder
+        self.shell = shell
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def send(self, data):
+        sent = self.channel.send(data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.recorder.sent(self.shell, data[:sent])
+        return sent
+
+    def recv(self, nbytes):
+        data = self.channel.recv(nbytes)
+        if data:
+            self.recorder.received(self.shell, data)
+        else:
+            self._finish()
+        return data
+
+    def close(self):
+        self.channel.close()
+        self._finish()
+
+    def _finish(self):
+        if not self.finished:
+            self.finished = True
+            self.recorder.closed(self.shell)
+
+
+class Recording:
+    """One session from a recording file. You get these from
+    load_recordings(), and hand them to CLIWrangler(replay=...).
+
+    "info" has the device, port and username the session connected to, and
+    when it started. "server_version" and "host_key" are from the SSH
+    handshake, which took "connected" seconds. "shells" has the records for
+    each shell in the order they were opened, as a list of (kind, seconds,
+    data) tuples, where kind is one of the _RECORD_* bytes.
+    """
+
+    def __init__(self, info):
+        self.info = info
+        self.server_version = None
+        self.host_key = None
+        self.connected = None
+        self.shells = []
+
+    def __repr__(self):
+        return "<Recording of %s, %d shells>" % (self.info.get('device'), len(self.shells))
+
+    def sent(self, shell=0):
+        """Everything we sent to a shell, in one string of bytes."""
+        return b''.join(data for kind, seconds, data in self.shells[shell] if kind == _RECORD_SENT)
+
+    def received(self, shell=0):
+        """Everything we got from a shell, in one string of bytes."""
+        return b''.join(data for kind, seconds, data in self.shells[shell] if kind == _RECORD_RECEIVED)
+
+
+def load_recordings(path):
+    """Read a recording file, and return a list of Recordings, one for each
+    session in it, oldest first."""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(RECORDING_MAGIC):
+        raise Exception("%s isn't a cliwrangler recording" % (path))
+
+    recordings = []
+    shells = {}
+    position = len(RECORDING_MAGIC)
+    while position + _RECORD_HEADER.size <= len(data):
+        kind, shell, seconds, length = _RECORD_HEADER.unpack_from(data, position)
+        position += _RECORD_HEADER.size
+        # Whoever was writing this died before they finished the record.
+        if position + length > len(data):
+            break
+        payload = data[position:position + length]
+        position += length
+
+        if kind == _RECORD_SESSION:
+            recording = Recording(json.loads(payload.decode('utf-8')))
+            recordings.append(recording)
+            shells = {}
+        elif not recordings:
+            raise Exception("%s has a record that isn't part of any session" % (path))
+        elif kind == _RECORD_CONNECTED:
+            info = json.loads(payload.decode('utf-8'))
+            recording.server_version = info['server_version']
+            recording.host_key = base64.b64decode(info['host_key'])
+            recording.connected = seconds
+        elif kind == _RECORD_OPEN:
+            shells[shell] = [(kind, seconds, payload)]
+            recording.shells.append(shells[shell])
+        else:
+            shells[shell].append((kind, seconds, payload))
+
+    return recordings
+
+
+class ReplayClient:
+    """Stands in for paramiko's SSHClient and plays back a Recording, so
+    that a CLIWrangler can connect() and send() without a device. It's what
+    CLIWrangler(replay=...) uses.
+
+    Arguments:
+    recording - A Recording, or the path of a recording file, in which case
+                we play the last session in it.
+    speed - How fast to play it: 1.0 is as fast as it happened, 10.0 is ten
+            times faster, and None is as fast as we can go.
+    """
+
+    def __init__(self, recording, speed=1.0):
+        if not isinstance(recording, Recording):
+            recordings = load_recordings(recording)
+            if not recordings:
+                raise Exception("There aren't any sessions in %s" % (recording))
+            recording = recordings[-1]
+        self.recording = recording
+        self.speed = speed
+        self.transport = None
+        self.channels = []
+        self.lock = threading.Lock()
+
+    def set_missing_host_key_policy(self, policy):
+        pass
+
+    def connect(self, hostname, port=22, username=None, password=None, **kwargs):
+        """Take as long as the SSH handshake did."""
+        if self.speed is not None and self.recording.connected is not None:
+            time.sleep(self.recording.connected / self.speed)
+        self.transport = _ReplayTransport(self.recording)
+
+    def get_transport(self):
+        return self.transport
+
+    def invoke_shell(self, term='vt100', width=80, height=24, **kwargs):
+        """Start playing the next shell in the recording."""
+        with self.lock:
+            if len(self.channels) >= len(self.recording.shells):
+                raise paramiko.SSHException("The recording of %s doesn't have another shell" % (
+                    self.recording.info.get('device')))
+            channel = ReplayChannel(self.recording.shells[len(self.channels)], self.speed)
+            self.channels.append(channel)
+        return channel
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        if self.transport is not None:
+            self.transport.active = False
+
+
+class _ReplayTransport:
+    """The parts of a paramiko Transport that CLIWrangler looks at."""
+
+    def __init__(self, recording):
+        self.recording = recording
+        self.remote_version = recording.server_version
+        self.active = True
+
+    def get_remote_server_key(self):
+        # All we ever want from it is asbytes(), and a Message does that.
+        return paramiko.Message(self.recording.host_key or b'')
+
+    def is_active(self):
+        return self.active
+
+    def set_keepalive(self, interval):
+        pass
+
+    def open_session(self, *args, **kwargs):
+        raise Exception("Can't open a new channel to %s during a replay" % (self.recording.info.get('device')))
+
+
+class ReplayChannel:
+    """Plays back one shell from a Recording, standing in for a paramiko
+    Channel. The output comes back in the same chunks it came in when we
+    recorded it, and each chunk shows up as long after the last thing that
+    happened (the last chunk, or the last thing we typed) as it did then,
+    divided by the speed.
+
+    We don't check what gets typed, only how much. The output that came
+    after we typed something in the recording doesn't show up until we've
+    typed at least as many bytes. If we wait for output that won't come
+    until we've typed something, the session has gone off script, and
+    recv() raises an exception instead of waiting forever.
+
+    Arguments:
+    records - The shell's records, from Recording.shells.
+    speed - See ReplayClient.
+    """
+
+    def __init__(self, records, speed=1.0):
+        self.records = records
+        self.speed = speed
+        self.position = 1
+        # How much of the current chunk of output we've handed out already.
+        self.offset = 0
+        # How many bytes we've typed, and how many the recording has typed
+        # up to where we are, and when we reached each total.
+        self.bytes_sent = 0
+        self.bytes_expected = 0
+        self.sends = collections.deque()
+        # The last thing we typed and the last chunk of output: when each
+        # happened in the recording, and when it happened this time.
+        now = time.time()
+        self.last_sent = (records[0][1], now)
+        self.last_received = (records[0][1], now)
+        self.timeout = None
+        self.closed = False
+
+    def _next(self):
+        """Skip what we've already typed, and return the next record, or
+        None if we're at the end."""
+
+        while self.position < len(self.records):
+            record = self.records[self.position]
+            kind, seconds, data = record
+            if kind != _RECORD_SENT or self.bytes_sent < self.bytes_expected + len(data):
+                return record
+            self.bytes_expected += len(data)
+            while self.sends[0][0] < self.bytes_expected:
+                self.sends.popleft()
+            self.last_sent = (seconds, self.sends[0][1])
+            self.position += 1
+        return None
+
+    def _due(self, seconds):
+        """When the output recorded at "seconds" should show up this time."""
+        if self.speed is None:
+            return 0
+        return max(happened + (seconds - recorded) / self.speed
+                   for recorded, happened in (self.last_sent, self.last_received))
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def send_ready(self):
+        return True
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.bytes_sent += len(data)
+        self.sends.append((self.bytes_sent, time.time()))
+        return len(data)
+
+    def sendall(self, data):
+        self.send(data)
+
+    def recv_ready(self):
+        record = self._next()
+        return record is None or record[0] != _RECORD_SENT and self._due(record[1]) <= time.time()
+
+    def wait_readable(self, timeout):
+        """Like select() on a real channel: wait up to "timeout" seconds for
+        output, and return True if there is some."""
+
+        record = self._next()
+        if record is None or record[0] == _RECORD_CLOSED:
+            return True
+        wait = timeout
+        if record[0] == _RECORD_RECEIVED:
+            wait = self._due(record[1]) - time.time()
+            if wait <= timeout:
+                if wait > 0:
+                    time.sleep(wait)
+                return True
+        # The device wouldn't say anything, so we just wait, unless we're
+        # going as fast as we can.
+        if self.speed is not None:
+            time.sleep(timeout)
+        return False
+
+    def recv(self, nbytes):
+        record = self._next()
+        if (record is None or record[0] == _RECORD_CLOSED) and self.bytes_sent > self.bytes_expected:
+            raise Exception("The replay went off script: we typed %d bytes, but the recording only typed %d" % (
+                self.bytes_sent, self.bytes_expected))
+        if self.closed or record is None or record[0] == _RECORD_CLOSED:
+            self.closed = True
+            return b''
+        kind, seconds, data = record
+        if kind == _RECORD_SENT:
+            raise Exception("The replay went off script: we're waiting for output, but the recording typed %r "
+                            "first, and we've only typed %d of the %d bytes it had by then" % (
+                                data[:40], self.bytes_sent, self.bytes_expected + len(data)))
+
+        due = self._due(seconds)
+        wait = due - time.time()
+        if wait > 0:
+            if self.timeout is not None and wait > self.timeout:
+                time.sleep(self.timeout)
+                raise socket.timeout()
+            time.sleep(wait)
+
+        chunk = data[self.offset:self.offset + nbytes]
+        self.offset += len(chunk)
+        if self.offset >= len(data):
+            self.position += 1
+            self.offset = 0
+            self.last_received = (seconds, max(due, self.last_received[1]))
+        return chunk
+
+    def exit_status_ready(self):
+        return False
+
+    def close(self):
+        self.closed = True
+
+
+def _do(method, *args, **kwargs):
+    """What the conversations in _SessionProtocol yield when they need the
+    session to talk to the device: the name of one of the session's methods,
+    and what to call it with."""
+    return method, args, kwargs
+
+
+class _LineFilter:
+    """Turns the output of a command, a chunk at a time, into the clean lines
+    that send_iter() yields: no command echo, no line endings, no pager
+    prompts, and nothing from the first line that looks like an error on."""
+
+    def __init__(self, driver, paging):
+        self.driver = driver
+        self.paging = paging
+        self.partial = ''
+        self.echo = True
+        # The line that looked like an error, if one did.
+        self.error = None
+
+    def feed(self, text):
+        """Take in some more output, and return the lines it finished."""
+
+        lines = (self.partial + text).split('\n')
+        # The last piece isn't a whole line yet. At the very end, it's the
+        # prompt.
+        self.partial = lines.pop()
+        clean = []
+        for line in lines:
+            if self.echo:
+                self.echo = False
+                continue
+            if self.error is not None:
+                continue
+            if self.paging:
+                line = self.driver.strip_pager(line)
+            if self.driver.error_regex.search(line):
+                self.error = line
+                continue
+            clean.append(line)
+        return clean
+
+
+class _SessionProtocol:
+    """What CLIWrangler and AsyncCLIWrangler have in common, which is
+    everything but the I/O: what we type, when, and what we make of what
+    comes back.
+
+    Anything that takes a conversation with the device is a generator here
+    (those are the methods whose names end in _steps). Whenever it needs the
+    device, it yields _do('send', command) or the like, and gets back
+    whatever that call returned, or has its exception raised at the yield.
+    CLIWrangler._run() makes those calls the ordinary way, and
+    AsyncCLIWrangler._run() awaits them. That way there's only one copy of
+    the logic, and the two classes only differ in how they read and write.
+
+    A subclass supplies _run(), _write(), _write_line(), _sleep(),
+    _expect(), _expect_output(), _wait_for_echo(), _host_key_fingerprint()
+    and _server_version(), plus the public methods.
+    """
+
+    def __init__(self, timeout, newline, backspace, buffer_size, wait, echo, readiness, profile_cache, metrics,
+                 result_cache, max_channels, ssh_options, host_keys):
+        """See CLIWrangler.__init__() for what the arguments mean."""
+
+        # Arguments
+        self.timeout = timeout
+        self.newline = newline
+        self.backspace = backspace
+        self.buffer_size = buffer_size
+        self.wait = wait
+        self.echo = echo
+        self.readiness = _Readiness(readiness, wait)
+        self.profile_cache = profile_cache
+        self.metrics = metrics
+        self.result_cache = result_cache
+        self.max_channels = max_channels
+        self.ssh_options = ssh_options or {}
+        self.host_keys = host_keys
+
+        # The device and port they asked to connect to.
+        self.device = None
+        self.port = None
+        # Our output after running a command.
+        self.output = None
+        self.output_raw = None
+        # The last thing that matched during an expect.
+        self.last_match = None
+        # The last prompt we found, and a boolean for whether or not the prompt changed after the last command send.
+        self.prompt = None
+        self.prompt_changed = False
+        # The prefix of the prompt that we try to consistently match. Let's see if this works.
+        self.prompt_prefix = None
+        # A list of keywords used to identify this device. Discovered via things like "show ver".
+        # This might be something like ['Cisco', 'IOS', 'C3750'] or ['Cisco', 'NX-OS', 'Nexus', '5000']
+        self.identifiers = []
+        # What we know about this device, like {'vendor': 'Cisco', 'os': 'IOS',
+        # 'model': 'WS-C3750G-24TS-1U', 'version': '12.2(55)SE10'}.
+        self.facts = {}
+        # If an enable succeeds, we set this to True.
+        self.enabled = False
+        # If we decide this device is safe to change, we set this to True.
+        # If we decide this device is NOT safe to change, we set this to False.
+        self.changeable = None
+        # Output we read while waiting for a command echo, which belongs at
+        # the front of that command's output.
+        self.pending_output = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        # How many times we had to type our unique string for the last command.
+        self.unique_strings_sent = 0
+        # The output of each command from the last send_batch().
+        self.outputs = []
+        # The prep commands that worked on this device.
+        self.prepare_commands = []
+        # The driver for this kind of device, once we know what it is, and
+        # whether paging might still be on.
+        self.driver = GENERIC_DRIVER
+        self.paging = True
+        # The output of the command that identified the device.
+        self.identify_output = None
+        self.identify_command = None
+        self._identify_output_raw = None
+        # If we have metrics turned on, the seconds we've spent in each phase,
+        # and the timing of the last command.
+        self.timings = {}
+        self.command_timing = None
+        self._command_started = None
+        # The extra shells we've opened on this SSH connection with
+        # open_channel(), and the ones send_parallel() can use again. If this
+        # is one of those shells, "parent" is the session that opened it.
+        self.channels = []
+        self.parent = None
+        self._idle_channels = []
+        # The password that worked for enable(), so extra shells can enable too.
+        self._enable_password = None
+        # The SessionRecorder, if we're recording.
+        self.recorder = None
+
+    def _phase(self, phase, started):
+        """Record the time since "started" for a phase, if we're keeping track."""
+
+        if self.metrics is not None:
+            self._record_phase(phase, time.time() - started)
+
+    def _record_phase(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+        self.metrics.phase(self, phase, seconds)
+
+    def _start_command(self, command):
+        """Start timing a command."""
+
+        self._command_started = time.time()
+        self.command_timing = {'command': command, 'bytes': 0, 'reads': 0, 'ttfb': None, 'wait': 0.0,
+                               'expect': None, 'seconds': None}
+
+    def _count_read(self, size):
+        """Count a read toward the command we're timing."""
+
+        timing = self.command_timing
+        if timing is None or timing['seconds'] is not None:
+            return
+        timing['bytes'] += size
+        timing['reads'] += 1
+        if timing['ttfb'] is None:
+            timing['ttfb'] = time.time() - self._command_started
+
+    def _finish_command(self):
+        """We're back at the prompt, so the command we were timing is done."""
+
+        timing = self.command_timing
+        if timing is None or timing['seconds'] is not None:
+            return
+        timing['seconds'] = time.time() - self._command_started
+        timing['expect'] = timing['seconds'] - timing['wait']
+        for phase in ('wait', 'expect'):
+            self._record_phase(phase, timing[phase])
+        self.metrics.command(self, timing)
+
+    def _clean_output(self, data):
+        """Decode what we read and clean it up the same way paramiko-expect
+        does: lose the carriage returns and strip out terminal escape codes."""
+
+        if self.metrics is not None:
+            self._count_read(len(data))
+        text = ANSI_ESCAPE_REGEX.sub('', self.decoder.decode(data).replace('\r', ''))
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        return text
+
+    def _matched(self, regexes, matcher, chunks):
+        """Set the output variables once _expect() has read up to a match,
+        and return the index of the regex that matched."""
+
+        # The clean output is everything except the line we matched.
+        self.output_raw = ''.join(chunks)
+        self.output = self.output_raw[:len(self.output_raw) - len(matcher.line)]
+        self.last_match = regexes[matcher.index]
+        return matcher.index
+
+    def _send_unique_string(self):
+        """Type our unique string at the end of the output. Returns the retry
+        function that _expect() should use, if there is one."""
+
+        self._write(UNIQUE_STRING)
+        self.unique_strings_sent = 1
+
+        # If we're being careful about IOS-XE eating our keystrokes, be
+        # ready to type the unique string again if it goes missing.
+        if self.readiness.needs_echo(self.identifiers):
+            return self._retype_unique_string
+        return None
+
+    def _finish_unique_string(self, retry, output):
+        """Clean up after the unique string trick, once we've found it at the
+        end of the output."""
+
+        if retry is not None and self.unique_strings_sent == 1:
+            self.readiness.delivered()
+
+        # Backspace over the dirty trick.
+        self._write(self.backspace * len(UNIQUE_STRING) * self.unique_strings_sent)
+
+        # We now need to set the "prompt" variable in case the prompt changed.
+        # See what's now at the end.
+        prompt = _prompt_from_output(output)
+        self.prompt_changed = prompt != self.prompt
+        self.prompt = prompt
+
+        # Try to get the prompt prefix if we haven't already.
+        if self.prompt_prefix is None:
+            self.prompt_prefix = _prompt_prefix_from_prompt(self.prompt)
+
+        if self.metrics is not None:
+            self._finish_command()
+
+    def _retype_unique_string(self):
+        """The device ate our unique string, so type it again and wait a
+        bit longer after commands from now on."""
+
+        self.readiness.dropped()
+        self._write(UNIQUE_STRING)
+        self.unique_strings_sent += 1
+
+    def _setup_steps(self):
+        """Get a session ready once we're sitting at its first prompt:
+        figure out what the device is and prep it, or do the prep that
+        worked last time."""
+
+        # If we've been here before, just do the prep that worked last time.
+        started = time.time()
+        if (yield from self._prepare_from_profile_steps()):
+            self._phase('prepare', started)
+        else:
+            # Turn off paging if we can, then identify the device we're on,
+            # so we know which driver to use.
+            yield from self._pager_off_steps()
+            yield from self._identify_steps()
+            self._phase('identify', started)
+
+            # Prep the session (term len 0, etc).
+            started = time.time()
+            yield from self._prepare_steps()
+            self._phase('prepare', started)
+
+            # Remember all that for next time.
+            self._save_profile()
+            self._cache_identify_output()
+
+        # If we auto-enabled, we can set that bit now, and do whatever the
+        # driver wants done once we're enabled.
+        if self.driver.looks_enabled(self.prompt):
+            self.enabled = True
+            yield from self._prepare_enabled_steps()
+
+        return True
+
+    def _prepare_steps(self):
+        """Prepare the session by doing "terminal length 0" and any other
+        such things that might be necessary. The driver tells us what to
+        send. If we don't know what kind of device this is, we guess."""
+
+        commands = self.driver.prepare_commands(self.identify_output)
+        if commands is None:
+            return (yield from self._guess_prepare_steps())
+
+        # _pager_off_steps() might have turned paging off already, so we can
+        # skip that one. Everything else gets sent in order, even a command
+        # we've sent before, like the second "end" on a FortiGate with vdoms.
+        skip = PAGER_OFF_COMMAND in self.prepare_commands
+        for command in commands:
+            if skip and command == PAGER_OFF_COMMAND:
+                skip = False
+                continue
+            yield from self._prep_steps(command)
+        return True
+
+    def _pager_off_steps(self):
+        """Before we know what we're talking to, try the command that turns
+        off paging on most devices. If it works, _prepare_steps() doesn't
+        send it again."""
+
+        self.prepare_commands = []
+        if _pager_off_first(self._server_version()):
+            yield from self._prep_steps(PAGER_OFF_COMMAND)
+
+    def _prepare_enabled_steps(self):
+        """Run the driver's commands for once we're enabled. These don't go
+        in prepare_commands, because we might not be enabled next time."""
+
+        for command in self.driver.enable_commands:
+            yield _do('send', command)
+            if command in self.driver.pager_off_commands:
+                self.paging = False
+
+    def _guess_prepare_steps(self):
+        """Prep a session on a device we couldn't identify, by trying the
+        usual commands and seeing what works."""
+
+        # The very first thing we need to do is turn off paging, if
+        # _pager_off_steps() didn't already.
+        if PAGER_OFF_COMMAND in self.prepare_commands:
+            result = True
+        else:
+            result = yield from self._prep_steps(PAGER_OFF_COMMAND)
+        # If that worked, send IOS commands to disable monitor and editing.
+        if result is not None:
+            yield from self._prep_steps('terminal no monitor')
+            yield from self._prep_steps('terminal no editing')
+            return True
+
+        # The usual IOS commands didn't work, so let's try the FortiOS ones.
+        # I don't feel comfortable trying these things unless we're relatively
+        # sure we're on FortiOS, so let's look for the Fortinet error format in
+        # the output of our last command.
+        if "Command fail. Return code" in self.output:
+            # There are two ways to do this. If we have vdoms, we need to
+            # "config global" first, and "end" once more at the end.
+            result = yield from self._prep_steps('config global')
+            yield from self._prep_steps('config system console')
+            yield from self._prep_steps('set output standard')
+            yield from self._prep_steps('end')
+            if result is not None:
+                yield from self._prep_steps('end')
+
+        # None of our prep worked. This may not be catastrophic, so let's return False.
+        return False
+
+    def _prep_steps(self, command, graceful=True):
+        """Send a prep command, and remember it if it worked."""
+
+        result = yield _do('send', command, graceful=graceful)
+        if result is not None:
+            self.prepare_commands.append(command)
+            if command in self.driver.pager_off_commands:
+                self.paging = False
+        return result
+
+    def _prepare_from_profile_steps(self):
+        """If the profile cache knows this device, send the prep commands
+        that worked last time and take its word for what the device is.
+        Returns False if we have to do it the long way."""
+
+        if self.profile_cache is None:
+            return False
+        profile = self.profile_cache.get(self.device, self.port, self._host_key_fingerprint())
+        if profile is None or not self.profile_cache.usable(profile, self.prompt_prefix):
+            return False
+
+        # We need to know the identifiers before we start, so that we know
+        # whether to be careful about IOS-XE.
+        self.identifiers = list(profile['identifiers'])
+        self.facts = dict(profile.get('facts', {}))
+        self.driver = find_driver(self.identifiers)
+        self.prepare_commands = []
+        for command in profile['prepare']:
+            if (yield from self._prep_steps(command)) is None:
+                # Something's changed. Start over.
+                self.identifiers = []
+                self.facts = {}
+                self.driver = GENERIC_DRIVER
+                self.paging = True
+                self.profile_cache.invalidate(self.device, self.port)
+                return False
+
+        return True
+
+    def _save_profile(self):
+        """Save what we learned about this device in the profile cache. If
+        we couldn't figure out what it is, there's nothing worth saving."""
+
+        if self.profile_cache is None or not self.identifiers:
+            return
+        self.profile_cache.put(self.device, self.port, self._host_key_fingerprint(),
+                               self.identifiers, self.prompt_prefix, self.prepare_commands, self.facts)
+
+    def _identify_steps(self):
+        """Run various commands to identify the device we're on, and pick
+        the driver for it."""
+
+        # Run a slew of commands and search through the output of the one (or
+        # ones) that worked. Right now, we break after one successful command
+        # run. If the SSH server told us what it is, we start with the
+        # command that's most likely to work.
+        output = None
+
+        for command in _identification_commands(self._server_version()):
+            # "graceful" just means "Don't raise an exception because this
+            # command might fail and I don't care if it does."
+            result = yield _do('send', command, graceful=True)
+            if result is not None:
+                output = self.output
+                self.identify_command = command
+                self._identify_output_raw = self.output_raw
+                break
+
+        if output is not None:
+            _identify_output(output, self.identifiers, self.facts)
+
+        self.identify_output = output
+        self.driver = find_driver(self.identifiers)
+        return True
+
+    def _channel_limit(self, max_channels=None):
+        """How many shells we can have open on this connection."""
+        return max_channels or self.max_channels or self.driver.max_channels
+
+    def _adopt_steps(self, parent):
+        """Prep an extra shell with what its parent already knows about the
+        device, once the shell is sitting at its first prompt."""
+
+        started = time.time()
+        self.identifiers = list(parent.identifiers)
+        self.facts = dict(parent.facts)
+        self.driver = parent.driver
+        self.identify_output = parent.identify_output
+        self.identify_command = parent.identify_command
+        self._identify_output_raw = parent._identify_output_raw
+        for command in parent.prepare_commands:
+            yield from self._prep_steps(command)
+        self._phase('prepare', started)
+
+        if self.driver.looks_enabled(self.prompt):
+            self.enabled = True
+            yield from self._prepare_enabled_steps()
+        elif parent.enabled and parent._enable_password is not None:
+            yield _do('enable', parent._enable_password)
+
+    def _send_steps(self, command, graceful=False, spool=None, cache=True):
+        """Run a command. See CLIWrangler.send()."""
+
+        # If we just did this, don't bother the device again.
+        if spool is None and cache and self.result_cache is not None:
+            output = self._cached_result(command)
+            if output is not None:
+                return output
+
+        # Send the command.
+        yield from self._send_command_steps(command)
+
+        # Expect the end of the output of the send command.
+        if spool is None:
+            yield _do('_expect_output')
+            # If paging is still on, take the pager prompts out.
+            if self.paging:
+                self.output = self.driver.strip_pager(self.output)
+        else:
+            yield _do('_expect_output', spool=SpooledOutput(spool))
+            self._update_result_cache(command, None)
+            error = self.output.find_error(self.driver.error_patterns)
+            if error is not None:
+                if graceful:
+                    return None
+                raise Exception("Found error string in %s! \n%s" % (self.output.path, error))
+            return self.output
+
+        # If something looked like an error, print it and maybe raise an exception.
+        error = self.driver.find_error(self.output)
+        self._update_result_cache(command, None if error else self.output)
+        if error:
+            # If they don't want exceptions, don't raise an exception.
+            # The reason why I offer the choice is because some Python
+            # programmers do everything by exception handling, and others
+            # hate it.
+            if graceful:
+                # We return None if there was an error and the user didn't
+                # want exceptions to be raised. If the user wants to check
+                # for a specific error, it will be in self.output.
+                return None
+            else:
+                raise Exception("Found error string! \n%s" % (self.output))
+
+        # Return the output.
+        return self.output
+
+    def _cached_result(self, command):
+        """If the result cache has a fresh result for this command, make it
+        look like we just ran it, and return the output. Otherwise None."""
+
+        cached = self.result_cache.get(self.device, self.port, self.prompt, command)
+        if cached is None:
+            return None
+        self.output, self.output_raw = cached
+        self.prompt_changed = False
+        return self.output
+
+    def _update_result_cache(self, command, output):
+        """After running a command, remember its output (if it worked, and
+        is something we're allowed to cache), or forget what we knew about
+        this device if the command might have changed something."""
+
+        if self.result_cache is None:
+            return
+        # An empty command just gets us a prompt, and can't change anything.
+        if self.prompt_changed or (command.strip() and not self.result_cache.cacheable(command)):
+            self._forget_results()
+        elif output is not None and command.strip():
+            self.result_cache.put(self.device, self.port, self.prompt, command, output, self.output_raw)
+
+    def _forget_results(self):
+        """Throw out everything the result cache knows about this device."""
+
+        if self.result_cache is not None:
+            self.result_cache.invalidate(self.device, self.port)
+
+    def _cache_identify_output(self):
+        """The prep after _identify_steps() made us forget its output, but
+        the prep didn't change what it says, so put it back in the result
+        cache. That way, check_ha_status() on a FortiGate doesn't have to
+        run "get system status" again."""
+
+        if (self.result_cache is not None and self.identify_output is not None
+                and self.result_cache.cacheable(self.identify_command)):
+            self.result_cache.put(self.device, self.port, self.prompt, self.identify_command,
+                                  self.identify_output, self._identify_output_raw)
+
+    def _send_command_steps(self, command):
+        """Type a command and hit return, then get ready to expect its output."""
+
+        if self.metrics is not None:
+            self._start_command(command)
+
+        self._write_line(command)
+
+        # Unfortunately, on IOS-XE, there's a short period of time after a
+        # command is sent where if you send characters, they get thrown out.
+        # This should be considered a bug, but I doubt Cisco's going to fix it.
+        # Because of this IOS-XE bug, we need to wait after sending a command.
+        yield from self._wait_until_ready_steps(command)
+
+        # On the off chance that we couldn't disable paging, hit space bar a
+        # few times. This is pretty sad, but necessary for things like the
+        # ASAs, which don't let you disable paging until you've enabled.
+        if self.paging:
+            self._write('     ')
+
+    def _send_batch_steps(self, commands, graceful=False, batch_size=None):
+        """Run a bunch of commands, typing them all at once. See
+        CLIWrangler.send_batch()."""
+
+        commands = list(commands)
+
+        if self.paging or "IOS-XE" in self.identifiers:
+            results = []
+            for command in commands:
+                results.append((yield _do('send', command, graceful=graceful)))
+            self.outputs = results
+            return results
+
+        batch_size = batch_size or len(commands) or 1
+        outputs = []
+        combined = []
+        combined_raw = []
+        for start in range(0, len(commands), batch_size):
+            batch = commands[start:start + batch_size]
+
+            # Type everything, with an empty line between each command.
+            if self.metrics is not None:
+                self._start_command('\n'.join(batch))
+            self._write((self.newline * 2).join(batch) + self.newline)
+            yield from self._wait_until_ready_steps(batch[-1])
+            yield _do('_expect_output')
+
+            outputs.extend(_split_batch_output(self.output, batch, self.prompt_prefix))
+            combined.append(self.output)
+            combined_raw.append(self.output_raw)
+
+        self.output = ''.join(combined)
+        self.output_raw = ''.join(combined_raw)
+        self.outputs = outputs
+        for command in commands:
+            self._update_result_cache(command, None)
+
+        return _batch_results(commands, outputs, graceful, self.driver)
+
+    def _wait_until_ready_steps(self, command):
+        """Wait until it's safe to type after sending a command. How we
+        decide that depends on the readiness mode; see _Readiness."""
+
+        started = time.time()
+
+        echoed = False
+        if self.readiness.needs_echo(self.identifiers):
+            echo_started = time.time()
+            echoed = yield _do('_wait_for_echo', _echo_target(command), self.wait)
+            if echoed:
+                self.readiness.observe(time.time() - echo_started)
+
+        settle = self.readiness.settle_time(echoed)
+        if settle > 0:
+            yield _do('_sleep', settle)
+
+        if self.metrics is not None and self.command_timing is not None:
+            self.command_timing['wait'] += time.time() - started
+
+    def _enable_steps(self, enable_password):
+        """Enable, dealing with the password prompt that comes up."""
+
+        self._write_line('enable')
+        yield _do('_expect', [re.escape(self.prompt), r'.*ssword:\s*'])
+
+        # Type the password at the password prompt, but don't write it down
+        # if we're recording.
+        if re.search('ssword:', self.last_match, flags=re.IGNORECASE):
+            if self.recorder is not None:
+                self.recorder.secrets.add(enable_password.encode('utf-8'))
+            yield _do('send', enable_password)
+        else:
+            raise Exception("Didn't get something that looked like a password prompt when trying to enable!")
+
+        # Make sure we enabled.
+        if self.driver.looks_enabled(self.prompt):
+            self.enabled = True
+            self._enable_password = enable_password
+
+            # Some things, like turning off paging on an ASA, can't be done
+            # until we've enabled.
+            yield from self._prepare_enabled_steps()
+
+        return self.enabled
+
+    def _check_ha_status_steps(self):
+        """Figure out whether we should make config changes on this device.
+        See CLIWrangler.check_ha_status()."""
+
+        # The driver knows what to look for. Cisco ASAs and FWSMs need to be
+        # checked to make sure they're standalone or currently active.
+        output = None
+        if self.driver.ha_command is not None:
+            # Has to be graceful because on an ASA, this command requires
+            # the failover license.
+            yield _do('send', self.driver.ha_command, graceful=True)
+            output = self.output
+
+        # For anything the driver isn't qualified to say with certainty
+        # about, we leave it alone. The default value is None.
+        status = self.driver.ha_status(output)
+        if status is not None:
+            self.changeable = status
+        return self.changeable
+
+    def _running_config_steps(self):
+        """Fetch the running config and parse it into a ConfigTree."""
+
+        command = self.driver.running_config_command
+        if command is None:
+            raise Exception("Don't know how to get the running config on %s devices yet!" % (self.driver.name))
+        # The first line is the command echo. Another session might have
+        # changed the config since the result cache saw it, so ask the device.
+        output = yield _do('send', command, cache=False)
+        return ConfigTree(output.split('\n')[1:])
+
+    def _diff_config_steps(self, config):
+        """Compare some config lines to the running config. See
+        CLIWrangler.diff_config()."""
+
+        running = yield from self._running_config_steps()
+        return _diff_config(ConfigTree(config), running, self.driver.config_exit)
+
+    def _apply_config_steps(self, config, diff=False, upload=None):
+        """Apply some config lines to the config. See CLIWrangler.apply_config()."""
+
+        # Make sure we're enabled.
+        if not self.enabled:
+            raise Exception("Called apply_config() without being enabled")
+
+        # If it seems like we were passed a string, split it into a list.
+        config = _config_lines(config)
+
+        if upload is None:
+            self.driver.check_apply_config()
+        else:
+            self.driver.check_push_config()
+
+        if diff:
+            changes = yield from self._diff_config_steps(config)
+            if changes.commands:
+                if upload is not None:
+                    yield from self._push_config_steps(changes.commands, upload)
+                else:
+                    yield _do('send', self.driver.config_command)
+                    for line in changes.commands:
+                        yield _do('send', line)
+                    # We could be a few sections deep, so get all the way out.
+                    yield _do('send', self.driver.end_command)
+                changes.sent = True
+                self._forget_results()
+            return changes
+
+        if upload is not None:
+            output = yield from self._push_config_steps(config, upload)
+            self._forget_results()
+            return output
+
+        # Apply the config by entering config mode, writing lines, then
+        # leaving config mode.
+        yield _do('send', self.driver.config_command)
+        # Send each line one at a time.
+        for line in config:
+            yield _do('send', line)
+        yield _do('send', self.driver.config_exit)
+
+        # Whatever "show" said before, it might not say it now.
+        self._forget_results()
+
+    def _push_config_steps(self, config, method):
+        """Upload some config as a file, merge it into the running config,
+        and clean up after ourselves. Returns what the merge printed."""
+
+        path = self.driver.push_path()
+        yield _do('upload', '\n'.join(config) + '\n', path, method)
+        try:
+            # The merge command might ask us where to copy to, and the
+            # answer is already in the question.
+            self._write_line(self.driver.merge_command % {'path': path})
+            if (yield _do('_expect', [_prompt_regex(self.prompt_prefix), self.driver.merge_question])) == 1:
+                yield _do('send', '', graceful=True)
+            output = self.output
+        finally:
+            if self.driver.delete_command is not None:
+                yield _do('send', self.driver.delete_command % {'path': path}, graceful=True)
+
+        error = self.driver.find_error(output)
+        if error is not None:
+            raise Exception("Found error string while merging %s! \n%s" % (path, output))
+        return output
+
+    def _write_config_steps(self):
+        """Write mem or copy run start or whatever.
+        Depending on the device type, this could be quite different."""
+
+        # Make sure we're enabled.
+        if not self.enabled:
+            raise Exception("Called write_config() without being enabled")
+
+        command = self.driver.write_config_command()
+        if command is not None:
+            yield _do('send', command)
+        self._forget_results()
+
+        return True
+
+
+class CLIWrangler(_SessionProtocol):
     """This class provides a clean interface to a Cisco IOS CLI ssh session. 
     To deal with the SSH and expect-type functionality, we use Paramiko and
     Paramiko-expect."""
 
-    def __init__(self, timeout=60, newline='\r', backspace='\b', buffer_size=1024, wait=0.2, echo=False, debug=False):    
-        """The constructor for the CLIWrangler class.
+    def __init__(self, timeout=60, newline='\r', backspace='\b', buffer_size=1024, wait=0.2, echo=False, debug=False,
+                 readiness='sleep', profile_cache=None, metrics=None, result_cache=None, max_channels=None,
+                 ssh_options=None, host_keys=None, record=None, replay=None, replay_speed=1.0, scheduler=None):
+        """The constructor for the CLIWrangler class.
+
+        Arguments:
+        timeout - Connection timeout in seconds.
+        newline - The newline character if '\r' doesn't work.
+        backspace - The backspace character if '\b' doesn't work.
+        buffer_size - The buffer size.
+        wait - The number of seconds to wait after every command sent, thanks to IOS-XE.
+        echo - Should we echo the session to the screen? (For verbosity purposes.)
+        debug - Should we provide ssh debug information on the screen as well?
+        readiness - How to decide when the device is ready for more input
+                    after a command: 'sleep' (always sleep for "wait"),
+                    'adaptive' (watch for the command echo and learn a delay
+                    for this device, only where it's needed) or 'none'.
+        profile_cache - A ProfileCache, if you want to remember what we
+                        learn about each device and skip most of connect()
+                        next time.
+        metrics - A Metrics object, if you want to know where the time goes.
+        result_cache - A ResultCache, if you want to reuse the output of
+                       "show" commands we ran recently instead of running
+                       them again.
+        max_channels - The most shells to have open at once on this SSH
+                       connection, counting the first one, if you know
+                       better than the driver. See open_channel().
+        ssh_options - A dict for tuning the SSH connection. 'ciphers', 'kex',
+                      'macs' and 'host_key_types' are lists of algorithms to
+                      prefer, which helps with devices whose CPUs are slow
+                      at some of them. 'nodelay' (True by default) turns off
+                      Nagle's algorithm, so our little keystrokes don't sit
+                      around waiting. 'window_size' and 'max_packet_size'
+                      are for the shell's SSH channel, and 'compress' turns
+                      on compression, which can help with big outputs on
+                      slow links. Anything else is passed to paramiko's
+                      SSHClient.connect().
+        host_keys - The HostKeyStore to check host keys against. By
+                    default, every session shares the one from
+                    host_key_store().
+        record - A file to record the session to, so it can be replayed
+                 later; see SessionRecorder. "%(device)s" and "%(port)s"
+                 in the name are filled in when we connect.
+        replay - A Recording (or a recording file) to play back instead of
+                 connecting to the device; see ReplayClient.
+        replay_speed - How fast to play it back: 1.0 for as fast as it
+                       happened, 10.0 for ten times faster, or None for as
+                       fast as we can go.
+        scheduler - A ConnectionScheduler, shared with other sessions, to
+                    decide when connect() gets to log in.
+        """
+
+        _SessionProtocol.__init__(self, timeout, newline, backspace, buffer_size, wait, echo, readiness,
+                                  profile_cache, metrics, result_cache, max_channels, ssh_options, host_keys)
+
+        # Arguments only we take
+        self.debug = debug
+        self.record = record
+        self.replay = replay
+        self.replay_speed = replay_speed
+        self.scheduler = scheduler
+        # Whether connect() is still logging in, as opposed to talking to a
+        # shell the device already gave us. See _login_failure().
+        self._logging_in = False
+
+        # send_parallel() opens and hands out extra shells from several threads.
+        self._channel_lock = threading.Lock()
+
+        # Initialize Paramiko and Paramiko-expect objects.
+        self.client = self._new_client()
+        # paramikoe.SSHClientInteraction() can't be initialized until after we
+        # connect, so this variable gets set during connect.
+        self.interact = None
+
+    def _new_client(self):
+        """A paramiko SSHClient, or if we're playing a recording back, the
+        ReplayClient that stands in for one."""
+
+        if self.replay is None:
+            return paramiko.SSHClient()
+        return ReplayClient(self.replay, self.replay_speed)
+
+    def _reset_connection(self):
+        """Forget everything connect() learned and get a new SSH client, so
+        that we can try connecting again."""
+
+        self.client = self._new_client()
+        self.interact = None
+        self.recorder = None
+        self.prompt = None
+        self.prompt_changed = False
+        self.prompt_prefix = None
+        self.identifiers = []
+        self.facts = {}
+        self.enabled = False
+        self.pending_output = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        self.prepare_commands = []
+        self.driver = GENERIC_DRIVER
+        self.paging = True
+        self.identify_output = None
+        self.identify_command = None
+        self._identify_output_raw = None
+
+    def __del__(self):
+        """The destructor for our CLIWrangler class."""
+        self.close()
+
+    def close(self):
+        """Attempts to close the paramiko-expect session and the SSH client
+        for clean completion. If this is an extra shell from open_channel(),
+        we only close the shell, and leave the connection to its parent."""
+        for channel in list(self.channels):
+            channel.close()
+        try:
+            # Close the paramiko-expect session.
+            self.interact.channel.close()
+        except:
+            pass
+        if self.parent is not None:
+            return
+        try:
+            # Close the SSH client too, otherwise the transport (and its
+            # thread) hangs around until the garbage collector finds it.
+            self.client.close()
+        except:
+            pass
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.scheduler is not None:
+            self.scheduler.release(self)
+
+    def connect(self, device, username, password, port=22, priority=0):
+        """Connect to the given device using our Paramiko client.
+
+        Arguments:
+        device - The device to connect.
+        username - The username to use.
+        password - The password to use.
+        port - The SSH port, if it isn't 22.
+        priority - If we have a scheduler, how urgent this is. Higher
+                   priorities get to log in first.
+        """
+
+        if self.scheduler is not None:
+            return self.scheduler.connect(self, device, username, password, port, priority)
+        return self._connect(device, username, password, port)
+
+    def _connect(self, device, username, password, port):
+        """Connect, log in and get the session ready. See connect()."""
+
+        self.device = device
+        self.port = port
+
+        # Check host keys against the shared store, which has already read
+        # known_hosts, and auto accept unknown hosts.
+        if self.host_keys is None:
+            self.host_keys = host_key_store()
+        self.client.set_missing_host_key_policy(_HostKeyPolicy(self.host_keys))
+
+        if self.record is not None:
+            self.recorder = SessionRecorder(self.record % {'device': device, 'port': port})
+            self.recorder.start(device, port, username)
+
+        # Connect to the host, or pretend to. Until we've got a shell, if
+        # this goes wrong, it might be because the device is too busy.
+        self._logging_in = True
+        if self.replay is None:
+            self._connect_client(device, port, username, password)
+        else:
+            started = time.time()
+            self.client.connect(hostname=device, port=port, username=username, password=password)
+            self._phase('handshake', started)
+        if self.recorder is not None:
+            self.recorder.connected(self.client.get_transport())
+
+        started = time.time()
+        # Now we can initialize our interaction object.
+        self._invoke_shell()
+        self._logging_in = False
+
+        # Hit a carriage return to make sure we can sense the prompt.
+        # This isn't necessary on Cisco IOS, but it's necessary on FortiOS.
+        self.interact.send(self.newline)
+
+        # Expect before continuing, to clear the buffer and set the prompt.
+        self._expect_output()
+        self._phase('shell', started)
+
+        return self._run(self._setup_steps())
+
+    def _invoke_shell(self):
+        """Open a shell on our SSH connection, and get paramiko-expect
+        going on it. If we're recording, the recorder gets to see everything
+        that goes through the shell."""
+
+        requested = time.time()
+        self.interact = paramikoe.SSHClientInteraction(self.client, timeout=self.timeout, display=self.echo)
+        if self.recorder is not None:
+            self.interact.channel = self.recorder.channel(self.interact.channel, requested)
+
+    def _connect_client(self, device, port, username, password):
+        """Connect the SSH client, tuned the way ssh_options says. We do the
+        TCP connection ourselves and use our own Transport, so that we can
+        set TCP_NODELAY and reorder the algorithms, and time the TCP
+        connection, the SSH handshake and the login separately."""
+
+        options = dict(self.ssh_options)
+        nodelay = options.pop('nodelay', True)
+        window_size = options.pop('window_size', None)
+        max_packet_size = options.pop('max_packet_size', None)
+        preferences = {}
+        for name in PREFERENCE_OPTIONS:
+            if options.get(name):
+                preferences[name] = list(options.pop(name))
+            else:
+                options.pop(name, None)
+
+        started = time.time()
+        sock = socket.create_connection((device, port), self.timeout)
+        if nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._phase('tcp', started)
+
+        if _TRANSPORT_FACTORY:
+            options['transport_factory'] = functools.partial(_TimedTransport, preferences=preferences)
+        elif preferences:
+            raise Exception("Preferring some SSH algorithms over others needs paramiko 2.12 or later")
+
+        # "allow_agent=False" and "look_for_keys=False" are necessary to log into some IOS devices.
+        started = time.time()
+        self.client.connect(hostname=device, port=port, username=username, password=password, allow_agent=False,
+                            look_for_keys=False, sock=sock, **options)
+        elapsed = time.time() - started
+
+        # The channel sizes only matter for channels we haven't opened yet,
+        # which is all of them.
+        transport = self.client.get_transport()
+        if window_size is not None:
+            transport.default_window_size = window_size
+        if max_packet_size is not None:
+            transport.default_max_packet_size = max_packet_size
+
+        if self.metrics is None:
+            return
+
+        # If we couldn't use our own Transport, the login is lumped in with
+        # the handshake.
+        handshake = getattr(transport, 'handshake_seconds', None)
+        if handshake is None:
+            self._record_phase('handshake', elapsed)
+        else:
+            self._record_phase('handshake', handshake)
+            self._record_phase('auth', elapsed - handshake)
+
+    def _run(self, steps):
+        """Carry out one of _SessionProtocol's conversations with the device.
+        Every time it asks for one of our methods, we call it, and hand back
+        what it returned, or the exception it raised. Returns whatever the
+        conversation returns."""
+
+        result = None
+        error = None
+        while True:
+            try:
+                if error is None:
+                    method, args, kwargs = steps.send(result)
+                else:
+                    method, args, kwargs = steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                result = getattr(self, method)(*args, **kwargs)
+                error = None
+            except Exception as e:
+                error = e
+
+    def _write(self, data):
+        """Type a string into the shell, as is."""
+        self.interact.channel.send(data)
+
+    def _write_line(self, line):
+        """Type a line and hit return. paramiko-expect hits return for us."""
+        self.interact.send(line)
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _server_version(self):
+        """The SSH server's version string, like "SSH-2.0-Cisco-1.25"."""
+        return self.client.get_transport().remote_version
+
+    def _expect_output(self, spool=None):
+        """Expect our entire output. This is meant to be used during a "send"
+        method call, or after any manual send. There are some dirty tricks in here.
+
+        If "spool" is a SpooledOutput, the output goes into it instead of
+        into a string, and self.output is set to it."""
+
+        # The first thing we do is type a string that we don't expect to get
+        # from any command output. This puts us in a known state. Otherwise, if
+        # we try to just match on the prompt, we won't know whether we're
+        # matching the last prompt available, or something before we ran the
+        # last command.
+
+        retry = self._send_unique_string()
+
+        # Expect the unique string we just sent, with the prompt prefix at the
+        # beginning of the line if we have one. This sets the output variables.
+        if spool is None:
+            self._expect(_expect_regexes(self.prompt_prefix), retry=retry, suffix=UNIQUE_STRING)
+            self._finish_unique_string(retry, self.output_raw)
+            return True
+
+        # Same thing, except that the output goes straight to the file.
+        matcher = _PromptMatcher(_expect_regexes(self.prompt_prefix), UNIQUE_STRING)
+        try:
+            for text in self._read_until(matcher, retry):
+                spool.write(text)
+            spool.finish(matcher.line)
+        except:
+            spool.close()
+            raise
+        self._finish_unique_string(retry, matcher.line)
+        self.output = spool
+        self.output_raw = None
+
+        # Let's return True. I have no idea what would be useful here yet.
+        return True
+
+    def _read(self):
+        """Read and clean up whatever output is available on the channel,
+        waiting up to our timeout for some to show up."""
+
+        data = self.interact.channel.recv(self.buffer_size)
+        if not data:
+            raise Exception("The connection to %s closed while we were waiting for output" % (self.device))
+        return self._clean_output(data)
+
+    def _expect(self, regexes, retry=None, suffix=None):
+        """Read output until the last line matches one of the regexes, and
+        set the output variables. This is what paramiko-expect's expect()
+        does, except that we start with anything we read while we were
+        waiting for a command echo. Otherwise that could include the prompt,
+        and we'd never find it. Returns the index of the regex that matched.
+
+        If "retry" is given, it gets called whenever we find ourselves
+        sitting at a bare prompt with nothing else coming in. If "suffix" is
+        given, the last line has to end with it to count; see _PromptMatcher."""
+
+        matcher = _PromptMatcher(regexes, suffix)
+        chunks = list(self._read_until(matcher, retry))
+        return self._matched(regexes, matcher, chunks)
+
+    def _read_until(self, matcher, retry=None):
+        """A generator that reads output and yields it a chunk at a time,
+        until the matcher matches. See _expect()."""
+
+        bare_prompt = _prompt_regex(self.prompt_prefix)
+        channel = self.interact.channel
+
+        # Anything we read while waiting for a command echo goes first.
+        if self.pending_output:
+            matcher.feed(self.pending_output)
+            yield self.pending_output
+            self.pending_output = ''
+
+        # If nothing shows up for this long, recv() raises socket.timeout.
+        channel.settimeout(self.timeout)
+
+        # Only the last line can be the prompt, so that's all we look at.
+        while matcher.match() is None:
+            if retry is not None and matcher.line_matches(bare_prompt):
+                if not _wait_readable(channel, self.readiness.probe_timeout()):
+                    retry()
+                    continue
+
+            text = self._read()
+            matcher.feed(text)
+            yield text
+
+    def _host_key_fingerprint(self):
+        """The fingerprint of the host key the device gave us."""
+        return _host_key_fingerprint(self.client.get_transport().get_remote_server_key().asbytes())
+
+    def _channel_open(self, channel):
+        """True if one of our extra shells is open, or still opening."""
+        return channel.interact is None or not channel.interact.channel.closed
+
+    def open_channel(self):
+        """Open another shell on this session's SSH connection, and return
+        it as a CLIWrangler of its own. There's no new handshake or login,
+        and we don't identify the device again: the new shell gets our
+        identifiers, driver and facts, and just runs the prep commands that
+        worked for us. It has its own prompt and output, so you can run a
+        long command on it in another thread while this one carries on.
+
+        If you enabled this session with enable(), we enable the new shell
+        with the same password.
+
+        We won't have more than max_channels shells open at once (counting
+        this one), and if the device turns us down, you get an exception.
+        Close the shell with close() when you're done with it. Closing this
+        session closes all of them."""
+
+        # Extra shells all belong to the session that owns the connection.
+        if self.parent is not None:
+            return self.parent.open_channel()
+
+        channel = CLIWrangler(timeout=self.timeout, newline=self.newline, backspace=self.backspace,
+                              buffer_size=self.buffer_size, wait=self.wait, echo=self.echo, debug=self.debug,
+                              metrics=self.metrics, result_cache=self.result_cache,
+                              max_channels=self.max_channels, ssh_options=self.ssh_options,
+                              host_keys=self.host_keys)
+
+        # Save the new shell a place before we go to the trouble of opening it.
+        with self._channel_lock:
+            self.channels = [other for other in self.channels if self._channel_open(other)]
+            self._idle_channels = [other for other in self._idle_channels if other in self.channels]
+            limit = self._channel_limit()
+            if len(self.channels) + 1 >= limit:
+                raise Exception("Can't open another shell on %s, we already have %d open" % (self.device, limit))
+            self.channels.append(channel)
+
+        try:
+            channel._open_shell(self)
+        except:
+            with self._channel_lock:
+                self.channels.remove(channel)
+            channel.close()
+            raise
+        return channel
+
+    def _open_shell(self, parent):
+        """Open a shell on the parent's SSH connection, and prep it with
+        what the parent already knows about the device."""
+
+        self.parent = parent
+        self.client = parent.client
+        self.device = parent.device
+        self.port = parent.port
+        self.replay = parent.replay
+        self.recorder = parent.recorder
+        # What the parent learned about waiting for IOS-XE goes for us too,
+        # but in our own copy, since we might be sending from another thread.
+        self.readiness = parent.readiness.copy()
+
+        started = time.time()
+        self._invoke_shell()
+        self.interact.send(self.newline)
+        self._expect_output()
+        self._phase('shell', started)
+
+        self._run(self._adopt_steps(parent))
+
+    def _spare_channel(self):
+        """An extra shell for send_parallel(): one it opened last time, or
+        a new one. None if we're out of shells, or the device won't give us
+        any more."""
+
+        with self._channel_lock:
+            while self._idle_channels:
+                channel = self._idle_channels.pop()
+                if self._channel_open(channel):
+                    return channel
+        try:
+            return self.open_channel()
+        except Exception:
+            return None
+
+    def send_parallel(self, commands, graceful=False, max_channels=None):
+        """Run a bunch of commands at the same time, spread across several
+        shells on this SSH connection. This is for things like a "show"
+        command per VRF, or counters for every interface, where each
+        command takes a while on the device's end.
+
+        We use this session's own shell plus extra ones from open_channel(),
+        each in its own thread, and each shell takes the next command as
+        soon as it's done with the last one. The extra shells stay open
+        afterwards, so the next send_parallel() doesn't have to open them
+        again. If the device won't give us as many shells as we asked for,
+        we make do with the ones we've got.
+
+        Returns a list with the output of each command, in the same order
+        as the commands, and checks each one for errors the way send_batch()
+        does. The outputs are also left in self.outputs.
+
+        Arguments:
+        commands - A list of commands.
+        graceful - Don't raise exceptions, return None for failed commands.
+        max_channels - Use at most this many shells at once, counting this
+                       one. It can't be more than the session's limit.
+        """
+
+        if self.parent is not None:
+            raise Exception("Call send_parallel() on the session that opened this shell")
+
+        commands = list(commands)
+        shells = max(1, min(self._channel_limit(max_channels), self._channel_limit(), len(commands)))
+        outputs = [None] * len(commands)
+        queue = collections.deque(enumerate(commands))
+        lock = threading.Lock()
+        failures = []
+
+        def work(shell):
+            while True:
+                with lock:
+                    if failures or not queue:
+                        return
+                    index, command = queue.popleft()
+                try:
+                    shell.send(command, graceful=True)
+                    outputs[index] = shell.output
+                except Exception as e:
+                    with lock:
+                        failures.append(e)
+                    # A broken extra shell is no good to anyone, but closing
+                    # our own shell would close the whole session, right out
+                    # from under the other shells.
+                    if shell is not self:
+                        shell.close()
+                    return
+
+        def work_elsewhere():
+            shell = self._spare_channel()
+            if shell is not None:
+                work(shell)
+            return shell
+
+        with futures.ThreadPoolExecutor(max_workers=max(1, shells - 1)) as executor:
+            extra = [executor.submit(work_elsewhere) for i in range(shells - 1)]
+            work(self)
+            for future in extra:
+                shell = future.result()
+                if shell is not None and self._channel_open(shell):
+                    with self._channel_lock:
+                        self._idle_channels.append(shell)
+
+        if failures:
+            raise failures[0]
+
+        self.outputs = outputs
+        return _batch_results(commands, outputs, graceful, self.driver)
+
+    def send(self, command, graceful=False, spool=None, cache=True):
+        """Run a command.
+
+        Here's what a "send" does:
+
+        1. Send the line.
+        2. Expect some type of prompt-looking thing.
+        3. Switch the prompt if necessary.
+        4. Clean the output if necessary.
+        5. Check the output for obvious errors, and maybe raise an exception if we got one. 
+        6. Send back the output and set it to self.output.
+
+        If you set "graceful" to True, this function will not raise an exception.
+        This allows us not to have to take sides in the
+        exceptions-vs.-return-codes holy war. 
+
+        If you give "spool" a filename (or True, for a temporary file), the
+        output gets written to that file as it comes in, and instead of a
+        string you get back a SpooledOutput. This is for when you need the
+        whole output of something huge, like a config backup, but don't
+        want it in memory.
+
+        If the session has a result cache and we ran this same read-only
+        command a moment ago, you get the output from last time without
+        anything being sent to the device, unless "cache" is False.
+        """
+
+        return self._run(self._send_steps(command, graceful, spool, cache))
+
+    def send_iter(self, command, graceful=False):
+        """Run a command and yield its output a line at a time, as it comes
+        in, instead of collecting the whole thing. This is for commands like
+        "show tech-support" whose output you'd rather not hold in memory.
+
+        The lines are cleaned like send() output, minus the command echo and
+        without line endings. We check each one for errors as it goes by. If
+        one looks like an error, we stop yielding lines, and either raise an
+        exception (once we're back at the prompt) or, if "graceful" is True,
+        just stop. self.output and self.output_raw are set to None, because
+        we don't keep the output around.
+
+        If you stop iterating early, we still read the rest of the output, so
+        the session is back at the prompt and ready for the next command.
+        """
+
+        self._run(self._send_command_steps(command))
+        retry = self._send_unique_string()
+        matcher = _PromptMatcher(_expect_regexes(self.prompt_prefix), UNIQUE_STRING)
+        reader = self._read_until(matcher, retry)
+        lines = _LineFilter(self.driver, self.paging)
+
+        try:
+            for text in reader:
+                for line in lines.feed(text):
+                    yield line
+        finally:
+            # Whatever happened, get back to the prompt.
+            for text in reader:
+                pass
+            self._finish_unique_string(retry, matcher.line)
+            self.output = None
+            self.output_raw = None
+            self._update_result_cache(command, None)
+
+        if lines.error is not None and not graceful:
+            raise Exception("Found error string! \n%s" % (lines.error))
+
+    def send_table(self, name, command=None):
+        """Run the command that prints a kind of table, and parse it into a
+        Table as it comes in. The kinds of table depend on the platform (see
+        the driver's "tables"), but the same kind has the same columns
+        everywhere:
+
+        mac_address_table - vlan, mac, type and ports.
+        arp - address, age (in seconds), mac and interface.
+        interfaces_status - port, name, status, vlan, duplex, speed and type.
+
+        We read the output with send_iter(), so a 100,000 row MAC table is
+        never in memory as one big string, or as 100,000 dicts.
+
+        Arguments:
+        name - The kind of table, like 'mac_address_table'.
+        command - The command to run, if you want something other than the
+                  usual one, like "show mac address-table vlan 10". It has
+                  to print the same kind of table.
+        """
+
+        parser = self.driver.table_parser(name)
+        return parser.parse(self.send_iter(command or parser.command))
+
+    def send_batch(self, commands, graceful=False, batch_size=None):
+        """Run a bunch of commands, typing them all at once instead of waiting
+        for each one to finish before sending the next. On a high-latency
+        link, this turns one round trip per command into one per batch.
+
+        We type each command with an empty line after it. The device answers
+        the empty line with a bare prompt, which marks where one command's
+        output ends and the next begins. Then we do the unique string trick
+        once at the very end, and split the output back up.
+
+        Returns a list with the output of each command. Each one gets the
+        error check that send() does: if "graceful" is True, a command that
+        fails gets None in the list, and otherwise we raise an exception for
+        the first one that failed. Keep in mind that by then, all of the
+        commands have already run. The outputs are also left in
+        self.outputs, and the whole thing is in self.output.
+
+        Paging needs to be off for this to work, because a --More-- prompt
+        would eat the commands we typed after it, so if paging might still
+        be on (say, on an ASA before enable), we quietly fall back to sending
+        the commands one at a time. We do the same on IOS-XE, which throws
+        away keystrokes that arrive while it's busy with a command.
+
+        Arguments:
+        commands - A list of commands.
+        graceful - Don't raise exceptions, return None for failed commands.
+        batch_size - Type at most this many commands per round trip, in
+                     case the device can't buffer that much typing.
+        """
+
+        return self._run(self._send_batch_steps(commands, graceful, batch_size))
+
+    def _wait_for_echo(self, target, limit):
+        """Read from the channel until we see the target string echoed back,
+        or until "limit" seconds go by. Whatever we read is saved in
+        pending_output, so it still shows up in the command's output.
+        Returns True if we saw the echo."""
+
+        channel = self.interact.channel
+        deadline = time.time() + limit
+        seen = ''
+
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            if not _wait_readable(channel, remaining):
+                return False
+
+            text = self._read()
+            self.pending_output += text
+            seen += text
+
+            # An empty command just echoes a newline, so anything will do.
+            if target in seen:
+                return True
+
+    def send_char(self, char):
+        """Send just a single character.
+        Useful for those times you need to hit 'y' at a prompt.
+        """
+
+        self._write(char)
+        return True
+
+    def is_alive(self, probe=False):
+        """Check whether this session still looks usable. Normally we just
+        make sure the SSH connection and the shell are still open, which
+        costs nothing. If "probe" is True, we also hit return and wait for
+        the prompt, which takes a round trip but proves the device is still
+        listening (and resets its idle timer, so it works as a keepalive).
+        """
+
+        try:
+            transport = self.client.get_transport()
+            if transport is None or not transport.is_active():
+                return False
+            channel = self.interact.channel
+            if channel.closed or channel.exit_status_ready():
+                return False
+            if probe:
+                self.send('', graceful=True)
+        except Exception:
+            return False
+        return True
+
+    def enable(self, enable_password):
+        """For people who need to manually enable, this is a helper method to
+perform that action.
+        """
+
+        return self._run(self._enable_steps(enable_password))
+
+    def interactive(self):
+        """Hand the session to the user.
+        This is useful if you do a really stupid thing in config mode and can
+        no longer log in, for example."""
+
+        self.interact.send(self.newline * 2)
+        self.interact.take_control()
+        return True
+
+    def check_ha_status(self):
+        """Run a series of tests to figure out whether we should make config
+        changes on this device. This is an HA test.
+
+        Active or standalone devices should return True, and the secondary
+        (inactive) device in a redundant pair should return False. If we can't
+        figure it out, return None."""
+
+        return self._run(self._check_ha_status_steps())
+
+    def running_config(self):
+        """Fetch the running config and parse it into a ConfigTree."""
+
+        return self._run(self._running_config_steps())
+
+    def diff_config(self, config):
+        """Compare some config lines to the running config, and return a
+        ConfigDiff that says which lines are missing and the commands it
+        would take to add just those. This doesn't change anything."""
+
+        return self._run(self._diff_config_steps(config))
+
+    def apply_config(self, config, diff=False, upload=None):
+        """Apply some config lines to the config.
+        You can pass in a string or a list.
+        This should even be made to work on things like Juniper devices.
+
+        If "diff" is True, we get the running config first, and only send
+        the lines that aren't in it already (plus whatever section headers
+        they go under). If nothing's missing, we don't even go into config
+        mode. You get a ConfigDiff back that says what was applied and what
+        was skipped. See diff_config().
+
+        If "upload" is 'scp' or 'sftp', we don't type the config at all.
+        Instead, we upload it to the device as a file, over the same SSH
+        connection, and merge it into the running config with one command
+        (like "copy flash:/cliwrangler.cfg running-config"). For a config
+        thousands of lines long, that's one transfer instead of thousands of
+        round trips. We check what the merge printed for errors, and you get
+        that output back (unless you asked for a diff too, in which case
+        only the missing lines get uploaded and you get the ConfigDiff)."""
+
+        return self._run(self._apply_config_steps(config, diff, upload))
+
+    def upload(self, data, path, method='scp'):
+        """Copy a file to the device over the SSH connection we already have.
+
+        Arguments:
+        data - What goes in the file, as a string or bytes.
+        path - Where to put it on the device, like "flash:/cliwrangler.cfg".
+        method - 'scp' or 'sftp', whichever one the device has turned on.
+        """
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        transport = self.client.get_transport()
+
+        if method == 'scp':
+            _scp_upload(transport, data, path, self.timeout)
+        elif method == 'sftp':
+            sftp = paramiko.SFTPClient.from_transport(transport)
+            try:
+                with sftp.open(path, 'wb') as f:
+                    # Don't wait for the device to answer every 32k.
+                    f.set_pipelined(True)
+                    f.write(data)
+            finally:
+                sftp.close()
+        else:
+            raise Exception("Unknown upload method: %s" % (method))
+
+        return True
+
+    def write_config(self):
+        """Write mem or copy run start or whatever.
+        Depending on the device type, this could be quite different."""
+
+        return self._run(self._write_config_steps())
+
+
+
+def _known_hosts_name(device, port):
+    """The name a host goes by in known_hosts: "[host]:port" if the port
+    isn't 22, which is how paramiko looks it up too."""
+
+    if port == 22:
+        return device
+    return '[%s]:%d' % (device, port)
+
+
+if asyncssh is not None:
+    class _AsyncHostKeyClient(asyncssh.SSHClient):
+        """Checks the host key an asyncssh connection gets against a
+        HostKeyStore, with the same rules as _HostKeyPolicy: a device we
+        don't know is accepted and remembered, and a device whose key
+        doesn't match the one we know is refused.
+
+        The keys we do know go to asyncssh through a known_hosts callable
+        (see known_hosts()), so it checks those itself. It asks us about any
+        key that isn't one of them."""
+
+        def __init__(self, store, hostname):
+            self.store = store
+            self.hostname = hostname
+            # The paramiko.BadHostKeyException, if the key didn't match.
+            self.mismatch = None
+
+        def known_hosts(self, host, addr, port):
+            """The known_hosts callable: (trusted host keys, trusted CA
+            keys, revoked keys) for the host we're connecting to."""
+
+            keys = self.store.lookup(self.hostname) or {}
+            trusted = [asyncssh.import_public_key('%s %s' % (key.get_name(), key.get_base64()))
+                       for key in keys.values()]
+            return trusted, [], []
+
+        def validate_host_public_key(self, host, addr, port, key):
+            key = paramiko.PKey.from_type_string(key.get_algorithm(), key.public_data)
+            try:
+                return self.store.check(self.hostname, key)
+            except paramiko.BadHostKeyException as e:
+                self.mismatch = e
+                return False
+
+
+class AsyncCLIWrangler(_SessionProtocol):
+    """An asyncio version of CLIWrangler. Every method that talks to the
+    device is a coroutine, so one event loop can drive hundreds of sessions
+    at once, and an idle session costs a coroutine rather than a thread.
+
+    It speaks SSH with asyncssh instead of paramiko, because paramiko needs a
+    thread per connection. Apart from that, it plays the same tricks as
+    CLIWrangler: the same unique string at the prompt to find the end of the
+    output, the same prompt prefix tracking, and the same error detection.
+
+    There's no interactive(), since there's no terminal for an event loop to
+    hand over. paramiko-expect is what does that for CLIWrangler.
+    """
+
+    def __init__(self, timeout=60, newline='\r', backspace='\b', buffer_size=1024, wait=0.2, echo=False,
+                 readiness='sleep', ssh_options=None, profile_cache=None, result_cache=None, max_channels=None,
+                 metrics=None, host_keys=None):
+        """The constructor for the AsyncCLIWrangler class.
+
+        Arguments:
+        timeout - Timeout in seconds for connecting and for waiting on output.
+        newline - The newline character if '\r' doesn't work.
+        backspace - The backspace character if '\b' doesn't work.
+        buffer_size - The buffer size.
+        wait - The number of seconds to wait after every command sent, thanks to IOS-XE.
+        echo - Should we echo the session to the screen? (For verbosity purposes.)
+        readiness - 'sleep', 'adaptive' or 'none'. See CLIWrangler.
+        ssh_options - A dict of extra keyword arguments for asyncssh.connect(),
+                      for example to turn on legacy key exchange algorithms.
+        profile_cache - A ProfileCache. See CLIWrangler.
+        result_cache - A ResultCache. See CLIWrangler.
+        max_channels - The most shells to have open at once on this SSH
+                       connection. See CLIWrangler.
+        metrics - A Metrics object. See CLIWrangler.
+        host_keys - The HostKeyStore to check host keys against. By
+                    default, it's the one from host_key_store().
+        """
+
+        if asyncssh is None:
+            raise Exception("AsyncCLIWrangler needs the asyncssh library. Try 'pip install asyncssh'.")
+
+        _SessionProtocol.__init__(self, timeout, newline, backspace, buffer_size, wait, echo, readiness,
+                                  profile_cache, metrics, result_cache, max_channels, ssh_options, host_keys)
+
+        # The asyncssh connection and the interactive shell process on it.
+        # These get set during connect.
+        self.connection = None
+        self.process = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def _run(self, steps):
+        """Carry out one of _SessionProtocol's conversations with the
+        device, awaiting each call it asks for. See CLIWrangler._run()."""
+
+        result = None
+        error = None
+        while True:
+            try:
+                if error is None:
+                    method, args, kwargs = steps.send(result)
+                else:
+                    method, args, kwargs = steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            try:
+                result = await getattr(self, method)(*args, **kwargs)
+                error = None
+            except Exception as e:
+                error = e
+
+    async def close(self):
+        """Attempts to close the shell and the SSH connection. An extra shell
+        from open_channel() only closes itself."""
+        for channel in list(self.channels):
+            await channel.close()
+        try:
+            self.process.close()
+        except:
+            pass
+        if self.parent is not None:
+            return
+        try:
+            self.connection.close()
+            await self.connection.wait_closed()
+        except:
+            pass
+
+    async def connect(self, device, username, password, port=22):
+        """Connect to the given device.
+
+        Arguments:
+        device - The device to connect.
+        username - The username to use.
+        password - The password to use.
+        port - The SSH port, if it isn't 22.
+        """
+
+        self.device = device
+        self.port = port
+
+        # Check host keys against the shared store, the same way CLIWrangler
+        # does, and don't use agents or key files, which is as close as
+        # asyncssh gets to what we do with paramiko.
+        if self.host_keys is None:
+            self.host_keys = host_key_store()
+        client = _AsyncHostKeyClient(self.host_keys, _known_hosts_name(device, port))
+        options = {'known_hosts': client.known_hosts, 'agent_path': None, 'client_keys': None}
+        options.update(self.ssh_options)
+
+        # asyncssh does the TCP connection, the handshake and the login in
+        # one go, so it all counts as the handshake.
+        started = time.time()
+        try:
+            self.connection = await asyncio.wait_for(
+                asyncssh.connect(device, port=port, username=username, password=password,
+                                 client_factory=lambda: client, **options),
+                self.timeout)
+        except asyncssh.HostKeyNotVerifiable:
+            if client.mismatch is not None:
+                raise client.mismatch
+            raise
+        self._phase('handshake', started)
+
+        started = time.time()
+        self.process = await self.connection.create_process(term_type='vt100', term_size=(80, 24), encoding=None)
+
+        # Hit a carriage return to make sure we can sense the prompt.
+        self._write(self.newline)
+
+        # Expect before continuing, to clear the buffer and set the prompt.
+        await self._expect_output()
+        self._phase('shell', started)
+
+        return await self._run(self._setup_steps())
+
+    def _write(self, data):
+        """Write a string to the shell."""
+        self.process.stdin.write(data.encode('utf-8'))
+
+    def _write_line(self, line):
+        """Type a line and hit return."""
+        self._write(line + self.newline)
+
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def _server_version(self):
+        """The SSH server's version string."""
+        return self.connection.get_extra_info('server_version')
+
+    async def _read(self, timeout):
+        """Read and clean up whatever output is available."""
+
+        data = await asyncio.wait_for(self.process.stdout.read(self.buffer_size), timeout)
+        if not data:
+            raise Exception("The connection to %s closed while we were waiting for output" % (self.device))
+        return self._clean_output(data)
+
+    async def _expect(self, regexes, retry=None, suffix=None):
+        """Read output until the last line matches one of the regexes, just
+        like CLIWrangler._expect(). Returns the index of the regex that matched."""
+
+        matcher = _PromptMatcher(regexes, suffix)
+        chunks = [text async for text in self._read_until(matcher, retry)]
+        return self._matched(regexes, matcher, chunks)
+
+    async def _read_until(self, matcher, retry=None):
+        """An async generator that yields output a chunk at a time until the
+        matcher matches. See CLIWrangler._read_until()."""
+
+        bare_prompt = _prompt_regex(self.prompt_prefix)
+
+        # Anything we read while waiting for a command echo goes first.
+        if self.pending_output:
+            matcher.feed(self.pending_output)
+            yield self.pending_output
+            self.pending_output = ''
+
+        while matcher.match() is None:
+            timeout = self.timeout
+            if retry is not None and matcher.line_matches(bare_prompt):
+                timeout = self.readiness.probe_timeout()
+            try:
+                text = await self._read(timeout)
+            except asyncio.TimeoutError:
+                if timeout == self.timeout:
+                    raise
+                retry()
+                continue
+
+            matcher.feed(text)
+            yield text
+
+    async def _expect_output(self, spool=None):
+        """Expect our entire output, using the same unique string trick as
+        CLIWrangler._expect_output()."""
+
+        retry = self._send_unique_string()
+        if spool is None:
+            await self._expect(_expect_regexes(self.prompt_prefix), retry=retry, suffix=UNIQUE_STRING)
+            self._finish_unique_string(retry, self.output_raw)
+            return True
+
+        matcher = _PromptMatcher(_expect_regexes(self.prompt_prefix), UNIQUE_STRING)
+        try:
+            async for text in self._read_until(matcher, retry):
+                spool.write(text)
+            spool.finish(matcher.line)
+        except:
+            spool.close()
+            raise
+        self._finish_unique_string(retry, matcher.line)
+        self.output = spool
+        self.output_raw = None
+        return True
+
+    def _host_key_fingerprint(self):
+        """The fingerprint of the host key the device gave us."""
+        return _host_key_fingerprint(self.connection.get_server_host_key().public_data)
+
+    def _channel_open(self, channel):
+        """True if one of our extra shells is open, or still opening."""
+        return channel.process is None or not channel.process.stdout.at_eof()
+
+    async def open_channel(self):
+        """Open another shell on this session's SSH connection, and return
+        it as an AsyncCLIWrangler of its own. This works just like
+        CLIWrangler.open_channel(), except that you have to await it."""
+
+        if self.parent is not None:
+            return await self.parent.open_channel()
+
+        channel = AsyncCLIWrangler(timeout=self.timeout, newline=self.newline, backspace=self.backspace,
+                                   buffer_size=self.buffer_size, wait=self.wait, echo=self.echo,
+                                   result_cache=self.result_cache, max_channels=self.max_channels,
+                                   metrics=self.metrics, host_keys=self.host_keys)
+
+        self.channels = [other for other in self.channels if self._channel_open(other)]
+        self._idle_channels = [other for other in self._idle_channels if other in self.channels]
+        limit = self._channel_limit()
+        if len(self.channels) + 1 >= limit:
+            raise Exception("Can't open another shell on %s, we already have %d open" % (self.device, limit))
+        self.channels.append(channel)
+
+        try:
+            await channel._open_shell(self)
+        except:
+            self.channels.remove(channel)
+            await channel.close()
+            raise
+        return channel
+
+    async def _open_shell(self, parent):
+        """Open a shell on the parent's SSH connection, and prep it with
+        what the parent already knows. See CLIWrangler._open_shell()."""
+
+        self.parent = parent
+        self.connection = parent.connection
+        self.device = parent.device
+        self.port = parent.port
+        self.readiness = parent.readiness.copy()
+
+        started = time.time()
+        self.process = await self.connection.create_process(term_type='vt100', term_size=(80, 24), encoding=None)
+        self._write(self.newline)
+        await self._expect_output()
+        self._phase('shell', started)
+
+        await self._run(self._adopt_steps(parent))
+
+    async def _spare_channel(self):
+        """An extra shell for send_parallel(), or None if we can't have one."""
+
+        while self._idle_channels:
+            channel = self._idle_channels.pop()
+            if self._channel_open(channel):
+                return channel
+        try:
+            return await self.open_channel()
+        except Exception:
+            return None
+
+    async def send_parallel(self, commands, graceful=False, max_channels=None):
+        """Run a bunch of commands at the same time, spread across several
+        shells on this SSH connection. This works just like
+        CLIWrangler.send_parallel(), except that you have to await it."""
+
+        if self.parent is not None:
+            raise Exception("Call send_parallel() on the session that opened this shell")
+
+        commands = list(commands)
+        shells = max(1, min(self._channel_limit(max_channels), self._channel_limit(), len(commands)))
+        outputs = [None] * len(commands)
+        queue = collections.deque(enumerate(commands))
+        failures = []
+
+        async def work(shell):
+            while queue and not failures:
+                index, command = queue.popleft()
+                try:
+                    await shell.send(command, graceful=True)
+                    outputs[index] = shell.output
+                except Exception as e:
+                    failures.append(e)
+                    # Never close our own shell; that's the whole session.
+                    if shell is not self:
+                        await shell.close()
+                    return
+
+        async def work_elsewhere():
+            shell = await self._spare_channel()
+            if shell is not None:
+                await work(shell)
+            return shell
+
+        extra = await asyncio.gather(work(self), *[work_elsewhere() for i in range(shells - 1)])
+        for shell in extra[1:]:
+            if shell is not None and self._channel_open(shell):
+                self._idle_channels.append(shell)
+
+        if failures:
+            raise failures[0]
+
+        self.outputs = outputs
+        return _batch_results(commands, outputs, graceful, self.driver)
+
+    async def send(self, command, graceful=False, spool=None, cache=True):
+        """Run a command. This works just like CLIWrangler.send(), except
+        that you have to await it."""
+
+        return await self._run(self._send_steps(command, graceful, spool, cache))
+
+    async def send_iter(self, command, graceful=False):
+        """Run a command and yield its output a line at a time. This works
+        just like CLIWrangler.send_iter(), except that it's an async
+        generator. If you stop early, close it with aclose() so that we get
+        back to the prompt."""
+
+        await self._run(self._send_command_steps(command))
+        retry = self._send_unique_string()
+        matcher = _PromptMatcher(_expect_regexes(self.prompt_prefix), UNIQUE_STRING)
+        reader = self._read_until(matcher, retry)
+        lines = _LineFilter(self.driver, self.paging)
+
+        try:
+            async for text in reader:
+                for line in lines.feed(text):
+                    yield line
+        finally:
+            async for text in reader:
+                pass
+            self._finish_unique_string(retry, matcher.line)
+            self.output = None
+            self.output_raw = None
+            self._update_result_cache(command, None)
+
+        if lines.error is not None and not graceful:
+            raise Exception("Found error string! \n%s" % (lines.error))
+
+    async def send_table(self, name, command=None):
+        """Run the command that prints a kind of table, and parse it into a
+        Table as it comes in. This works just like CLIWrangler.send_table(),
+        except that you have to await it."""
+
+        parser = self.driver.table_parser(name)
+        table = parser.new_table()
+        batch = []
+        async for line in self.send_iter(command or parser.command):
+            batch.append(line)
+            if len(batch) >= TABLE_BATCH_LINES:
+                parser.feed(table, '\n'.join(batch))
+                batch = []
+        if batch:
+            parser.feed(table, '\n'.join(batch))
+        return table
+
+    async def send_batch(self, commands, graceful=False, batch_size=None):
+        """Run a bunch of commands, typing them all at once. This works just
+        like CLIWrangler.send_batch(), except that you have to await it."""
+
+        return await self._run(self._send_batch_steps(commands, graceful, batch_size))
+
+    async def _wait_for_echo(self, target, limit):
+        """Read until we see the target echoed back or "limit" seconds go by,
+        saving what we read in pending_output. Returns True on an echo."""
+
+        deadline = time.time() + limit
+        seen = ''
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                text = await self._read(remaining)
+            except asyncio.TimeoutError:
+                return False
+            self.pending_output += text
+            seen += text
+            if target in seen:
+                return True
+
+    async def send_char(self, char):
+        """Send just a single character, like a 'y' at a prompt. See
+        CLIWrangler.send_char()."""
+
+        self._write(char)
+        await self.process.stdin.drain()
+        return True
+
+    async def enable(self, enable_password):
+        """Enable, dealing with the password prompt that comes up."""
+
+        return await self._run(self._enable_steps(enable_password))
+
+    async def check_ha_status(self):
+        """See CLIWrangler.check_ha_status()."""
 
-        Arguments:
-        timeout - Connection timeout in seconds.
-        newline - The newline character if '\r' doesn't work.
-        backspace - The backspace character if '\b' doesn't work.
-        buffer_size - The buffer size.
-        wait - The number of seconds to wait after every command sent, thanks to IOS-XE.
-        echo - Should we echo the session to the screen? (For verbosity purposes.)
-        debug - Should we provide ssh debug information on the screen as well?
-        """
+        return await self._run(self._check_ha_status_steps())
 
-        # Arguments
-        self.timeout = timeout
-        self.newline = newline
-        self.backspace = backspace
-        self.buffer_size = buffer_size
-        self.wait = wait
-        self.echo = echo
-        self.debug = debug
+    async def running_config(self):
+        """Fetch the running config and parse it into a ConfigTree."""
 
-        # The device they asked to connect to.
-        self.device = None
-        # Our output after running a command.
-        self.output = None
-        self.output_raw = None
-        # The last thing that matched during an expect.
-        self.last_match = None
-        # The last prompt we found, and a boolean for whether or not the prompt changed after the last command send.
-        self.prompt = None
-        self.prompt_changed = False
-        # The prefix of the prompt that we try to consistently match. Let's see if this works.
-        self.prompt_prefix = None
-        # A list of keywords used to identify this device. Discovered via things like "show ver".
-        # This might be something like ['Cisco', 'IOS', 'C3750'] or ['Cisco', 'NX-OS', 'Nexus', '5000']
-        self.identifiers = []
-        # If an enable succeeds, we set this to True.
-        self.enabled = False
-        # If we decide this device is safe to change, we set this to True.
-        # If we decide this device is NOT safe to change, we set this to False.
-        self.changeable = None
+        return await self._run(self._running_config_steps())
 
-        # Initialize Paramiko and Paramiko-expect objects.
-        self.client = paramiko.SSHClient()
-        # paramikoe.SSHClientInteraction() can't be initialized until after we
-        # connect, so this variable gets set during connect.
-        self.interact = None
+    async def diff_config(self, config):
+        """See CLIWrangler.diff_config()."""
 
-    def __del__(self):
-        """The destructor for our CLIWrangler class."""
-        self.close()
+        return await self._run(self._diff_config_steps(config))
+
+    async def apply_config(self, config, diff=False, upload=None):
+        """Apply some config lines to the config.
+        You can pass in a string or a list. See CLIWrangler.apply_config()
+        for what "diff" and "upload" do."""
+
+        return await self._run(self._apply_config_steps(config, diff, upload))
+
+    async def upload(self, data, path, method='scp'):
+        """Copy a file to the device over the SSH connection we already
+        have. See CLIWrangler.upload()."""
+
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        if method == 'scp':
+            await asyncio.wait_for(self._scp_upload(data, path), self.timeout)
+        elif method == 'sftp':
+            async with self.connection.start_sftp_client() as sftp:
+                async with sftp.open(path, 'wb') as f:
+                    await asyncio.wait_for(f.write(data), self.timeout)
+        else:
+            raise Exception("Unknown upload method: %s" % (method))
+
+        return True
+
+    async def _scp_upload(self, data, path):
+        """Speak SCP at "scp -t" on the device. See _scp_upload()."""
+
+        process = await self.connection.create_process('scp -t %s' % (path), encoding=None)
+
+        async def reply():
+            answer = await process.stdout.read(1)
+            message = b''
+            if answer not in (b'', b'\x00'):
+                message = await process.stdout.readline()
+            _scp_reply(answer, message)
 
-    def close(self):
-        """Attempts to close the paramiko-expect session for clean completion."""
         try:
-            # Close the paramiko-expect session.
-            self.channel.close()
-        except:
-            pass
+            await reply()
+            process.stdin.write(('C0644 %d %s\n' % (len(data), _scp_file_name(path))).encode('utf-8'))
+            await reply()
+            process.stdin.write(data + b'\x00')
+            await reply()
+        finally:
+            process.close()
+
+    async def write_config(self):
+        """Write mem or copy run start or whatever."""
+
+        return await self._run(self._write_config_steps())
 
-    def connect(self, device, username, password):
-        """Connect to the given device using our Paramiko client.
 
-        Arguments:
-        device - The device to connect.
-        username - The username to use.
-        password - The password to use.
-        """
 
+class FleetResult:
+    """The outcome of running a job against one device during a fleet run.
+
+    Attributes:
+    device - The device this result is for.
+    entry - The inventory entry we were handed for this device.
+    result - Whatever the job returned, or None if something went wrong.
+    error - A string describing the exception, or None if everything worked.
+    error_type - The class name of the exception, or None.
+    traceback - The formatted traceback of the exception, or None.
+    identifiers - The identifiers we collected for the device.
+    facts - What we learned about the device, like its vendor and version.
+    connect_time - Seconds spent in connect(), including prep and identification.
+    job_time - Seconds spent running the job.
+    elapsed - Total seconds spent on this device.
+    """
+
+    def __init__(self, device, entry=None):
         self.device = device
+        self.entry = entry
+        self.result = None
+        self.error = None
+        self.error_type = None
+        self.traceback = None
+        self.identifiers = []
+        self.facts = {}
+        self.connect_time = None
+        self.job_time = None
+        self.elapsed = None
 
-        # Set SSH key parameters to auto accept unknown hosts.
-        self.client.load_system_host_keys()
-        self.client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    @property
+    def ok(self):
+        """True if the job ran to completion without raising."""
+        return self.error is None
 
-        # Connect to the host.
-        # "allow_agent=False" and "look_for_keys=False" are necessary to log into some IOS devices.
-        self.client.connect(hostname=device, username=username, password=password, allow_agent=False, look_for_keys=False)
-        # Now we can initialize our interaction object.
-        self.interact = paramikoe.SSHClientInteraction(self.client, timeout=self.timeout, display=self.echo)
+    def __repr__(self):
+        if self.ok:
+            return "<FleetResult %s ok in %.2fs>" % (self.device, self.elapsed or 0)
+        return "<FleetResult %s failed in %.2fs: %s>" % (self.device, self.elapsed or 0, self.error)
 
-        # Hit a carriage return to make sure we can sense the prompt.
-        # This isn't necessary on Cisco IOS, but it's necessary on FortiOS.
-        self.interact.send(self.newline)
 
-        # Expect before continuing, to clear the buffer and set the prompt.
-        self._expect_output()
+def _fleet_entry(entry, username, password):
+    """Turn an inventory entry into a dict with at least device, username
+    and password in it. An entry can be a plain hostname or a dict."""
 
-        # Prep the session (term len 0, etc).
-        self._prepare()
-        
-        # Identify the device we're on.
-        self._identify()
+    if isinstance(entry, dict):
+        entry = dict(entry)
+    else:
+        entry = {'device': entry}
 
-        # If we auto-enabled, we can set that bit now.
-        if re.match('^.*#\s*$', self.prompt):
-            self.enabled = True
+    if 'device' not in entry:
+        raise Exception("Inventory entry has no 'device' key: %r" % (entry,))
 
-        return True
+    entry.setdefault('username', username)
+    entry.setdefault('password', password)
+    return entry
 
-    def _expect_output(self):
-        """Expect our entire output. This is meant to be used during a "send"
-        method call, or after any manual send. There are some dirty tricks in here."""
 
-        # The first thing we do is type a string that we don't expect to get
-        # from any command output. This puts us in a known state. Otherwise, if
-        # we try to just match on the prompt, we won't know whether we're
-        # matching the last prompt available, or something before we ran the
-        # last command.
-        unique_string = 'RRRR'
-        length_of_unique_string = len(unique_string)
-        backspace_string = self.backspace * length_of_unique_string
+def _fleet_entry_failure(entry, e):
+    """A failed FleetResult for an inventory entry that we couldn't make
+    sense of."""
 
-        # Send our unique string.
-        self.interact.channel.send(unique_string)
+    device = entry.get('device') if isinstance(entry, dict) else entry
+    result = FleetResult(device, entry)
+    result.error = str(e) or repr(e)
+    result.error_type = e.__class__.__name__
+    result.traceback = traceback.format_exc()
+    result.elapsed = 0.0
+    return result
 
-        # Expect the unique string we just sent, with the prompt prefix at the
-        # beginning of the line if we have one.
-        if self.prompt_prefix:
-            # If your hostname is longer than 20 characters, IOS will cut off
-            # anything after character 20 when you enter expect mode. So let's
-            # also look for a cut-off version of that just in case.
-            prompt_and_unique_string = "%s.*%s" % (self.prompt_prefix, unique_string)
-            truncated_prompt_and_unique_string = "%s.*%s" % (self.prompt_prefix[:20], unique_string)
-            self.interact.expect([prompt_and_unique_string, truncated_prompt_and_unique_string])
-        else:
-            # If we don't have a prompt prefix, at least expect something sane.
-            # Unfortunately, this is a bit more complex, because we have to
-            # define sanity. It should be "something kind of prompty" followed
-            # by an allowed end-of-prompt character followed by the unique
-            # string we typed.
-            end_of_prompt_chars = ['>', '#', '$', '%']
-            # A prompt, simply, is 3 or more [a-z0-9/-] characters, plus maybe
-            # an extension of other things, with an end_of_prompt_char at the end,
-            # and maybe some whitespace after that. You can thank the FWSM for
-            # using the forward slash in a prompt.
-            general_prompt_regex_template = '[a-zA-Z0-9/-]{3,}\s*%s\s*%s'
-            # Create a regex for each char in the list above.
-            general_prompt_regexes = [ general_prompt_regex_template % (char, unique_string) for char in end_of_prompt_chars ]
-            # See if any of the "sane-looking possible prompts" matched.
-            self.interact.expect(general_prompt_regexes)
-
-        # Set the output variables.
-        self.output = self.interact.current_output_clean
-        self.output_raw = self.interact.current_output
 
-        # Backspace over the dirty trick.
-        self.interact.channel.send(backspace_string)
+def _fleet_worker(entry, job, session_args):
+    """Connect to one device, run the job against it and hand back a
+    FleetResult. This runs inside a pool worker, so it must never raise."""
 
-        # We now need to set the "prompt" variable in case the prompt changed.
-        # See what's now at the end.
-        output = self.output_raw
-        # Strip the extra stuff we created off the end.
-        output = output[:-length_of_unique_string]
-        # Take the last line. That's our prompt.
-        self.prompt = output.splitlines()[-1];
-
-        # Try to get the prompt prefix if we haven't already. We keep track of
-        # this in case the prompt gets suffixes tacked onto it by mode changes.
-        # If we don't do this, we'll trip up when a prompt-ending character is
-        # found at the end of a line of command output. 
-        if self.prompt_prefix is None:
-            m = re.match('^([a-zA-Z0-9-]{3,})', self.prompt)
-            if m is not None:
-                self.prompt_prefix = m.group(1)
+    result = FleetResult(entry['device'], entry)
+    started = time.time()
+    session = None
 
-        # Let's return True. I have no idea what would be useful here yet.
-        return True
+    try:
+        session = CLIWrangler(**session_args)
+        session.connect(device=entry['device'], username=entry['username'], password=entry['password'],
+                        port=entry.get('port', 22), priority=entry.get('priority', 0))
+        result.connect_time = time.time() - started
+        result.identifiers = list(session.identifiers)
+        result.facts = dict(session.facts)
 
-    def _prepare(self):
-        """Prepare the session by doing "terminal length 0" and any other
-        such things that might be necessary."""
+        job_started = time.time()
+        result.result = job(session, entry)
+        result.job_time = time.time() - job_started
+    except Exception as e:
+        # We flatten the exception into strings, because a lot of paramiko's
+        # exceptions can't be pickled back across a process pool.
+        result.error = str(e) or repr(e)
+        result.error_type = e.__class__.__name__
+        result.traceback = traceback.format_exc()
+    finally:
+        if session is not None:
+            session.close()
 
-        # The very first thing we need to do is turn off paging.
-        result = self.send('terminal length 0', graceful=True)
-        # If that worked, send IOS commands to disable monitor and editing.
-        if result is not None:
-            self.send('terminal no monitor', graceful=True)
-            self.send('terminal no editing', graceful=True)
-            return True
+    result.elapsed = time.time() - started
+    return result
 
-        # Cisco ASAs don't let you run "terminal pager 0" unless you've
-        # enabled. This is severely cramping my style. Not sure how to deal
-        # with this case yet.
 
-        # The usual IOS commands didn't work, so let's try the FortiOS ones.
-        # This is horribly dirty because FortiOS CLI is terrible.
-        # I don't feel comfortable trying these things unless we're relatively
-        # sure we're on FortiOS, so let's look for the Fortinet error format in
-        # the output of our last command.
-        if "Command fail. Return code" in self.output:
-            # There are two ways to do this. Here's the one you need if you have vdoms:
-            result = self.send('config global', graceful=True)
-            if result is not None:
-                self.send('config system console')
-                self.send('set output standard')
-                self.send('end')
-                self.send('end')
-            # And here's the one you need if you don't have vdom support (fortiOS 4.x?)
-            else:
-                self.send('config system console')
-                self.send('set output standard')
-                self.send('end')
+def run_fleet(inventory, job, username=None, password=None, workers=32, processes=False, session_args=None,
+              scheduler=None):
+    """Run a job against a whole bunch of devices in parallel.
 
-        # None of our prep worked. This may not be catastrophic, so let's return False.
-        return False
-        
-    def _identify(self):
-        """Run various commands to identify the device we're on."""
-
-        # Here's a big collection of strings to look for. If we find any of
-        # these strings in command output, we add their value to the
-        # identification list. I should probably load this in from a separate
-        # file because it's going to get huge.
-        identification_strings = yaml.load("""
-            'Cisco ': 'Cisco'
-            'cisco ': 'Cisco'
-            'CISCO ': 'Cisco'
-            ' IOS ': 'IOS'
-            'IOS ': 'IOS'
-            ' C3750 ': 'C3750'
-            ' WS-C6509-E ': 'C6509-E'
-            'Adaptive Security Appliance': 'ASA'
-            'ASA5520': 'ASA5520'
-            'FWSM Firewall': 'FWSM'
-            'FWSM Firewall Version': 'Cisco'
-            'FortiOS': 'Fortinet'
-            'FortiGate': 'FortiGate'
-            'FortiGate-1000C': '1000C'
-            'Nexus Operating': 'Nexus'
-            'NX-OS': 'NX-OS'
-            'Nexus5548': 'Nexus5548'
-        """)
-
-        identification_commands = yaml.load("""
-            - 'show version' # Cisco IOS
-            - 'get system status' # Fortinet FortiOS
-        """)
+    This is a generator. It yields a FleetResult for each device as soon as
+    that device is finished, so a big sweep takes about as long as its
+    slowest devices, and you can start dealing with results right away.
 
-        # Run a slew of commands and search through the output of the one (or
-        # ones) that worked. Right now, we break after one successful command
-        # run.
-        output = None
+    Every device gets its own CLIWrangler session, which is connected,
+    handed to the job as job(session, entry), and closed afterwards. If the
+    job or the connect raises, the exception is caught and recorded in the
+    FleetResult instead of taking down the whole run.
 
-        for command in identification_commands:
-            # "graceful" just means "Don't raise an exception because this
-            # command might fail and I don't care if it does."
-            result = self.send(command, graceful=True)
-            if result is not None:
-                output = self.output
-                break
+    Arguments:
+    inventory - An iterable of devices. Each one is either a hostname or a
+                dict with a 'device' key, plus optional 'username',
+                'password', 'port' and 'priority' keys and anything else
+                your job wants to see.
+    job - A function that takes (session, entry) and returns whatever you like.
+    username - The username to use for entries that don't have one.
+    password - The password to use for entries that don't have one.
+    workers - The maximum number of devices to work on at the same time.
+    processes - Use a process pool instead of a thread pool. The job has to
+                be a module-level function so that it can be pickled.
+    session_args - A dict of keyword arguments for each CLIWrangler().
+    scheduler - A ConnectionScheduler to decide when each device gets to
+                log in. Share it with any other run_fleet() going at the
+                same time, and an entry's 'priority' decides who goes
+                first. It only works with threads.
+    """
 
-        # If any of the identification strings are found in the output, stick
-        # them into the identifiers list.
-        for string in identification_strings.keys():
-            if string in output:
-                identity = identification_strings[string]
-                # Don't add it if it's already there. More than one might match.
-                if identity not in self.identifiers:
-                    self.identifiers.append(identity)
+    session_args = session_args or {}
+    if scheduler is not None:
+        if processes:
+            raise Exception("A ConnectionScheduler can't be shared between processes")
+        session_args = dict(session_args, scheduler=scheduler)
 
-        return True
+    if processes:
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
 
-    def send(self, command, graceful=False):
-        """Run a command.
+    # Only keep a couple of devices queued up per worker. Submitting a
+    # 4,000-device inventory all at once would work, but it would build
+    # thousands of futures before the first result came back.
+    max_pending = workers * 2
+    pending = set()
 
-        Here's what a "send" does:
+    try:
+        for entry in inventory:
+            # A broken inventory entry is that entry's problem, not the
+            # whole run's.
+            try:
+                entry = _fleet_entry(entry, username, password)
+            except Exception as e:
+                yield _fleet_entry_failure(entry, e)
+                continue
+            pending.add(executor.submit(_fleet_worker, entry, job, session_args))
+            if len(pending) < max_pending:
+                continue
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
 
-        1. Send the line.
-        2. Expect some type of prompt-looking thing.
-        3. Switch the prompt if necessary.
-        4. Clean the output if necessary.
-        5. Check the output for obvious errors, and maybe raise an exception if we got one. 
-        6. Send back the output and set it to self.output.
+        while pending:
+            done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # If the caller stopped iterating early, don't start any more devices.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
 
-        If you set "graceful" to True, this function will not raise an exception.
-        This allows us not to have to take sides in the
-        exceptions-vs.-return-codes holy war. 
-        """
 
-        # Send the command.
-        self.interact.send(command)
+# A login that fails with one of these looks like the device or the AAA
+# server is too busy, not like a wrong password, so it's worth another try.
+BUSY_LOGIN_PATTERNS = ['protocol banner', 'No existing session', 'Connection reset', 'lines? (are )?busy',
+                       'Authentication timeout', 'Administratively prohibited', 'Resource shortage']
 
-        # Unfortunately, on IOS-XE, there's a short period of time after a
-        # command is sent where if you send characters, they get thrown out.
-        # This should be considered a bug, but I doubt Cisco's going to fix it.
-        # Because of this IOS-XE bug, we need to wait after sending a command.
-        time.sleep(self.wait)
 
-        # On the off chance that we couldn't disable paging, hit space bar a
-        # few times. This is pretty sad, but necessary for things like the
-        # ASAs, which don't let you disable paging until you've enabled.
-        self.interact.channel.send('     ')
+def _login_failure(e, logging_in=True):
+    """Decide what a failed connect() was about: 'auth' if the AAA server
+    turned us down, 'busy' if the device looks like it's out of VTY lines
+    (or too busy to talk to us), or None if it's something a retry won't
+    fix.
 
-        # Expect the end of the output of the send command.
-        self._expect_output()
+    Only the TCP connection, the SSH handshake, the login and opening the
+    shell can fail for being busy. If "logging_in" is False, the device had
+    already let us in and given us a shell, so whatever went wrong after
+    that (like the connection closing while we were waiting for output)
+    isn't something a retry will fix."""
 
-        # If something looked like an error, print it and maybe raise an exception.
-        error_patterns = ['^% Invalid', '^% Incomplete', '^ERROR: ', '^Cannot make changes', 'Command fail. Return code']
-        for error in error_patterns:
-            if re.search(error, self.output, flags=re.MULTILINE):
-                # If they don't want exceptions, don't raise an exception.
-                # The reason why I offer the choice is because some Python
-                # programmers do everything by exception handling, and others
-                # hate it.
-                if graceful:
-                    # We return None if there was an error and the user didn't
-                    # want exceptions to be raised. If the user wants to check
-                    # for a specific error, it will be in self.output.
-                    return None
-                else:
-                    raise Exception("Found error string! \n%s" % (self.output))
+    if not logging_in:
+        return None
+    if isinstance(e, paramiko.BadAuthenticationType):
+        return None
+    if isinstance(e, paramiko.AuthenticationException):
+        return 'auth'
+    if isinstance(e, (paramiko.ChannelException, EOFError, ConnectionResetError)):
+        return 'busy'
+    for pattern in BUSY_LOGIN_PATTERNS:
+        if re.search(pattern, str(e), flags=re.IGNORECASE):
+            return 'busy'
+    return None
 
-        # Return the output.
-        return self.output
 
-    def send_char(self, char):
-        """Send just a single character.
-        Useful for those times you need to hit 'y' at a prompt.
-        """
+class _TokenBucket:
+    """Lets "rate" things happen per second, with up to "burst" at once."""
 
-        interact.channel.send(char)
-        return True
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
 
-    def enable(self, enable_password):
-        """For people who need to manually enable, this is a helper method to
-perform that action.
-        """
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
-        self.interact.send('enable')
-        self.interact.expect([self.prompt, '.*ssword:\s*$'])
+    def wait_time(self, now):
+        """Seconds until we have a token, or 0 if we have one now."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
 
-        # Type the password at the password prompt.
-        if re.search('ssword:', self.interact.last_match, flags=re.IGNORECASE):
-            self.send(enable_password)
-            #self.interact.send(enable_password)
-            #self._expect_prompt()
-        else:
-            raise Exception("Didn't get something that looked like a password prompt when trying to enable!")
+    def take(self):
+        self.tokens -= 1
 
-        # Make sure we enabled.
-        if (re.search('#', self.prompt)):
-            self.enabled = True
+    def drain(self):
+        """Throw away the tokens we've saved up, so we slow down right away."""
+        self.tokens = min(self.tokens, 0.0)
 
-        # If we're on an ASA, we need to disable paging here, because we
-        # couldn't do it during the _prepare.
-        if ("Cisco" in self.identifiers and "ASA" in self.identifiers):
-            self.send('terminal pager 0')
 
-        return self.enabled
+class ConnectionScheduler:
+    """Decides when each connect() gets to happen, so that a big sweep
+    doesn't knock over our TACACS+ servers or use up every VTY line on a
+    little switch, and then retry in a thundering herd.
 
-    def interactive(self):
-        """Hand the session to the user.
-        This is useful if you do a really stupid thing in config mode and can
-        no longer log in, for example."""
+    Give one to CLIWrangler(scheduler=...) (or to run_fleet()), and share it
+    between every session that logs in through the same AAA servers. Then
+    connect() waits its turn:
 
-        self.interact.send(self.newline * 2)
-        self.interact.take_control()
-        return True
+    * We never have more than "max_connections" sessions connected at once,
+      or more than "max_per_device" to one device. A session holds its place
+      from the time it starts logging in until it's closed.
+    * Logins are rate limited with a token bucket for each AAA domain, so
+      each set of AAA servers gets at most "login_rate" logins per second,
+      with bursts of up to "login_burst".
+    * Whoever is waiting with the highest priority goes first, so a change
+      that's urgent (connect(priority=10)) gets in ahead of a bulk audit
+      (priority 0). Waiters that can't go yet, because their device is full
+      or their AAA domain is out of tokens, don't hold up anybody else.
+    * If a login fails in a way that looks like the device is too busy
+      (see _login_failure()), we back off for a random time (up to
+      "backoff" seconds, doubling every try, but never more than
+      "max_backoff") and try again, up to "retries" times.
+    * An authentication failure empties the AAA domain's bucket, so
+      everybody else slows down too, instead of piling on. A wrong password
+      looks just like an overloaded AAA server, though, and every try counts
+      towards locking the account, so we only try again (up to
+      "auth_retries" times) if other sessions in the same AAA domain were
+      turned down in the last "auth_window" seconds too. On its own, an
+      authentication failure is raised right away.
 
-    def check_ha_status(self):
-        """Run a series of tests to figure out whether we should make config
-        changes on this device. This is an HA test.
+    It's thread-safe, but it lives in one process, so it can't be shared
+    between the workers of a process pool.
+    """
 
-        Active or standalone devices should return True, and the secondary
-        (inactive) device in a redundant pair should return False. If we can't
-        figure it out, return None."""
+    def __init__(self, max_connections=64, max_per_device=2, login_rate=None, login_burst=None, domains=None,
+                 rates=None, retries=3, backoff=1.0, max_backoff=30.0, auth_retries=1, auth_window=10.0):
+        """Arguments:
+        max_connections - The most sessions connected at once, in total.
+        max_per_device - The most sessions connected to one device at once.
+                         A lot of devices only have 5 VTY lines, so leave
+                         some for the humans.
+        login_rate - Logins per second for each AAA domain, or None for no
+                     limit.
+        login_burst - How many logins can go at once before login_rate kicks
+                      in. By default, login_rate rounded up.
+        domains - Which AAA domain each device logs in through: a dict of
+                  {device: domain}, or a function that takes a device and
+                  returns its domain. Devices it doesn't know all share the
+                  None domain.
+        rates - A dict of {domain: (login_rate, login_burst)}, for AAA
+                domains that can take more (or less) than the others.
+        retries - How many times to try again when a login fails because
+                  something's too busy.
+        backoff - The most seconds to wait before the first retry.
+        max_backoff - The most seconds to wait before any retry.
+        auth_retries - How many times to try again when a login is turned
+                       down while other logins to the same AAA domain are
+                       being turned down too. 0 means never.
+        auth_window - How many seconds back we look for those other
+                      authentication failures.
+        """
 
-        # We should use the identifiers to figure out how to proceed.
-        # Cisco ASAs and FWSMs need to be checked to make sure they're
-        # standalone or currently active.
-        if "Cisco" in self.identifiers:
-            if "ASA" in self.identifiers:
-                # Run "show failover" on the ASA and look for various strings.
-                # Has to be graceful because this command requires the failover license.
-                self.send('show failover', graceful=True)
-                if re.search('Command requires failover license', self.output):
-                    self.changeable = True
-                elif 'Failover Off' in self.output:
-                    self.changeable = True
-                elif re.search('This host:.*- Active', self.output):
-                    self.changeable = True
-                elif re.search('This host:.*- Standby', self.output):
-                    self.changeable = False
-                else:
-                    # We don't know for sure, so return None.
-                    pass
-            elif "FWSM" in self.identifiers:
-                # We run "show failover" on the FWSM and look for various strings.
-                self.send('show failover', graceful=True)
-                if 'Failover Off' in self.output:
-                    self.changeable = True
-                elif 'This context: Active' in self.output:
-                    self.changeable = True
-                elif re.search('This Host:.*- Active', self.output):
-                    self.changeable = True
-                elif 'This context: Standby' in self.output:
-                    self.changeable = False
-                elif re.search('This Host:.*- Standby', self.output):
-                    self.changeable = False
-                else:
-                    # We don't know for sure, so return None.
-                    pass
+        self.max_connections = max_connections
+        self.max_per_device = max_per_device
+        self.login_rate = login_rate
+        self.login_burst = login_burst
+        self.domains = domains or {}
+        self.rates = rates or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.auth_retries = auth_retries
+        self.auth_window = auth_window
+
+        self.condition = threading.Condition()
+        # The sessions that are connected (or connecting), and their devices.
+        self.connected = {}
+        self.counts = collections.defaultdict(int)
+        # A token bucket for each AAA domain, if they're rate limited.
+        self.buckets = {}
+        # Everybody who's waiting, best first, as (-priority, ticket, device,
+        # domain) tuples. The ticket keeps it first come, first served within
+        # a priority.
+        self.waiting = []
+        self.tickets = 0
+        # Recent authentication failures in each AAA domain, oldest first,
+        # as (time, session) tuples.
+        self.auth_failures = collections.defaultdict(collections.deque)
+        # How many logins we've let through, retried and given up on.
+        self.logins = 0
+        self.retried = 0
+        self.gave_up = 0
+
+    def domain(self, device):
+        """The AAA domain a device logs in through."""
+        if callable(self.domains):
+            return self.domains(device)
+        return self.domains.get(device)
+
+    def _bucket(self, domain):
+        """The token bucket for an AAA domain, or None if it isn't limited."""
+        if domain not in self.buckets:
+            rate, burst = self.rates.get(domain, (self.login_rate, self.login_burst))
+            if rate is None:
+                self.buckets[domain] = None
             else:
-                # We'll always give a green light for Cisco devices.
-                self.changeable = True
-        # On Fortinet devices, this probably won't always work, but it works
-        # for FortiOS 5.x so far.
-        elif "Fortinet" in self.identifiers:
-            if "FortiGate" in self.identifiers:
-                self.send('get system status', graceful=True)
-                if 'Current HA mode: a-p, master' in self.output:
-                    self.changeable = True
-                elif 'Current HA mode: standalone' in self.output:
-                    self.changeable = True
-                elif 'Current HA mode: a-p, backup' in self.output:
-                    self.changeable = False
+                self.buckets[domain] = _TokenBucket(rate, burst or max(1, int(math.ceil(rate))))
+        return self.buckets[domain]
+
+    def _blocked(self, device, domain, now):
+        """Why a login can't go yet: None if it can, 'full' if there's no
+        room for another session, or the seconds until its AAA domain has a
+        token."""
+
+        if len(self.connected) >= self.max_connections or self.counts[device] >= self.max_per_device:
+            return 'full'
+        bucket = self._bucket(domain)
+        if bucket is not None:
+            return bucket.wait_time(now) or None
+        return None
+
+    def acquire(self, session, device, priority=0, timeout=None):
+        """Wait until it's this session's turn to log into a device, and
+        count the session as connected. Call release() when it's closed.
+        Returns the seconds we waited."""
+
+        started = time.time()
+        deadline = None if timeout is None else started + timeout
+        domain = self.domain(device)
+
+        with self.condition:
+            self.tickets += 1
+            waiter = (-priority, self.tickets, device, domain)
+            bisect.insort(self.waiting, waiter)
+            try:
+                while True:
+                    # Go through everybody ahead of us. If one of them could
+                    # go now, it's their turn, not ours.
+                    now = time.time()
+                    wake = None
+                    for other in self.waiting:
+                        blocked = self._blocked(other[2], other[3], now)
+                        if blocked is None:
+                            break
+                        if blocked != 'full':
+                            wake = blocked if wake is None else min(wake, blocked)
+                    else:
+                        other = None
+
+                    if other is waiter:
+                        break
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0:
+                            raise Exception("Timed out waiting for a turn to log into %s" % (device))
+                        wake = remaining if wake is None else min(wake, remaining)
+                    self.condition.wait(wake)
+            finally:
+                self.waiting.remove(waiter)
+                self.condition.notify_all()
+
+            bucket = self._bucket(domain)
+            if bucket is not None:
+                bucket.take()
+            self.connected[session] = device
+            self.counts[device] += 1
+            self.logins += 1
+
+        return time.time() - started
+
+    def release(self, session, failure=None):
+        """Stop counting a session as connected. If it failed to log in,
+        "failure" is what _login_failure() said about it."""
+
+        with self.condition:
+            device = self.connected.pop(session, None)
+            if device is None:
+                return
+            self.counts[device] -= 1
+            if self.counts[device] <= 0:
+                del self.counts[device]
+            if failure == 'auth':
+                domain = self.domain(device)
+                bucket = self._bucket(domain)
+                if bucket is not None:
+                    bucket.drain()
+                self.auth_failures[domain].append((time.time(), session))
+            self.condition.notify_all()
+
+    def _auth_storm(self, session, device):
+        """True if other sessions have been turned down by this device's AAA
+        domain lately, which makes it look like the AAA server is
+        overloaded, and not like we've got the wrong password."""
+
+        with self.condition:
+            failures = self.auth_failures[self.domain(device)]
+            cutoff = time.time() - self.auth_window
+            while failures and failures[0][0] < cutoff:
+                failures.popleft()
+            return any(other is not session for when, other in failures)
+
+    def connect(self, session, device, username, password, port=22, priority=0, timeout=None):
+        """Connect a CLIWrangler session when it's our turn, and try again
+        if the login fails because something's too busy. This is what
+        CLIWrangler.connect() calls when it has a scheduler."""
+
+        busy_tries = auth_tries = 0
+        while True:
+            waited = self.acquire(session, device, priority, timeout)
+            if session.metrics is not None:
+                session._record_phase('queue', waited)
+            try:
+                return session._connect(device, username, password, port)
+            except Exception as e:
+                failure = _login_failure(e, session._logging_in)
+                self.release(session, failure)
+                session.close()
+                if failure is None:
+                    raise
+                if failure == 'auth':
+                    # If we're the only one getting turned down, it's
+                    # probably just the wrong password, so don't try it
+                    # again and get the account locked out.
+                    if not self._auth_storm(session, device):
+                        raise
+                    auth_tries += 1
+                    tries, limit = auth_tries, self.auth_retries
                 else:
-                    # We don't know for sure, so return None.
-                    pass
-        
-        # For anything else, we aren't qualified to say with certainty.
-        # The default value is None.
-        return self.changeable
+                    busy_tries += 1
+                    tries, limit = busy_tries, self.retries
+                if tries > limit:
+                    with self.condition:
+                        self.gave_up += 1
+                    raise Exception("Couldn't log into %s after %d tries, it looks like %s is too busy: %s" % (
+                        device, busy_tries + auth_tries, 'the AAA server' if failure == 'auth' else 'the device', e))
 
-    def apply_config(self, config):
-        """Apply some config lines to the config.
-        You can pass in a string or a list.
-        This should even be made to work on things like Juniper devices."""
+            attempt = busy_tries + auth_tries - 1
+            with self.condition:
+                self.retried += 1
+            # Full jitter: everybody who failed at the same time comes back at
+            # a different time.
+            time.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+            session._reset_connection()
 
-        # Make sure we're enabled.
-        if not self.enabled:
-            raise Exception("Called apply_config() without being enabled")
 
-        # If it seems like we were passed a string, split it into a list.
-        # If this is a list, the split will raise an exception, which is fine.
+class SessionPool:
+    """A pool of connected, prepped CLIWrangler sessions, so that code that
+    talks to the same devices over and over (a web app, say) doesn't pay
+    for an SSH handshake, a login and connect()'s prep and identification
+    every time.
+
+    Sessions are pooled per (device, port, username). acquire() hands out an
+    idle one if there is one, or connects a new one if the device is under
+    its cap, or waits for one to be released. release() puts a session back,
+    after getting it out of config mode. Idle sessions are kept alive with
+    an empty command every "keepalive" seconds, so the device doesn't log
+    them out, and thrown away after "idle_timeout" seconds. If there are
+    more than "max_idle" idle sessions, the least recently used ones go.
+
+    The easiest way to use it is the session() context manager:
+
+        pool = cliwrangler.SessionPool(username='cisco', password='sekrit')
+        with pool.session('switch1') as session:
+            output = session.send('show ip int brief')
+    """
+
+    def __init__(self, username=None, password=None, max_per_device=2, max_idle=64, idle_timeout=300,
+                 keepalive=60, session_args=None):
+        """Arguments:
+        username - The username to use if acquire() isn't given one.
+        password - The password to use if acquire() isn't given one.
+        max_per_device - The most sessions we'll have open to one device at
+                         once, idle or not. A lot of devices only have a few
+                         VTY lines, so don't hog them.
+        max_idle - The most idle sessions we'll keep around, in total.
+        idle_timeout - Close sessions that have been idle this many seconds.
+        keepalive - Send an empty command on idle sessions this often, in
+                    seconds, or None to not bother.
+        session_args - A dict of keyword arguments for each CLIWrangler().
+        """
+
+        self.username = username
+        self.password = password
+        self.max_per_device = max_per_device
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.session_args = session_args or {}
+
+        self.condition = threading.Condition()
+        # Idle sessions, least recently used first. The values are
+        # [key, when it was released, when we last heard from it].
+        self.idle = collections.OrderedDict()
+        # Sessions that have been handed out, and their keys.
+        self.in_use = {}
+        # How many sessions each key has open, idle or not.
+        self.counts = collections.defaultdict(int)
+        self.closed = False
+
+        self.keepalive_thread = None
+        self.stopping = threading.Event()
+        if keepalive is not None:
+            self.keepalive_thread = threading.Thread(target=self._keepalive_loop, name='cliwrangler-keepalive')
+            self.keepalive_thread.daemon = True
+            self.keepalive_thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @contextlib.contextmanager
+    def session(self, device, username=None, password=None, port=22, timeout=None):
+        """Acquire a session for a "with" block, and release it afterwards."""
+
+        session = self.acquire(device, username=username, password=password, port=port, timeout=timeout)
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def acquire(self, device, username=None, password=None, port=22, timeout=None):
+        """Get a connected session to a device.
+
+        Arguments:
+        device - The device to connect to.
+        username - The username, if it isn't the pool's.
+        password - The password, if it isn't the pool's.
+        port - The SSH port.
+        timeout - How many seconds to wait for a session if the device is
+                  already at max_per_device, or None to wait forever.
+        """
+
+        username = username or self.username
+        password = password or self.password
+        key = (device, port, username)
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            session, probe = self._take(key, deadline)
+            if session is None:
+                break
+            # Make sure it still works before we hand it out. If it's been
+            # sitting there long enough that the device might have hung up on
+            # it, check for real.
+            if session.is_alive(probe=probe):
+                with self.condition:
+                    self.in_use[session] = key
+                return session
+            self._discard(key, session)
+
+        # There wasn't an idle one, so make a new one. _take() already
+        # counted it against the device.
         try:
-            # This will transform a string into a list, even if it's just one
-            # item. Very classy.
-            config = config.split('\n')
+            session = CLIWrangler(**self.session_args)
+            session.connect(device=device, username=username, password=password, port=port)
+            if self.keepalive is not None:
+                # This keeps NAT and firewall state alive underneath us.
+                session.client.get_transport().set_keepalive(self.keepalive)
         except:
-            pass
+            self._discard(key, None)
+            raise
 
-        if "Cisco" in self.identifiers:
-            if "IOS" in self.identifiers:
-                # Apply the config by entering config mode, writing lines, then
-                # leaving config mode.
-                self.send('configure terminal')
-                # Send each line one at a time.
-                for line in config:
-                    self.send(line)
-                self.send('exit')
-            else:
-                raise Exception("Don't know how to apply config on this type of Cisco device!")
-        else:
-            raise Exception("Don't know how to apply config on this vendor yet!")
+        with self.condition:
+            self.in_use[session] = key
+        return session
 
-    def write_config(self):
-        """Write mem or copy run start or whatever.
-        Depending on the device type, this could be quite different."""
+    def _take(self, key, deadline):
+        """Take the most recently used idle session for a key, or make room
+        for a new one. Returns (session, probe), where session is None if
+        the caller should connect a new one."""
 
-        # Make sure we're enabled.
-        if not self.enabled:
-            raise Exception("Called write_config() without being enabled")
-            
-        if "Cisco" in self.identifiers:
-            if "IOS" in self.identifiers:
-                self.send('write memory')
-            elif "Nexus" in self.identifiers:
-                self.send('copy running-config startup-config')
-            elif "ASA" in self.identifiers:
-                self.send('write memory')
-            elif "FWSM" in self.identifiers:
-                self.send('write memory')
-            else:
-                raise Exception("Don't know how to write config on this type of Cisco device!")
-        elif "Fortinet" in self.identifiers:
-            if "FortiGate" in self.identifiers:
-                # FortiGate devices automatically write their config when you
-                # leave edit mode.
-                pass
-            else:
-                raise Exception("Don't know how to write config on this type of Fortinet device!")
-        else:
-            raise Exception("Don't know how to write config on this vendor yet!")
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise Exception("This SessionPool has been closed")
 
-        return True
+                # Reuse the warmest idle session we have for this key.
+                for session in reversed(list(self.idle.keys())):
+                    session_key, released, heard = self.idle[session]
+                    if session_key == key:
+                        del self.idle[session]
+                        probe = self.keepalive is not None and time.time() - heard >= self.keepalive
+                        return session, probe
+
+                if self.counts[key] < self.max_per_device:
+                    self.counts[key] += 1
+                    return None, False
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise Exception("Timed out waiting for a session to %s" % (key[0]))
+                self.condition.wait(remaining)
+
+    def release(self, session, discard=False):
+        """Give a session back to the pool. We get it out of config mode
+        first, and if that doesn't work, or "discard" is True, we close it
+        instead of keeping it."""
 
+        with self.condition:
+            key = self.in_use.pop(session)
+
+        if not discard and not self.closed:
+            try:
+                # FortiOS needs an "end" for every level of config it's in.
+                for attempt in range(5):
+                    if not session.driver.in_config_mode(session.prompt):
+                        break
+                    session.send(session.driver.end_command, graceful=True)
+                discard = session.driver.in_config_mode(session.prompt) or not session.is_alive()
+            except Exception:
+                discard = True
+
+        if discard or self.closed:
+            self._discard(key, session)
+            return
+
+        evicted = []
+        with self.condition:
+            now = time.time()
+            self.idle[session] = [key, now, now]
+            while len(self.idle) > self.max_idle:
+                evicted.append(self.idle.popitem(last=False))
+            self.condition.notify_all()
+
+        for old_session, (old_key, released, heard) in evicted:
+            self._discard(old_key, old_session)
+
+    def _discard(self, key, session):
+        """Close a session and stop counting it against its device."""
+
+        if session is not None:
+            session.close()
+        with self.condition:
+            self.counts[key] -= 1
+            if self.counts[key] <= 0:
+                del self.counts[key]
+            self.condition.notify_all()
+
+    def _keepalive_loop(self):
+        """Every so often, close the sessions that have been idle too long
+        and poke the ones we haven't heard from in a while."""
+
+        interval = self.keepalive / 2.0
+        if self.idle_timeout is not None:
+            interval = min(interval, self.idle_timeout / 2.0)
+
+        while not self.stopping.wait(interval):
+            self.expire()
+            self._ping_idle()
+
+    def expire(self):
+        """Close every session that's been idle longer than idle_timeout."""
+
+        if self.idle_timeout is None:
+            return
+        expired = []
+        with self.condition:
+            now = time.time()
+            for session in list(self.idle.keys()):
+                key, released, heard = self.idle[session]
+                if now - released > self.idle_timeout:
+                    del self.idle[session]
+                    expired.append((key, session))
+        for key, session in expired:
+            self._discard(key, session)
+
+    def _ping_idle(self):
+        """Send a keepalive on each idle session that's due for one. We take
+        it out of the idle list while we do, so nobody acquires it."""
+
+        with self.condition:
+            now = time.time()
+            due = [(session, info) for session, info in self.idle.items() if now - info[2] >= self.keepalive]
+            for session, info in due:
+                del self.idle[session]
+
+        for session, (key, released, heard) in due:
+            if not session.is_alive(probe=True):
+                self._discard(key, session)
+                continue
+            with self.condition:
+                closed = self.closed
+                if not closed:
+                    # Put it back where it was, as far as LRU is concerned.
+                    self.idle[session] = [key, released, time.time()]
+                    for idle_session in sorted(self.idle, key=lambda idle_session: self.idle[idle_session][1]):
+                        self.idle.move_to_end(idle_session)
+                    self.condition.notify_all()
+            if closed:
+                self._discard(key, session)
+
+    def close(self):
+        """Close all the idle sessions and stop the keepalives. Sessions that
+        are handed out get closed when they're released."""
 
+        self.stopping.set()
+        with self.condition:
+            self.closed = True
+            idle = list(self.idle.items())
+            self.idle.clear()
+            self.condition.notify_all()
+        for session, (key, released, heard) in idle:
+            self._discard(key, session)
@@ -0,0 +1,580 @@
+# cliwrangler_bench
+# by Loren Jan Wilson
+#
+# Benchmarks for cliwrangler, run against the fake device in
+# cliwrangler_fakedevice.py, so that we can see what a change does to the
+# hot path without a rack of switches.
+#
+#     python cliwrangler_bench.py --platform ios --latency 0.02
+#
+# The fake device runs in its own process, so it doesn't fight us for the
+# GIL and its memory doesn't show up in ours.
+#
+
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from concurrent import futures
+
+import paramiko
+
+import cliwrangler
+import cliwrangler_fakedevice
+
+
+# All the benchmarks, in the order we run them.
+BENCHMARKS = ['handshake', 'connect', 'send', 'send_parallel', 'apply_config', 'apply_config_diff', 'apply_config_upload',
+              'large_output', 'memory', 'table', 'replay', 'scheduler']
+
+# The biggest known_hosts file we'll time paramiko reading.
+PARAMIKO_KNOWN_HOSTS = 5000
+
+
+class FakeDeviceProcess:
+    """A fake device running in a separate Python process.
+
+    Arguments:
+    platform - The platform to pretend to be.
+    device_args - Options for the fake device, like latency=0.05. These
+                  become command line options, so tech_lines=1000 turns
+                  into --tech-lines 1000.
+    """
+
+    def __init__(self, platform='ios', **device_args):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cliwrangler_fakedevice.py')
+        command = [sys.executable, script, platform]
+        for name, value in sorted(device_args.items()):
+            if value is not None:
+                command.extend(['--%s' % (name.replace('_', '-')), str(value)])
+
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        # The first thing it prints is the port it's listening on.
+        line = self.process.stdout.readline()
+        if not line:
+            raise Exception("The fake device didn't start: %s" % (' '.join(command)))
+        self.port = int(line)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+
+def _summary(samples):
+    """Boil a list of timings (in seconds) down to the numbers we report."""
+
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        'count': count,
+        'min': samples[0],
+        'median': samples[count // 2] if count % 2 else (samples[count // 2 - 1] + samples[count // 2]) / 2.0,
+        'p95': samples[min(count - 1, int(count * 0.95))],
+        'max': samples[-1],
+        'total': sum(samples),
+    }
+
+
+def _connect(port, session_args):
+    session = cliwrangler.CLIWrangler(**session_args)
+    session.connect('127.0.0.1', 'bench', 'bench', port=port)
+    return session
+
+
+def _known_hosts(entries):
+    """Write a known_hosts file with this many hashed entries, like a
+    big shop's, and return its path."""
+
+    key = paramiko.RSAKey.generate(1024)
+    line = ' %s %s\n' % (key.get_name(), key.get_base64())
+    f = tempfile.NamedTemporaryFile('w', suffix='.known_hosts', delete=False)
+    with f:
+        for entry in range(entries):
+            f.write(paramiko.HostKeys.hash_host('10.%d.%d.%d' % (entry >> 16, (entry >> 8) & 255, entry & 255)) + line)
+    return f.name
+
+
+def bench_handshake(port, iterations, session_args, known_hosts=0):
+    """Time the TCP connection, SSH handshake and login of connect(),
+    with whatever ssh_options are in session_args. If "known_hosts" is more
+    than 0, we check host keys against a known_hosts file that big, and
+    also time reading it into the HostKeyStore that all the sessions share,
+    and (if it isn't huge) the way every connect() used to, with paramiko."""
+
+    session_args = dict(session_args)
+    path = None
+    result = {}
+    if known_hosts:
+        path = _known_hosts(known_hosts)
+        # paramiko checks each hashed entry against all the ones before it,
+        # so past a few thousand entries we'd be here all day.
+        if known_hosts <= PARAMIKO_KNOWN_HOSTS:
+            started = time.time()
+            paramiko.HostKeys(path)
+            result['paramiko_load_ms'] = (time.time() - started) * 1000
+        started = time.time()
+        session_args['host_keys'] = cliwrangler.HostKeyStore([path])
+        result['store_load_ms'] = (time.time() - started) * 1000
+
+    samples = []
+    handshakes = []
+    try:
+        for i in range(iterations):
+            session = cliwrangler.CLIWrangler(metrics=cliwrangler.Metrics(), **session_args)
+            session.connect('127.0.0.1', 'bench', 'bench', port=port)
+            timings = session.timings
+            samples.append(timings['tcp'] + timings['handshake'] + timings.get('auth', 0.0))
+            handshakes.append(timings['handshake'])
+            session.close()
+    finally:
+        if path is not None:
+            os.unlink(path)
+
+    result.update(_summary(samples))
+    result['kex_median_ms'] = _summary(handshakes)['median'] * 1000
+    return result
+
+
+def bench_connect(port, iterations, session_args):
+    """Time a whole connect(): handshake, login, prep and identification."""
+
+    samples = []
+    for i in range(iterations):
+        started = time.time()
+        session = _connect(port, session_args)
+        samples.append(time.time() - started)
+        session.close()
+    return _summary(samples)
+
+
+def bench_send(port, iterations, session_args):
+    """Time send() of a small command on one session."""
+
+    session = _connect(port, session_args)
+    samples = []
+    try:
+        for i in range(iterations):
+            started = time.time()
+            session.send('show version')
+            samples.append(time.time() - started)
+    finally:
+        session.close()
+    return _summary(samples)
+
+
+def bench_send_parallel(port, iterations, session_args, commands=8):
+    """Time send_parallel() of a handful of small commands, spread across
+    as many shells as the session will open. The first run opens the
+    shells, so it doesn't count."""
+
+    session = _connect(port, session_args)
+    samples = []
+    try:
+        session.send_parallel(['show version'] * commands)
+        for i in range(iterations):
+            started = time.time()
+            session.send_parallel(['show version'] * commands)
+            samples.append(time.time() - started)
+        shells = 1 + len(session.channels)
+    finally:
+        session.close()
+
+    result = _summary(samples)
+    result['commands'] = commands
+    result['shells'] = shells
+    return result
+
+
+def _bench_config(config_lines):
+    """A block of interface descriptions."""
+
+    config = []
+    for line in range(config_lines // 2):
+        config.append('interface GigabitEthernet1/0/%d' % (1 + line % 24))
+        config.append(' description bench %d' % (line))
+    return config
+
+
+def bench_apply_config(port, iterations, session_args, config_lines=50, upload=None):
+    """Time apply_config() of a block of interface descriptions, typed in
+    or (if "upload" is 'scp' or 'sftp') pushed as a file."""
+
+    config = _bench_config(config_lines)
+    session = _connect(port, session_args)
+    samples = []
+    try:
+        if not session.enabled:
+            session.enable('enable')
+        for i in range(iterations):
+            started = time.time()
+            session.apply_config(config, upload=upload)
+            samples.append(time.time() - started)
+    finally:
+        session.close()
+
+    result = _summary(samples)
+    result['lines'] = len(config)
+    return result
+
+
+def bench_apply_config_diff(port, iterations, session_args, config_lines=50):
+    """Time apply_config(diff=True) of the same block, once it's already in
+    the running config, with one line that's different each time."""
+
+    config = _bench_config(config_lines)
+    session = _connect(port, session_args)
+    samples = []
+    try:
+        if not session.enabled:
+            session.enable('enable')
+        session.apply_config(config, diff=True)
+        for i in range(iterations):
+            config[1] = ' description bench 0 take %d' % (i)
+            started = time.time()
+            changes = session.apply_config(config, diff=True)
+            samples.append(time.time() - started)
+    finally:
+        session.close()
+
+    result = _summary(samples)
+    result['lines'] = len(config)
+    result['commands'] = len(changes.commands)
+    return result
+
+
+def bench_large_output(port, iterations, session_args):
+    """Time send() of a big "show tech-support", and work out the throughput."""
+
+    session = _connect(port, session_args)
+    samples = []
+    size = 0
+    try:
+        for i in range(iterations):
+            started = time.time()
+            size = len(session.send('show tech-support'))
+            samples.append(time.time() - started)
+    finally:
+        session.close()
+
+    result = _summary(samples)
+    result['bytes'] = size
+    result['mb_per_second'] = size / result['median'] / 1e6
+    return result
+
+
+def bench_memory(port, iterations, session_args):
+    """Measure the peak memory we allocate while reading a big "show
+    tech-support" with send(), send_iter() and send() spooled to a file."""
+
+    session = _connect(port, session_args)
+    result = {}
+
+    def measure(name, run):
+        tracemalloc.start()
+        try:
+            run()
+            result[name + '_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        finally:
+            tracemalloc.stop()
+
+    def spool():
+        session.send('show tech-support', spool=True).close()
+
+    try:
+        measure('send', lambda: session.send('show tech-support'))
+        session.output = session.output_raw = None
+        measure('send_iter', lambda: sum(1 for line in session.send_iter('show tech-support')))
+        measure('spool', spool)
+    finally:
+        session.close()
+    return result
+
+
+def _parse_dicts(output, regex, names):
+    """Parse a table the old way, one line at a time into a list of dicts,
+    so that we have something to compare send_table() to."""
+
+    rows = []
+    for line in output.splitlines():
+        match = regex.match(line)
+        if match:
+            rows.append(dict(zip(names, match.groups())))
+    return rows
+
+
+def bench_table(port, iterations, session_args, mac_rows=100000):
+    """Time send_table() of a big MAC address table, and compare parsing it
+    into columns with parsing it into a list of dicts, for time and memory."""
+
+    parser = cliwrangler.IOS_MAC_ADDRESS_TABLE
+    names = [name for name, kind in parser.columns]
+    regex = re.compile(parser.regex.pattern)
+    result = {}
+
+    # First, parse the same output offline, so that the network isn't part
+    # of the numbers.
+    output = cliwrangler_fakedevice.FakeDevice(mac_rows=mac_rows).show_mac_address_table()
+    samples = []
+    for i in range(iterations):
+        started = time.time()
+        table = parser.parse(output)
+        samples.append(time.time() - started)
+    result['parse_ms'] = _summary(samples)['median'] * 1000
+    samples = []
+    for i in range(iterations):
+        started = time.time()
+        rows = _parse_dicts(output, regex, names)
+        samples.append(time.time() - started)
+    result['dicts_ms'] = _summary(samples)['median'] * 1000
+    result['table_mb'] = table.nbytes() / 1e6
+    tracemalloc.start()
+    try:
+        rows = _parse_dicts(output, regex, names)
+        result['dicts_mb'] = tracemalloc.get_traced_memory()[0] / 1e6
+    finally:
+        tracemalloc.stop()
+    del rows
+
+    # Then over SSH, with send_table() against send() and a loop.
+    session = _connect(port, session_args)
+    try:
+        for name, fetch in (('send_table', lambda: session.send_table('mac_address_table')),
+                            ('send', lambda: _parse_dicts(session.send(parser.command), regex, names))):
+            tracemalloc.start()
+            try:
+                started = time.time()
+                fetch()
+                result[name + '_ms'] = (time.time() - started) * 1000
+                result[name + '_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+            finally:
+                tracemalloc.stop()
+            session.output = session.output_raw = None
+    finally:
+        session.close()
+    return result
+
+
+def bench_replay(port, iterations, session_args, replays=1000):
+    """Record a session against the fake device, then replay it: once at
+    the speed it happened, to see how closely we keep time, and "replays"
+    times on a bunch of threads as fast as we can, to see how many sessions
+    one box can play back. The fast ones don't sleep after commands, since
+    there's no device to wait for."""
+
+    commands = ['show version', 'show interfaces status'] * 4
+    f = tempfile.NamedTemporaryFile(suffix='.cwr', delete=False)
+    f.close()
+    result = {}
+
+    def play(replay_args):
+        session = cliwrangler.CLIWrangler(**replay_args)
+        session.connect('127.0.0.1', 'bench', 'bench')
+        for command in commands:
+            session.send(command)
+        session.close()
+
+    try:
+        started = time.time()
+        session = _connect(port, dict(session_args, record=f.name))
+        for command in commands:
+            session.send(command)
+        session.close()
+        result['recorded_s'] = time.time() - started
+        recording = cliwrangler.load_recordings(f.name)[-1]
+        result['recording_kb'] = os.path.getsize(f.name) / 1e3
+
+        started = time.time()
+        play(dict(session_args, replay=recording))
+        result['replayed_s'] = time.time() - started
+
+        fast_args = dict(session_args, replay=recording, replay_speed=None, readiness='none', wait=0)
+        started = time.time()
+        with futures.ThreadPoolExecutor(32) as executor:
+            for done in executor.map(play, [fast_args] * replays):
+                pass
+        elapsed = time.time() - started
+        result['replays'] = replays
+        result['sessions_per_second'] = replays / elapsed
+        result['commands_per_second'] = replays * len(commands) / elapsed
+    finally:
+        os.unlink(f.name)
+    return result
+
+
+def _show_version(session, entry):
+    return session.send('show version')
+
+
+def bench_scheduler(platform, session_args, devices=40, vty_lines=5, aaa_rate=10):
+    """Log into a fake device with only a few VTY lines and a pretend
+    TACACS+ server that can only take so many logins a second, "devices"
+    times at once with run_fleet(): first with nothing holding us back, and
+    then with a ConnectionScheduler. We count how many fail, and how long
+    it all takes."""
+
+    result = {}
+    # paramiko complains loudly about every connection the device hangs up on.
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    for name in ('unscheduled', 'scheduled'):
+        scheduler = None
+        if name == 'scheduled':
+            scheduler = cliwrangler.ConnectionScheduler(max_per_device=vty_lines - 1, login_rate=aaa_rate * 0.8,
+                                                        backoff=0.5)
+        with FakeDeviceProcess(platform, vty_lines=vty_lines, aaa_rate=aaa_rate) as device:
+            inventory = [{'device': '127.0.0.1', 'port': device.port}] * devices
+            started = time.time()
+            results = list(cliwrangler.run_fleet(inventory, _show_version, 'bench', 'bench', workers=devices,
+                                                 session_args=session_args, scheduler=scheduler))
+            result[name + '_s'] = time.time() - started
+            result[name + '_failed'] = sum(1 for fleet_result in results if not fleet_result.ok)
+    result['devices'] = devices
+    result['retried'] = scheduler.retried
+    return result
+
+
+def run(platform='ios', benchmarks=None, iterations=10, latency=0.0, jitter=0.0, tech_lines=100000,
+        config_lines=50, known_hosts=0, mac_rows=100000, replays=1000, session_args=None):
+    """Run some benchmarks and return a dict of results, keyed by benchmark.
+
+    Arguments:
+    platform - The platform for the fake device.
+    benchmarks - A list of benchmark names (see BENCHMARKS), or None for all.
+    iterations - How many times to run each timed benchmark.
+    latency - Seconds of fake network delay per round trip.
+    jitter - Up to this many extra seconds of delay.
+    tech_lines - Lines of "show tech-support" output for the large output
+                 and memory benchmarks.
+    config_lines - Lines of config for the apply_config benchmark.
+    known_hosts - Entries in a known_hosts file for the handshake benchmark.
+    mac_rows - Rows in the MAC address table for the table benchmark.
+    replays - How many sessions the replay benchmark plays back at once.
+    session_args - A dict of keyword arguments for each CLIWrangler().
+    """
+
+    benchmarks = benchmarks or BENCHMARKS
+    session_args = session_args or {}
+    results = {}
+
+    with FakeDeviceProcess(platform, latency=latency, jitter=jitter, tech_lines=tech_lines,
+                           mac_rows=mac_rows) as device:
+        for name in benchmarks:
+            if name == 'handshake':
+                results[name] = bench_handshake(device.port, iterations, session_args, known_hosts)
+            elif name == 'connect':
+                results[name] = bench_connect(device.port, iterations, session_args)
+            elif name == 'send':
+                results[name] = bench_send(device.port, iterations, session_args)
+            elif name == 'send_parallel':
+                results[name] = bench_send_parallel(device.port, iterations, session_args)
+            elif name == 'apply_config':
+                # We only know how to apply config on IOS.
+                if platform not in ('ios', 'iosxe'):
+                    continue
+                results[name] = bench_apply_config(device.port, iterations, session_args, config_lines)
+            elif name == 'apply_config_upload':
+                if platform not in ('ios', 'iosxe', 'nxos', 'asa'):
+                    continue
+                results[name] = bench_apply_config(device.port, iterations, session_args, config_lines, upload='scp')
+            elif name == 'apply_config_diff':
+                if platform not in ('ios', 'iosxe'):
+                    continue
+                results[name] = bench_apply_config_diff(device.port, iterations, session_args, config_lines)
+            elif name == 'large_output':
+                results[name] = bench_large_output(device.port, max(1, iterations // 5), session_args)
+            elif name == 'memory':
+                results[name] = bench_memory(device.port, 1, session_args)
+            elif name == 'table':
+                # The fake device only prints the IOS table format.
+                if platform not in ('ios', 'iosxe'):
+                    continue
+                results[name] = bench_table(device.port, max(1, iterations // 5), session_args, mac_rows)
+            elif name == 'replay':
+                results[name] = bench_replay(device.port, iterations, session_args, replays)
+            elif name == 'scheduler':
+                # This one needs a device of its own, with hardly any VTY lines.
+                results[name] = bench_scheduler(platform, session_args)
+            else:
+                raise Exception("Unknown benchmark: %s" % (name))
+
+    return results
+
+
+def report(results, out=sys.stdout):
+    """Print the results in a table a human can read."""
+
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        result = results[name]
+        if 'median' in result:
+            line = "%-19s n=%-4d min %8.1fms  median %8.1fms  p95 %8.1fms  max %8.1fms" % (
+                name, result['count'], result['min'] * 1000, result['median'] * 1000,
+                result['p95'] * 1000, result['max'] * 1000)
+            if 'mb_per_second' in result:
+                line += "  %.1f MB/s" % (result['mb_per_second'])
+            for key in ('kex_median_ms', 'paramiko_load_ms', 'store_load_ms'):
+                if key in result:
+                    line += "  %s %.1f" % (key, result[key])
+        else:
+            line = "%-19s %s" % (name, '  '.join("%s %.1f" % (key, result[key]) for key in sorted(result)))
+        out.write(line + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark cliwrangler against a fake device.')
+    parser.add_argument('benchmarks', nargs='*', help='The benchmarks to run: %s (default: all).' % (
+        ', '.join(BENCHMARKS)))
+    parser.add_argument('--platform', default='ios', help='The fake device platform (default: ios).')
+    parser.add_argument('--iterations', type=int, default=10, help='Iterations per benchmark.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of fake network delay.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Seconds of extra random delay.')
+    parser.add_argument('--tech-lines', type=int, default=100000, help='Lines of "show tech-support".')
+    parser.add_argument('--config-lines', type=int, default=50, help='Lines of config to apply.')
+    parser.add_argument('--readiness', default='sleep', choices=['sleep', 'adaptive', 'none'])
+    parser.add_argument('--wait', type=float, default=0.2, help='The session "wait" setting.')
+    parser.add_argument('--known-hosts', type=int, default=0, help='Entries in a known_hosts file to check against.')
+    parser.add_argument('--mac-rows', type=int, default=100000, help='Rows in the MAC address table.')
+    parser.add_argument('--replays', type=int, default=1000, help='Sessions to play back at once.')
+    parser.add_argument('--ciphers', help='Ciphers to prefer, separated by commas.')
+    parser.add_argument('--kex', help='Key exchange algorithms to prefer, separated by commas.')
+    parser.add_argument('--macs', help='MACs to prefer, separated by commas.')
+    parser.add_argument('--compress', action='store_true', help='Turn on SSH compression.')
+    parser.add_argument('--no-nodelay', action='store_true', help="Don't set TCP_NODELAY.")
+    parser.add_argument('--window-size', type=int, help='The SSH channel window size.')
+    parser.add_argument('--max-packet-size', type=int, help='The SSH channel maximum packet size.')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args(argv)
+
+    ssh_options = {'compress': args.compress, 'nodelay': not args.no_nodelay,
+                   'window_size': args.window_size, 'max_packet_size': args.max_packet_size}
+    for name in ('ciphers', 'kex', 'macs'):
+        if getattr(args, name):
+            ssh_options[name] = getattr(args, name).split(',')
+
+    results = run(platform=args.platform, benchmarks=args.benchmarks, iterations=args.iterations,
+                  latency=args.latency, jitter=args.jitter, tech_lines=args.tech_lines,
+                  config_lines=args.config_lines, known_hosts=args.known_hosts, mac_rows=args.mac_rows,
+                  replays=args.replays,
+                  session_args={'readiness': args.readiness, 'wait': args.wait, 'ssh_options': ssh_options})
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        report(results)
+
+
+if __name__ == '__main__':
+    main()
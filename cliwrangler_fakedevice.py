@@ -0,0 +1,892 @@
+# cliwrangler_fakedevice
+# by Loren Jan Wilson
+#
+# A fake network device that speaks SSH on the loopback interface, so that
+# we can exercise and benchmark cliwrangler without a rack of switches.
+#
+# Uses paramiko's server-side support.
+#
+# You can also run it by itself, and point cliwrangler (or anything else)
+# at it:
+#
+#     python cliwrangler_fakedevice.py ios --port 2222 --latency 0.05
+#
+
+import paramiko
+import os
+import random
+import socket
+import argparse
+import logging
+import threading
+import collections
+import time
+import sys
+
+
+# paramiko complains about every client that hangs up on us. We don't care.
+logging.getLogger('cliwrangler_fakedevice').addHandler(logging.NullHandler())
+
+
+# Canned "show version" style output for the platforms we pretend to be.
+VERSION_OUTPUT = {
+    'ios': """Cisco IOS Software, C3750 Software (C3750-IPSERVICESK9-M), Version 12.2(55)SE10, RELEASE SOFTWARE (fc2)
+Technical Support: http://www.cisco.com/techsupport
+Copyright (c) 1986-2015 by Cisco Systems, Inc.
+
+ROM: Bootstrap program is C3750 boot loader
+BOOTLDR: C3750 Boot Loader (C3750-HBOOT-M) Version 12.2(44)SE5, RELEASE SOFTWARE (fc1)
+
+%(hostname)s uptime is 1 year, 12 weeks, 3 days, 2 hours, 1 minute
+System returned to ROM by power-on
+System image file is "flash:c3750-ipservicesk9-mz.122-55.SE10.bin"
+
+cisco WS-C3750G-24TS-1U (PowerPC405) processor (revision H0) with 131072K bytes of memory.
+Processor board ID FOC1234X0AB
+24 Gigabit Ethernet interfaces
+
+Model number                    : WS-C3750G-24TS-1U
+System serial number            : FOC1234X0AB
+
+Switch Ports Model              SW Version            SW Image
+------ ----- -----              ----------            ----------
+*    1 28    WS-C3750G-24TS-1U  12.2(55)SE10          C3750-IPSERVICESK9-M
+
+Configuration register is 0xF
+""",
+    'iosxe': """Cisco IOS XE Software, Version 16.09.04
+Cisco IOS Software [Fuji], Catalyst L3 Switch Software (CAT9K_IOSXE), Version 16.9.4, RELEASE SOFTWARE (fc2)
+Technical Support: http://www.cisco.com/techsupport
+Copyright (c) 1986-2019 by Cisco Systems, Inc.
+
+%(hostname)s uptime is 21 weeks, 1 day, 4 hours, 12 minutes
+
+cisco C9300-48P (X86) processor with 1392780K/6147K bytes of memory.
+Processor board ID FCW1234L0AB
+48 Gigabit Ethernet interfaces
+
+Model Number                       : C9300-48P
+System Serial Number               : FCW1234L0AB
+
+Configuration register is 0x102
+""",
+    'nxos': """Cisco Nexus Operating System (NX-OS) Software
+TAC support: http://www.cisco.com/tac
+Copyright (c) 2002-2016, Cisco Systems, Inc. All rights reserved.
+
+Software
+  BIOS:      version 3.6.0
+  kickstart: version 7.0(3)I4(2)
+  system:    version 7.0(3)I4(2)
+
+Hardware
+  cisco Nexus5548 Chassis ("O2 32X10GE/Modular Universal Platform Supervisor")
+  Intel(R) Xeon(R) CPU with 8253860 kB of memory.
+
+  Device name: %(hostname)s
+""",
+    'asa': """
+Cisco Adaptive Security Appliance Software Version 9.1(7)
+Device Manager Version 7.6(1)
+
+Compiled on Fri 05-Feb-16 13:17 PST by builders
+System image file is "disk0:/asa917-k8.bin"
+Config file at boot was "startup-config"
+
+%(hostname)s up 98 days 2 hours
+
+Hardware:   ASA5520, 2048 MB RAM, CPU Pentium 4 Celeron 2000 MHz
+""",
+    'fwsm': """
+FWSM Firewall Version 4.1(15) <context>
+
+Device Manager Version 6.2(1)F
+
+%(hostname)s up 1 year 20 days
+""",
+}
+
+FAILOVER_OUTPUT = {
+    'asa': """Failover On
+Failover unit Primary
+Failover LAN Interface: failover GigabitEthernet0/3 (up)
+  This host: Primary - Active
+  Other host: Secondary - Standby Ready
+""",
+    'fwsm': """Failover On
+Failover unit Primary
+        This context: Active
+        Peer context: Standby Ready
+""",
+}
+
+FORTIOS_STATUS = """Version: FortiGate-1000C v5.2.3,build0670,150318 (GA)
+Virus-DB: 16.00560(2012-10-19 16:45)
+Serial-Number: FG1K0C3912600001
+BIOS version: 04000013
+Log hard disk: Available
+Hostname: %(hostname)s
+Operation Mode: NAT
+Current virtual domain: root
+Max number of virtual domains: 10
+Virtual domains status: 1 in NAT mode, 0 in TP mode
+Virtual domain configuration: %(vdoms)s
+FIPS-CC mode: disable
+Current HA mode: standalone
+System time: Tue Mar 31 10:11:12 2015
+"""
+
+# The SSH version string each platform's server sends, since clients use it
+# as a hint about what they're talking to.
+SERVER_VERSIONS = {
+    'ios': 'SSH-2.0-Cisco-1.25',
+    'iosxe': 'SSH-2.0-Cisco-1.25',
+    'nxos': 'SSH-2.0-OpenSSH_6.2 PKIX FIPS',
+    'asa': 'SSH-2.0-Cisco-1.25',
+    'fwsm': 'SSH-2.0-Cisco-1.25',
+    'fortios': 'SSH-2.0-FortiSSH_3.0',
+}
+
+# The error strings each platform prints when it doesn't like a command.
+CISCO_INVALID = "% Invalid input detected at '^' marker.\n"
+ASA_INVALID = "ERROR: % Invalid input detected at '^' marker.\n"
+FORTIOS_INVALID = "Unknown action 0\nCommand fail. Return code -61\n"
+
+# Top-level config lines that put you into a sub-mode on Cisco devices.
+SECTION_KEYWORDS = ('interface ', 'router ', 'line ', 'vlan ', 'ip access-list ',
+                    'object-group ', 'policy-map ', 'class-map ', 'route-map ')
+
+
+class FakeDevice:
+    """The behavior of one fake device. This holds the platform, the prompt
+    state, the running config and the knobs for output size and latency.
+    A FakeDeviceServer hands each SSH shell its own FakeDevice."""
+
+    def __init__(self, platform='ios', hostname=None, enable_password='enable',
+                 latency=0.0, jitter=0.0, drop_window=0.0, mac_rows=100, tech_lines=1000,
+                 vdoms=True, files=None):
+        self.platform = platform
+        self.hostname = hostname or "fake-%s" % (platform)
+        self.enable_password = enable_password
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_window = drop_window
+        self.mac_rows = mac_rows
+        self.tech_lines = tech_lines
+        self.vdoms = vdoms
+        # The device's flash, as {path: bytes}. Uploads land here.
+        self.files = files if files is not None else {}
+
+        self.enabled = platform in ('nxos', 'fortios')
+        self.paging = True
+        self.mode = []
+        self.running_config = self._initial_config()
+        # The top-level entries by line, so big merges don't crawl.
+        self.config_index = dict((entry[0], entry) for entry in self.running_config)
+        # Every command we've been asked to run, for tests to look at.
+        self.history = []
+        # If we've asked a question (like "Destination filename?"), what to
+        # print instead of the prompt, and what to do with the answer.
+        self.question = None
+        self.answer = None
+
+    def _initial_config(self):
+        """A small, believable running config, stored as a list of
+        [line, [children]] pairs."""
+
+        config = [['hostname %s' % (self.hostname), []],
+                  ['service timestamps log datetime msec', []],
+                  ['ip domain-name example.com', []]]
+        for port in range(1, 25):
+            config.append(['interface GigabitEthernet1/0/%d' % (port),
+                           [' description access port %d' % (port),
+                            ' switchport mode access',
+                            ' switchport access vlan 10']])
+        config.append(['line vty 0 4', [' transport input ssh']])
+        return config
+
+    def prompt(self):
+        """The prompt for the current mode."""
+
+        if self.platform == 'fortios':
+            if self.mode:
+                return "%s (%s) # " % (self.hostname, self.mode[-1])
+            return "%s # " % (self.hostname)
+        end = '#' if self.enabled else '>'
+        if self.mode:
+            return "%s(%s)%s" % (self.hostname, self.mode[-1], end)
+        return "%s%s" % (self.hostname, end)
+
+    def delay(self):
+        """Sleep for one hop of our fake network."""
+
+        pause = self.latency + random.uniform(0, self.jitter)
+        if pause > 0:
+            time.sleep(pause)
+
+    def run(self, line):
+        """Run one line of input and return its output."""
+
+        if self.answer is not None:
+            answer, self.answer, self.question = self.answer, None, None
+            return answer(line.strip())
+
+        command = line.strip()
+        if not command:
+            return ''
+        self.history.append(command)
+        if self.platform == 'fortios':
+            return self._run_fortios(command)
+        if self.mode:
+            return self._run_config(command)
+        return self._run_exec(command)
+
+    def _invalid(self):
+        """The error this platform prints for a command it doesn't know."""
+        if self.platform in ('asa', 'fwsm'):
+            return ASA_INVALID
+        return CISCO_INVALID
+
+    def _run_exec(self, command):
+        """Commands at the exec prompt on Cisco-ish platforms."""
+
+        words = command.split()
+        if command in ('terminal length 0', 'term len 0'):
+            if self.platform in ('asa', 'fwsm'):
+                return self._invalid()
+            self.paging = False
+            return ''
+        if command == 'terminal pager 0':
+            if self.platform not in ('asa', 'fwsm') or not self.enabled:
+                return self._invalid()
+            self.paging = False
+            return ''
+        if command in ('terminal no monitor', 'terminal no editing'):
+            return '' if self.platform in ('ios', 'iosxe', 'nxos') else self._invalid()
+        if command.startswith('show ver'):
+            return VERSION_OUTPUT.get(self.platform, '') % {'hostname': self.hostname}
+        if command == 'show failover':
+            if self.platform in FAILOVER_OUTPUT:
+                return FAILOVER_OUTPUT[self.platform]
+            return self._invalid()
+        if command in ('configure terminal', 'conf t'):
+            if not self.enabled:
+                return self._invalid()
+            self.mode.append('config')
+            return 'Enter configuration commands, one per line.  End with CNTL/Z.\n'
+        if command in ('write memory', 'wr mem', 'copy running-config startup-config'):
+            if not self.enabled:
+                return self._invalid()
+            return 'Building configuration...\n[OK]\n'
+        if command.startswith('show run'):
+            if not self.enabled:
+                return self._invalid()
+            return self.show_running_config()
+        if words[0] == 'copy' and len(words) == 3 and words[2] == 'running-config':
+            if not self.enabled:
+                return self._invalid()
+            return self._copy_to_running_config(words[1])
+        if words[0] == 'delete':
+            if not self.enabled:
+                return self._invalid()
+            paths = [word for word in words[1:] if ':' in word]
+            for path in paths:
+                if path not in self.files:
+                    return "%%Error deleting %s (No such file or directory)\n" % (path)
+                del self.files[path]
+            return ''
+        if command.startswith('show tech'):
+            return ''.join("tech-support line %d: the quick brown fox jumps over the lazy dog\n" % (n)
+                           for n in range(self.tech_lines))
+        if command.startswith('show mac'):
+            return self.show_mac_address_table()
+        if command.startswith('show ip arp'):
+            return self.show_ip_arp()
+        if command.startswith('show int') and command.endswith('status'):
+            return self.show_interfaces_status()
+        if words[0] in ('exit', 'logout', 'quit'):
+            return None
+        return self._invalid()
+
+    def _run_config(self, command):
+        """Commands in configuration mode."""
+
+        if command in ('end', '\x1a'):
+            self.mode = []
+            return ''
+        if command == 'exit':
+            self.mode.pop()
+            return ''
+        if command.startswith('do '):
+            saved, self.mode = self.mode, []
+            try:
+                return self._run_exec(command[3:])
+            finally:
+                self.mode = saved
+
+        if command.startswith(SECTION_KEYWORDS):
+            # Entering a section always brings us back out to global config
+            # first, just like on a real switch.
+            self.mode = ['config', 'config-%s' % (command.split()[0][:2])]
+            self._section = self._config_section(command, create=True)
+            return ''
+
+        if len(self.mode) > 1:
+            children = self._section[1]
+            if command.startswith('no '):
+                target = ' ' + command[3:]
+                self._section[1] = [child for child in children if child != target]
+            elif ' ' + command not in children:
+                children.append(' ' + command)
+            return ''
+
+        if command.startswith('no '):
+            target = command[3:]
+            if target in self.config_index:
+                del self.config_index[target]
+                self.running_config = [entry for entry in self.running_config if entry[0] != target]
+        else:
+            self._config_section(command, create=True)
+        return ''
+
+    def _copy_to_running_config(self, path):
+        """Merge a file from flash into the running config. Everybody but
+        NX-OS asks where you want to copy it to first."""
+
+        if path not in self.files:
+            return "%%Error opening %s (No such file or directory)\n" % (path)
+        if self.platform == 'nxos':
+            return self._merge(path)
+
+        def answer(destination):
+            if destination not in ('', 'running-config'):
+                return self._invalid()
+            return self._merge(path)
+
+        self.question = 'Destination filename [running-config]? '
+        self.answer = answer
+        return ''
+
+    def _merge(self, path):
+        """Run every line of a file as if it were typed in config mode."""
+
+        data = self.files[path]
+        saved, self.mode = self.mode, ['config']
+        output = []
+        try:
+            for line in data.decode('utf-8', 'ignore').splitlines():
+                command = line.strip()
+                if not command or command.startswith('!'):
+                    continue
+                if command == 'end':
+                    break
+                self.history.append(command)
+                output.append(self._run_config(command))
+                if not self.mode:
+                    self.mode = ['config']
+        finally:
+            self.mode = saved
+        output.append('%d bytes copied in 0.052 secs (%d bytes/sec)\n' % (len(data), len(data) * 19))
+        return ''.join(output)
+
+    def _config_section(self, line, create=False):
+        """Find the top-level config entry for a line, or add it."""
+        entry = self.config_index.get(line)
+        if entry is None and create:
+            entry = [line, []]
+            self.running_config.append(entry)
+            self.config_index[line] = entry
+        return entry
+
+    def _run_fortios(self, command):
+        """Commands on our fake FortiGate."""
+
+        if command == 'get system status':
+            return FORTIOS_STATUS % {'hostname': self.hostname, 'vdoms': 'enable' if self.vdoms else 'disable'}
+        if command == 'config global':
+            if not self.vdoms:
+                return FORTIOS_INVALID
+            self.mode.append('global')
+            return ''
+        if command == 'config system console':
+            self.mode.append('console')
+            return ''
+        if command == 'set output standard':
+            if self.mode and self.mode[-1] == 'console':
+                self.paging = False
+                return ''
+            return FORTIOS_INVALID
+        if command == 'end':
+            if self.mode:
+                self.mode.pop()
+            return ''
+        if command in ('exit', 'quit'):
+            return None
+        return FORTIOS_INVALID
+
+    def show_running_config(self):
+        """Our running config, indented the way IOS does it."""
+        lines = ['Building configuration...', '', 'Current configuration : 4096 bytes', '!']
+        for line, children in self.running_config:
+            lines.append(line)
+            lines.extend(children)
+            lines.append('!')
+        lines.append('end')
+        return '\n'.join(lines) + '\n'
+
+    def show_mac_address_table(self):
+        """A MAC address table with mac_rows entries."""
+        lines = ['          Mac Address Table', '-------------------------------------------', '',
+                 'Vlan    Mac Address       Type        Ports', '----    -----------       --------    -----']
+        for row in range(self.mac_rows):
+            mac = '%012x' % (0x001122000000 + row)
+            lines.append('%4d    %s.%s.%s    DYNAMIC     Gi1/0/%d' % (
+                1 + row % 4000, mac[0:4], mac[4:8], mac[8:12], 1 + row % 24))
+        lines.append('Total Mac Addresses for this criterion: %d' % (self.mac_rows))
+        return '\n'.join(lines) + '\n'
+
+    def show_ip_arp(self):
+        """An ARP table with mac_rows entries."""
+        lines = ['Protocol  Address          Age (min)  Hardware Addr   Type   Interface']
+        for row in range(self.mac_rows):
+            mac = '%012x' % (0x001122000000 + row)
+            lines.append('Internet  10.%d.%d.%d %12s   %s.%s.%s  ARPA   Vlan%d' % (
+                (row >> 16) & 255, (row >> 8) & 255, row & 255, str(row % 240) if row % 7 else '-',
+                mac[0:4], mac[4:8], mac[8:12], 10 + row % 10))
+        return '\n'.join(lines) + '\n'
+
+    def show_interfaces_status(self):
+        """A "show interfaces status" for our 24 ports."""
+        lines = ['', 'Port      Name               Status       Vlan       Duplex  Speed Type']
+        for port in range(1, 25):
+            status = 'connected' if port % 3 else 'notconnect'
+            lines.append('%-9s %-18s %-12s %-10s %6s %5s %s' % (
+                'Gi1/0/%d' % (port), 'access port %d' % (port), status, '10',
+                'a-full', 'a-1000', '10/100/1000BaseTX'))
+        return '\n'.join(lines) + '\n'
+
+
+class FakeShell:
+    """A tiny line editor wrapped around a FakeDevice. It echoes keystrokes,
+    handles backspace, pages long output and prints prompts, which is all the
+    interactive behavior cliwrangler cares about."""
+
+    PAGE_LINES = 23
+
+    def __init__(self, channel, device):
+        self.channel = channel
+        self.device = device
+        self.line = ''
+        self.password_prompt = False
+        self.drop_until = 0
+        # Keystrokes we've read but haven't handled yet. Like a real
+        # device, a --More-- prompt takes its key from here first.
+        self.typeahead = []
+
+    def write(self, text):
+        """Send some text, with the line endings a terminal expects."""
+        self.channel.sendall(text.replace('\n', '\r\n').encode('utf-8'))
+
+    def serve(self):
+        """Print a prompt and handle keystrokes until the client leaves."""
+
+        device = self.device
+        device.delay()
+        self.write(device.prompt())
+        try:
+            while True:
+                data = self.channel.recv(4096)
+                if not data:
+                    break
+                if self.feed(data.decode('utf-8', 'ignore')) is False:
+                    break
+        except (socket.error, EOFError):
+            pass
+        finally:
+            try:
+                self.channel.close()
+            except (socket.error, EOFError):
+                pass
+
+    def feed(self, data):
+        """Handle some keystrokes. Returns False if the session is over."""
+
+        device = self.device
+        device.delay()
+        echo = []
+        self.typeahead = list(data)
+        while self.typeahead:
+            char = self.typeahead.pop(0)
+            # Pretend to be IOS-XE, which throws away keystrokes for a
+            # moment after it gets a command.
+            if time.time() < self.drop_until:
+                continue
+            if char in ('\r', '\n'):
+                if echo:
+                    self.write(''.join(echo))
+                    echo = []
+                self.write('\n')
+                if self.execute() is False:
+                    return False
+            elif char in ('\b', '\x7f'):
+                if self.line:
+                    self.line = self.line[:-1]
+                    echo.append('\b \b')
+            elif char >= ' ':
+                self.line += char
+                if not self.password_prompt:
+                    echo.append(char)
+        if echo:
+            self.write(''.join(echo))
+        return True
+
+    def execute(self):
+        """Run the line that was just typed and print the next prompt."""
+
+        device = self.device
+        line, self.line = self.line, ''
+
+        if self.password_prompt:
+            self.password_prompt = False
+            if line == device.enable_password:
+                device.enabled = True
+            else:
+                self.write('% Bad secrets\n\n')
+            self.write(device.prompt())
+            return True
+
+        if line.strip() == 'enable' and device.platform != 'fortios':
+            if device.enabled:
+                self.write(device.prompt())
+            else:
+                self.password_prompt = True
+                self.write('Password: ')
+            return True
+
+        output = device.run(line)
+        if output is None:
+            return False
+        self.page(output)
+        if device.drop_window and line.strip():
+            self.drop_until = time.time() + device.drop_window
+        self.write(device.question or device.prompt())
+        return True
+
+    def page(self, output):
+        """Send output, stopping at a --More-- prompt every screenful if
+        paging is still turned on."""
+
+        lines = output.splitlines(True)
+        if not self.device.paging or len(lines) <= self.PAGE_LINES:
+            self.write(output)
+            return
+
+        start = 0
+        while start < len(lines):
+            self.write(''.join(lines[start:start + self.PAGE_LINES]))
+            start += self.PAGE_LINES
+            if start >= len(lines):
+                break
+            self.write(' --More-- ')
+            if self.typeahead:
+                key = self.typeahead.pop(0)
+            else:
+                key = self.channel.recv(1).decode('utf-8', 'ignore')
+            self.write('\b' * 10 + ' ' * 10 + '\b' * 10)
+            if key != ' ':
+                break
+
+
+class _FakeServerInterface(paramiko.ServerInterface):
+    """The paramiko side of the house: who may log in and what they get."""
+
+    def __init__(self, server):
+        self.server = server
+        self.shell_requested = threading.Event()
+        # How many shells are open on this connection.
+        self.shells = 0
+        self.lock = threading.Lock()
+
+    def check_auth_password(self, username, password):
+        if not self.server._aaa_answers():
+            return paramiko.AUTH_FAILED
+        if self.server.username in (None, username) and self.server.password in (None, password):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_shell_request(self, channel):
+        # Like a real device, we only allow so many shells per connection.
+        with self.lock:
+            if self.server.max_sessions is not None and self.shells >= self.server.max_sessions:
+                return False
+            self.shells += 1
+        thread = threading.Thread(target=self.server._run_shell, args=(channel, self))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        # The only thing we'll exec is the receiving end of an SCP upload.
+        words = command.decode('utf-8', 'ignore').split()
+        if len(words) != 3 or words[:2] != ['scp', '-t']:
+            return False
+        thread = threading.Thread(target=self.server._run_scp, args=(channel, words[2]))
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class _FakeSFTPHandle(paramiko.SFTPHandle):
+    """A file being uploaded over SFTP. It lands in flash when it's closed."""
+
+    def __init__(self, server, path, flags=0):
+        paramiko.SFTPHandle.__init__(self, flags)
+        self.server = server
+        self.path = path
+        self.chunks = {}
+
+    def write(self, offset, data):
+        self.chunks[offset] = data
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.server.files[self.path] = b''.join(self.chunks[offset] for offset in sorted(self.chunks))
+        paramiko.SFTPHandle.close(self)
+
+
+class _FakeSFTPInterface(paramiko.SFTPServerInterface):
+    """Just enough of an SFTP server to upload files to flash."""
+
+    def __init__(self, server_interface, server):
+        paramiko.SFTPServerInterface.__init__(self, server_interface)
+        self.server = server
+
+    def open(self, path, flags, attr):
+        if not flags & (os.O_WRONLY | os.O_RDWR):
+            return paramiko.SFTP_OP_UNSUPPORTED
+        return _FakeSFTPHandle(self.server, path, flags)
+
+
+class FakeDeviceServer:
+    """An SSH server on the loopback interface that pretends to be a network
+    device. Every login gets a fresh FakeDevice built from the keyword
+    arguments given here.
+
+    Arguments:
+    platform - One of 'ios', 'iosxe', 'nxos', 'asa', 'fwsm' or 'fortios'.
+    port - The TCP port to listen on. The default of 0 picks a free one.
+    username - The username to accept, or None for any.
+    password - The password to accept, or None for any.
+    host_key - A paramiko key to use as the host key. We generate one if not given.
+    max_sessions - How many shells one SSH connection can have open at
+                   once, or None for no limit.
+    vty_lines - How many SSH connections we take at once, or None for no
+                limit. Like a switch that's out of VTY lines, we hang up
+                on any more.
+    aaa_rate - How many logins per second our pretend TACACS+ server can
+               handle, or None for no limit. Any more than that get turned
+               down, even with the right password.
+    device_args - Anything else is passed to FakeDevice (latency, jitter, etc).
+    """
+
+    def __init__(self, platform='ios', port=0, username=None, password=None, host_key=None, max_sessions=None,
+                 vty_lines=None, aaa_rate=None, **device_args):
+        self.platform = platform
+        self.max_sessions = max_sessions
+        self.vty_lines = vty_lines
+        self.aaa_rate = aaa_rate
+        self.username = username
+        self.password = password
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
+        self.device_args = device_args
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.socket.listen(128)
+        self.host, self.port = self.socket.getsockname()
+
+        self.transports = []
+        # The files on the device's flash, as {path: bytes}. Every
+        # connection sees the same ones.
+        self.files = {}
+        # The FakeDevice behind each connection, in order.
+        self.devices = []
+        self.thread = None
+        self.running = False
+
+        # When the last second's worth of logins happened, and how many
+        # connections and logins we've turned away.
+        self.logins = collections.deque()
+        self.aaa_lock = threading.Lock()
+        self.dropped = 0
+        self.rejected = 0
+        self.most_connections = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        """Start accepting connections in a background thread."""
+
+        self.running = True
+        self.thread = threading.Thread(target=self._accept_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop accepting connections and drop everyone who's logged in."""
+
+        self.running = False
+        try:
+            self.socket.close()
+        except socket.error:
+            pass
+        for transport in self.transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, address = self.socket.accept()
+            except socket.error:
+                break
+            # Network delay is what "latency" is for. We don't want Nagle's
+            # algorithm adding some of its own.
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # Out of VTY lines? Hang up, like a real switch does.
+            self.transports = [transport for transport in self.transports if transport.is_active()]
+            if self.vty_lines is not None and len(self.transports) >= self.vty_lines:
+                self.dropped += 1
+                client.close()
+                continue
+            self.most_connections = max(self.most_connections, len(self.transports) + 1)
+
+            transport = paramiko.Transport(client)
+            transport.set_log_channel('cliwrangler_fakedevice.transport')
+            transport.add_server_key(self.host_key)
+            if self.platform in SERVER_VERSIONS:
+                transport.local_version = SERVER_VERSIONS[self.platform]
+            transport.set_subsystem_handler('sftp', paramiko.SFTPServer, _FakeSFTPInterface, self)
+            self.transports.append(transport)
+            try:
+                transport.start_server(server=_FakeServerInterface(self))
+            except (paramiko.SSHException, EOFError, socket.error):
+                continue
+
+    def _aaa_answers(self):
+        """Whether our pretend TACACS+ server has time for another login."""
+
+        if self.aaa_rate is None:
+            return True
+        with self.aaa_lock:
+            now = time.time()
+            while self.logins and self.logins[0] <= now - 1.0:
+                self.logins.popleft()
+            if len(self.logins) >= self.aaa_rate:
+                self.rejected += 1
+                return False
+            self.logins.append(now)
+            return True
+
+    def _run_shell(self, channel, interface):
+        """Give a new shell its own FakeDevice."""
+        device = FakeDevice(platform=self.platform, files=self.files, **self.device_args)
+        self.devices.append(device)
+        try:
+            FakeShell(channel, device).serve()
+        finally:
+            with interface.lock:
+                interface.shells -= 1
+
+    def _run_scp(self, channel, path):
+        """Be the receiving end of "scp -t <path>", which means answering
+        each step with a zero byte, and keeping the file we get."""
+
+        try:
+            channel.sendall(b'\x00')
+            header = b''
+            while not header.endswith(b'\n'):
+                char = channel.recv(1)
+                if not char:
+                    return
+                header += char
+            # This looks like "C0644 <size> <name>".
+            size = int(header.split()[1])
+            channel.sendall(b'\x00')
+
+            chunks = []
+            left = size + 1
+            while left:
+                chunk = channel.recv(min(left, 65536))
+                if not chunk:
+                    return
+                chunks.append(chunk)
+                left -= len(chunk)
+            self.files[path] = b''.join(chunks)[:size]
+            channel.sendall(b'\x00')
+            channel.send_exit_status(0)
+        except (socket.error, EOFError, ValueError, IndexError):
+            pass
+        finally:
+            channel.close()
+
+
+def main(argv=None):
+    """Run a fake device until we're interrupted. We print the port we're
+    listening on first thing, so a script that starts us can find us."""
+
+    parser = argparse.ArgumentParser(description='Run a fake network device SSH server on 127.0.0.1.')
+    parser.add_argument('platform', nargs='?', default='ios',
+                        choices=['ios', 'iosxe', 'nxos', 'asa', 'fwsm', 'fortios'])
+    parser.add_argument('--port', type=int, default=0, help='The port to listen on (default: any free one).')
+    parser.add_argument('--username', help='The only username to accept.')
+    parser.add_argument('--password', help='The only password to accept.')
+    parser.add_argument('--hostname', help='The device hostname.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds of delay per round trip.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds of delay.')
+    parser.add_argument('--drop-window', type=float, default=0.0,
+                        help='Throw away keystrokes for this long after a command, like IOS-XE.')
+    parser.add_argument('--tech-lines', type=int, default=1000, help='Lines of "show tech-support" output.')
+    parser.add_argument('--mac-rows', type=int, default=100, help='Rows in the MAC and ARP tables.')
+    parser.add_argument('--max-sessions', type=int, help='Shells allowed per SSH connection (default: no limit).')
+    parser.add_argument('--vty-lines', type=int, help='SSH connections allowed at once (default: no limit).')
+    parser.add_argument('--aaa-rate', type=int, help='Logins per second before we turn them down (default: no limit).')
+    args = parser.parse_args(argv)
+
+    server = FakeDeviceServer(args.platform, port=args.port, username=args.username, password=args.password,
+                              max_sessions=args.max_sessions, vty_lines=args.vty_lines, aaa_rate=args.aaa_rate,
+                              hostname=args.hostname, latency=args.latency, jitter=args.jitter,
+                              drop_window=args.drop_window, tech_lines=args.tech_lines, mac_rows=args.mac_rows)
+    server.start()
+    print(server.port)
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
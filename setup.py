@@ -9,10 +9,14 @@ setup(
     author_email='lorenjanwilson@gmail.com',
     description='A python library for interacting with Cisco switches and other network devices via the CLI.',
     platforms='Posix',
-    py_modules=['cliwrangler'],
+    py_modules=['cliwrangler', 'cliwrangler_fakedevice', 'cliwrangler_bench'],
     install_requires=[
         'paramiko >= 1.10.1',
         'paramiko-expect >= 0.2',
         'pyyaml >= 3.0'
     ],
+    extras_require={
+        'async': ['asyncssh >= 2.0'],
+        'numpy': ['numpy'],
+    },
 )
@@ -0,0 +1,1106 @@
+# test_cliwrangler
+#
+# Tests for cliwrangler, run against the fake devices in
+# cliwrangler_fakedevice, so no switches are harmed. Run them with:
+#
+#     python -m pytest -q
+#
+
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+
+import paramiko
+import pytest
+import yaml
+
+import cliwrangler
+from cliwrangler_fakedevice import FakeDeviceServer
+
+
+# Making a host key is the slowest part of starting a fake device, so every
+# fake device gets the same one. A small one is fine for the loopback.
+HOST_KEY = paramiko.RSAKey.generate(1024)
+
+# The fake devices answer right away, so there's no point waiting around
+# after every command.
+SESSION_ARGS = {'wait': 0.01, 'timeout': 10}
+
+
+@pytest.fixture
+def host_keys():
+    """A HostKeyStore of our own, so we don't go reading (or remembering
+    the fake devices in) the real ~/.ssh/known_hosts."""
+    return cliwrangler.HostKeyStore([])
+
+
+def fake_device(platform='ios', **kwargs):
+    return FakeDeviceServer(platform, host_key=HOST_KEY, **kwargs)
+
+
+def connect(server, host_keys, **kwargs):
+    """Connect a CLIWrangler to a fake device."""
+
+    args = dict(SESSION_ARGS, host_keys=host_keys)
+    args.update(kwargs)
+    session = cliwrangler.CLIWrangler(**args)
+    session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+    return session
+
+
+def without_echo(output):
+    """A command's output minus the line with the command echo, which
+    can start with leftover backspaces from the unique string trick."""
+    if output is None:
+        return None
+    return output.split('\n', 1)[1]
+
+
+def known_hosts(tmp_path, server, key):
+    """Write a known_hosts file that says the fake device has this key."""
+
+    path = tmp_path / 'known_hosts'
+    path.write_text('[127.0.0.1]:%d %s %s\n' % (server.port, key.get_name(), key.get_base64()))
+    return cliwrangler.HostKeyStore([str(path)])
+
+
+asyncssh_only = pytest.mark.skipif(cliwrangler.asyncssh is None, reason="needs asyncssh")
+
+
+async def async_connect(server, store):
+    """Connect an AsyncCLIWrangler to a fake device."""
+
+    session = cliwrangler.AsyncCLIWrangler(host_keys=store, **SESSION_ARGS)
+    try:
+        await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+    except:
+        await session.close()
+        raise
+    return session
+
+
+# run_fleet()
+
+def show_version(session, entry):
+    return session.send('show version')
+
+
+def test_run_fleet(host_keys):
+    session_args = dict(SESSION_ARGS, host_keys=host_keys)
+
+    with fake_device() as ios, fake_device('nxos') as nxos, fake_device(password='right') as locked:
+        inventory = [{'device': '127.0.0.1', 'port': ios.port, 'site': 'east'},
+                     {'device': '127.0.0.1', 'port': nxos.port},
+                     {'device': '127.0.0.1', 'port': locked.port, 'password': 'wrong'},
+                     {'host': '127.0.0.1'}]
+        results = list(cliwrangler.run_fleet(inventory, show_version, username='cisco', password='sekrit',
+                                             workers=2, session_args=session_args))
+
+    assert len(results) == 4
+    results = dict((result.entry.get('port'), result) for result in results)
+
+    assert results[nxos.port].ok
+    assert 'NX-OS' in results[nxos.port].identifiers
+    assert 'Cisco Nexus Operating System' in results[nxos.port].result
+    assert results[ios.port].entry['site'] == 'east'
+    assert results[ios.port].job_time is not None
+
+    # A bad password or a bad inventory entry is that device's problem, and
+    # the rest of the run carries on.
+    assert results[locked.port].error_type == 'AuthenticationException'
+    assert results[locked.port].result is None
+    assert not results[None].ok
+    assert "no 'device' key" in results[None].error
+
+
+# apply_config(diff=True)
+
+def test_apply_config_diff_only_sends_missing_lines(host_keys):
+    config = ['hostname fake-ios',
+              'interface GigabitEthernet1/0/1',
+              ' description access port 1',
+              ' description CHANGED',
+              'ip domain-name example.com']
+
+    with fake_device() as server:
+        session = connect(server, host_keys)
+        session.enable('enable')
+
+        changes = session.apply_config(config, diff=True)
+        assert changes.commands == ['interface GigabitEthernet1/0/1', ' description CHANGED']
+        assert changes.applied == [' description CHANGED']
+        assert changes.sent
+        assert ' description CHANGED' in server.devices[-1].show_running_config()
+
+        # The second time around, there's nothing missing, so we don't even
+        # go into config mode.
+        history = list(server.devices[-1].history)
+        changes = session.apply_config(config, diff=True)
+        assert changes.commands == []
+        assert not changes.sent
+        assert server.devices[-1].history[len(history):] == ['show running-config']
+        session.close()
+
+
+def test_apply_config_diff_by_upload_cleans_up(host_keys):
+    with fake_device() as server:
+        session = connect(server, host_keys)
+        session.enable('enable')
+
+        changes = session.apply_config(['interface GigabitEthernet1/0/2', ' shutdown'], diff=True, upload='scp')
+        assert changes.commands == ['interface GigabitEthernet1/0/2', ' shutdown']
+        assert ' shutdown' in server.devices[-1].show_running_config()
+        # The file we merged from is gone again.
+        assert server.files == {}
+        session.close()
+
+
+# readiness
+
+def test_adaptive_readiness_learns_how_long_to_wait(host_keys):
+    # This IOS-XE throws away keystrokes for 20ms after every command.
+    with fake_device('iosxe', drop_window=0.02) as server:
+        session = connect(server, host_keys, readiness='adaptive', wait=0.5)
+        expected = without_echo(session.send('show version'))
+
+        retyped = []
+        for i in range(15):
+            assert without_echo(session.send('show version')) == expected
+            retyped.append(session.unique_strings_sent > 1)
+        # It had to type the unique string again at first, but it learned
+        # to wait long enough, and no longer than "wait". Since it shaves a
+        # little off the settle time after every command that went through,
+        # it can end up right at the edge of the window and get one more
+        # wrong, but then it doubles the settle time again.
+        assert retyped[0] and not all(retyped)
+        assert sum(retyped[retyped.index(False):]) <= 1
+        assert 0.01 <= session.readiness.settle <= 0.5
+        session.close()
+
+
+def test_adaptive_readiness_doesnt_wait_on_ios(host_keys):
+    with fake_device() as server:
+        session = connect(server, host_keys, readiness='adaptive', wait=0.5)
+        assert not session.readiness.needs_echo(session.identifiers)
+        started = time.time()
+        session.send('show version')
+        assert time.time() - started < 0.5
+        assert session.readiness.drops == 0
+        session.close()
+
+
+def test_readiness_modes():
+    with pytest.raises(Exception, match='Unknown readiness mode'):
+        cliwrangler._Readiness('eventually', 0.2)
+
+    assert cliwrangler._Readiness('sleep', 0.2).settle_time(True) == 0.2
+    assert cliwrangler._Readiness('none', 0.2).settle_time(True) == 0
+
+    readiness = cliwrangler._Readiness('adaptive', 0.2)
+    # We don't know what the device is yet, so it might be IOS-XE.
+    assert readiness.needs_echo([])
+    assert not readiness.needs_echo(['Cisco', 'NX-OS'])
+    readiness.observe(0.01)
+    for i in range(10):
+        readiness.dropped()
+    assert readiness.settle == 0.2
+    readiness.delivered()
+    assert readiness.settle < 0.2
+    # If the echo never came, don't wait on top of that.
+    assert readiness.settle_time(False) == 0
+
+
+# _PromptMatcher
+
+def naive_match(regexes, output, suffix):
+    """What paramiko-expect does: split up the whole output every time, and
+    try the regexes on the last line."""
+
+    line = output.split('\n')[-1]
+    if len(line) > cliwrangler._PromptMatcher.WINDOW or not line.endswith(suffix or ''):
+        return None
+    for index, regex in enumerate(regexes):
+        if re.match('(?:%s)$' % (regex), line, re.DOTALL):
+            return index
+    return None
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_prompt_matcher_agrees_with_splitting_everything(seed):
+    rng = random.Random(seed)
+    regexes = cliwrangler._expect_regexes('fake-ios')
+    unique = cliwrangler.UNIQUE_STRING
+    lines = ['Internet  10.0.0.%d  0011.2200.%04x  ARPA' % (n, n) for n in range(200)]
+    # A line too long to be a prompt, a line that only looks like one, and
+    # the real thing.
+    lines[50] = 'x' * 3000
+    lines[100] = 'fake-ios#show version ' + unique
+    output = '\n'.join(lines) + '\nfake-ios#' + unique
+
+    for suffix in (None, unique):
+        matcher = cliwrangler._PromptMatcher(regexes, suffix)
+        fed = ''
+        while len(fed) < len(output):
+            chunk = output[len(fed):len(fed) + rng.randint(1, 700)]
+            fed += chunk
+            matcher.feed(chunk)
+            assert matcher.match() == naive_match(regexes, fed, suffix)
+        assert matcher.index == 0
+        assert matcher.line == 'fake-ios#' + unique
+
+
+def test_send_big_output(host_keys):
+    with fake_device(tech_lines=20000) as server:
+        session = connect(server, host_keys)
+        output = session.send('show tech-support')
+        assert len(output.split('\n')) > 20000
+        assert session.prompt == 'fake-ios>'
+        session.close()
+
+
+# send_iter()
+
+def test_send_iter_yields_clean_lines(host_keys):
+    with fake_device(tech_lines=500) as server:
+        session = connect(server, host_keys)
+        expected = without_echo(session.send('show tech-support')).split('\n')[:-1]
+        assert list(session.send_iter('show tech-support')) == expected
+        assert session.output is None
+
+        # Stopping early still leaves us at the prompt.
+        lines = session.send_iter('show tech-support')
+        next(lines)
+        lines.close()
+        assert session.send('show version')
+
+        with pytest.raises(Exception, match='Found error string'):
+            list(session.send_iter('show failover'))
+        assert list(session.send_iter('show failover', graceful=True)) == []
+        assert session.prompt == 'fake-ios>'
+        session.close()
+
+
+@asyncssh_only
+def test_async_send_iter(host_keys):
+    async def run(server):
+        async with await async_connect(server, host_keys) as session:
+            expected = without_echo(await session.send('show tech-support')).split('\n')[:-1]
+            assert [line async for line in session.send_iter('show tech-support')] == expected
+            with pytest.raises(Exception, match='Found error string'):
+                [line async for line in session.send_iter('show failover')]
+            assert session.prompt == 'fake-ios>'
+
+    with fake_device(tech_lines=500) as server:
+        asyncio.run(run(server))
+
+
+# send(spool=...)
+
+def test_spooled_send_matches_send(host_keys, tmp_path):
+    with fake_device(tech_lines=2000) as server:
+        session = connect(server, host_keys)
+        expected = session.send('show tech-support')
+
+        path = str(tmp_path / 'tech.txt')
+        with session.send('show tech-support', spool=path) as spooled:
+            assert spooled.read() == expected
+            assert spooled.size == len(expected.encode('utf-8'))
+            lines = expected.splitlines()
+            assert len(spooled) == len(lines)
+            assert spooled[0] == lines[0] and spooled[-1] == lines[-1]
+            assert spooled[10:13] == lines[10:13]
+            assert list(spooled) == lines
+            assert lines[1000] in spooled
+            assert list(spooled.grep('line 199[0-9]:')) == [line for line in lines if re.search('line 199[0-9]:', line)]
+        with open(path) as f:
+            assert f.read() == expected
+
+        # A temporary file goes away when we're done with it.
+        spooled = session.send('show version', spool=True)
+        assert 'Cisco IOS Software' in spooled
+        assert session.output is spooled
+        spooled.close()
+        assert not os.path.exists(spooled.path)
+
+        # A failed command still leaves its output behind for "graceful".
+        assert session.send('show failover', spool=True, graceful=True) is None
+        assert 'Invalid input' in session.output
+        session.output.close()
+        session.close()
+
+
+# ProfileCache
+
+def test_profile_cache_skips_identification(host_keys, tmp_path):
+    cache = cliwrangler.ProfileCache(str(tmp_path / 'profiles.json'))
+    fingerprint = cliwrangler._host_key_fingerprint(HOST_KEY.asbytes())
+
+    def connect_and_list(server):
+        session = connect(server, host_keys, profile_cache=cache)
+        history = list(server.devices[-1].history)
+        session.close()
+        return session, history
+
+    with fake_device() as server:
+        first, history = connect_and_list(server)
+        assert 'show version' in history
+        profile = cache.get('127.0.0.1', server.port, fingerprint)
+        assert profile['identifiers'] == ['Cisco', 'IOS', 'C3750']
+        assert profile['prepare'] == first.prepare_commands
+
+        # Next time, we only send the prep commands that worked.
+        second, history = connect_and_list(server)
+        assert history == first.prepare_commands
+        assert second.identifiers == first.identifiers
+        assert second.facts == first.facts
+        assert second.prompt_prefix == 'fake-ios'
+
+        # If the prompt doesn't look like it did, it's not the same device.
+        cache.put('127.0.0.1', server.port, fingerprint, ['Cisco', 'NX-OS'], 'other-switch', ['terminal length 0'])
+        third, history = connect_and_list(server)
+        assert 'show version' in history
+        assert third.identifiers == first.identifiers
+
+        cache.invalidate('127.0.0.1')
+        assert 'show version' in connect_and_list(server)[1]
+
+    # An expired profile doesn't count either.
+    with fake_device() as server:
+        cache = cliwrangler.ProfileCache(str(tmp_path / 'profiles.json'), ttl=0)
+        connect_and_list(server)
+        assert 'show version' in connect_and_list(server)[1]
+
+
+@asyncssh_only
+def test_async_profile_cache(host_keys, tmp_path):
+    cache = cliwrangler.ProfileCache(str(tmp_path / 'profiles.json'))
+
+    async def run(server):
+        for i in range(2):
+            session = cliwrangler.AsyncCLIWrangler(host_keys=host_keys, profile_cache=cache, **SESSION_ARGS)
+            await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+            await session.close()
+        return session
+
+    with fake_device('nxos') as server:
+        session = asyncio.run(run(server))
+        assert 'Nexus' in session.identifiers
+        assert 'show version' not in server.devices[-1].history
+        # A CLIWrangler can use what the AsyncCLIWrangler learned.
+        connect(server, host_keys, profile_cache=cache).close()
+        assert server.devices[-1].history == session.prepare_commands
+
+
+# Metrics
+
+def test_metrics(host_keys):
+    metrics = cliwrangler.Metrics()
+    events = []
+    metrics.add_callback(events.append)
+
+    with fake_device(tech_lines=2000) as server:
+        session = connect(server, host_keys, metrics=metrics)
+        output = session.send('show tech-support')
+        session.close()
+
+    for phase in ('tcp', 'handshake', 'auth', 'shell', 'identify', 'prepare', 'wait', 'expect'):
+        assert phase in session.timings
+    timing = session.command_timing
+    assert timing['command'] == 'show tech-support'
+    # We read the output, the prompt and our unique string.
+    assert timing['bytes'] > len(output)
+    assert timing['reads'] >= 1
+    assert 0 <= timing['ttfb'] <= timing['seconds']
+    assert abs(timing['wait'] + timing['expect'] - timing['seconds']) < 1e-6
+
+    commands = [event for event in events if event['type'] == 'command']
+    assert [event['command'] for event in commands][-1] == 'show tech-support'
+    data = metrics.as_dict()
+    assert data['counters']['commands'] == len(commands)
+    assert data['phase_seconds']['handshake']['count'] == 1
+    assert 'cliwrangler_phase_seconds_bucket{phase="tcp",le="60.0"} 1' in metrics.to_prometheus()
+    assert json.loads(metrics.to_json()) == data
+
+
+@asyncssh_only
+def test_async_metrics(host_keys):
+    metrics = cliwrangler.Metrics()
+
+    async def run(server):
+        session = cliwrangler.AsyncCLIWrangler(host_keys=host_keys, metrics=metrics, **SESSION_ARGS)
+        await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+        await session.send('show version')
+        await session.send_batch(['show version', 'show ip arp'])
+        await session.close()
+        return session
+
+    with fake_device() as server:
+        session = asyncio.run(run(server))
+
+    for phase in ('handshake', 'shell', 'identify', 'prepare', 'wait', 'expect'):
+        assert phase in session.timings
+    assert session.command_timing['command'] == 'show version\nshow ip arp'
+    assert session.command_timing['bytes'] > 0
+    assert metrics.as_dict()['counters']['commands'] >= 2
+
+
+# Prep
+
+@pytest.mark.parametrize('vdoms', [True, False])
+def test_fortigate_prep_gets_back_to_the_top(vdoms, host_keys, tmp_path):
+    cache = cliwrangler.ProfileCache(str(tmp_path / 'profiles.json'))
+
+    with fake_device('fortios', vdoms=vdoms) as server:
+        # The second time around, the prep comes from the profile.
+        for i in range(2):
+            session = connect(server, host_keys, profile_cache=cache)
+            assert server.devices[-1].mode == []
+            assert not server.devices[-1].paging
+            assert session.prompt == 'fake-fortios # '
+            if vdoms:
+                assert session.prepare_commands == ['config global', 'config system console', 'set output standard',
+                                                    'end', 'end']
+            session.close()
+
+
+@asyncssh_only
+def test_async_fortigate_prep_gets_back_to_the_top(host_keys):
+    async def run(server):
+        async with await async_connect(server, host_keys) as session:
+            return session.prompt
+
+    with fake_device('fortios') as server:
+        assert asyncio.run(run(server)) == 'fake-fortios # '
+        assert server.devices[-1].mode == []
+
+
+# check_ha_status()
+
+@pytest.mark.parametrize('platform', ['asa', 'fwsm', 'fortios', 'nxos'])
+def test_check_ha_status(platform, host_keys):
+    with fake_device(platform) as server:
+        session = connect(server, host_keys)
+        if platform in ('asa', 'fwsm'):
+            session.enable('enable')
+        # The firewalls are the active ones, and a Nexus is always fair game.
+        assert session.check_ha_status() is True
+        assert session.changeable is True
+        session.close()
+
+
+@pytest.mark.parametrize('identifiers, expected', [
+    (['Cisco'], True),
+    (['Cisco', 'C3750'], True),
+    (['Juniper'], None),
+])
+def test_check_ha_status_without_a_platform(identifiers, expected, host_keys):
+    # Before we had drivers, anything that said "Cisco" got a green light,
+    # even if we couldn't tell which Cisco platform it was.
+    with fake_device('ios') as server:
+        session = connect(server, host_keys)
+        session.identifiers = identifiers
+        session.driver = cliwrangler.find_driver(identifiers)
+        assert session.check_ha_status() is expected
+        assert session.changeable is expected
+        session.close()
+
+
+@asyncssh_only
+def test_async_check_ha_status(host_keys):
+    async def run(server):
+        async with await async_connect(server, host_keys) as session:
+            await session.enable('enable')
+            return await session.check_ha_status()
+
+    with fake_device('asa') as server:
+        assert asyncio.run(run(server)) is True
+
+
+# IdentificationCatalog
+
+def naive_scan(entries, output):
+    """What we did before the catalog: look for every string on its own,
+    and throw out the matches that are part of a bigger word."""
+
+    def word(char):
+        return char.isalnum() or char == '_'
+
+    identifiers = []
+    facts = {}
+    lengths = {}
+    for entry in entries:
+        string = entry['match']
+        start = output.find(string)
+        while start != -1:
+            end = start + len(string)
+            if entry.get('partial') or not (
+                    (start > 0 and word(string[0]) and word(output[start - 1]))
+                    or (end < len(output) and word(string[-1]) and word(output[end]))):
+                break
+            start = output.find(string, start + 1)
+        if start == -1:
+            continue
+
+        for identifier in entry.get('identifiers') or []:
+            if identifier not in identifiers:
+                identifiers.append(identifier)
+        entry_facts = dict((key, value) for key, value in entry.items()
+                           if key not in cliwrangler.IdentificationCatalog.RESERVED_KEYS)
+        if entry.get('regex'):
+            m = re.compile(entry['regex']).match(output, start)
+            if m is not None:
+                entry_facts.update((key, value) for key, value in m.groupdict().items() if value is not None)
+        for key, value in entry_facts.items():
+            if len(string) > lengths.get(key, -1):
+                facts[key] = value
+                lengths[key] = len(string)
+    return identifiers, facts
+
+
+@pytest.mark.parametrize('platform', ['ios', 'iosxe', 'nxos', 'asa', 'fwsm', 'fortios'])
+def test_identification_catalog_agrees_with_a_naive_scan(platform, host_keys):
+    entries = yaml.safe_load(cliwrangler.IDENTIFICATION_CATALOG)
+    catalog = cliwrangler.IdentificationCatalog(entries)
+    with fake_device(platform) as server:
+        session = connect(server, host_keys)
+        output = session.identify_output
+        session.close()
+    assert catalog.scan(output) == naive_scan(entries, output)
+    assert catalog.scan(output)[0] == session.identifiers
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_identification_catalog_overlapping_strings(seed):
+    # Lots of strings that are prefixes and suffixes of each other, in text
+    # made of the same few letters, to give the failure links a workout.
+    rng = random.Random(seed)
+    entries = []
+    for n in range(40):
+        string = ''.join(rng.choice('ab-') for _ in range(rng.randint(1, 5)))
+        entry = {'match': string, 'identifiers': ['id%d' % (rng.randint(0, 9))],
+                 'size': str(len(string))}
+        if rng.random() < 0.3:
+            entry['partial'] = True
+        entries.append(entry)
+    catalog = cliwrangler.IdentificationCatalog(entries)
+    for _ in range(20):
+        output = ''.join(rng.choice('ab- \n') for _ in range(rng.randint(0, 60)))
+        assert catalog.scan(output) == naive_scan(entries, output)
+
+
+# ResultCache
+
+def test_result_cache_evicts_and_expires(host_keys):
+    cache = cliwrangler.ResultCache(ttl=1, max_entries=2)
+    with fake_device() as server:
+        session = connect(server, host_keys, result_cache=cache)
+        device = server.devices[-1]
+
+        def sent(command):
+            return device.history.count(command)
+
+        # connect() left "show version" in the cache.
+        session.send('show version')
+        assert sent('show version') == 1
+        session.send('show ip arp')
+        session.send('show ip arp')
+        assert sent('show ip arp') == 1
+        assert len(cache) == 2
+
+        # Using "show version" makes "show ip arp" the least recently used,
+        # so that's the one that goes to make room.
+        session.send('show version')
+        session.send('show interfaces status')
+        assert len(cache) == 2
+        session.send('show version')
+        assert sent('show version') == 1
+        session.send('show ip arp')
+        assert sent('show ip arp') == 2
+
+        # Once they're older than the ttl, we ask again.
+        time.sleep(1.1)
+        session.send('show ip arp')
+        assert sent('show ip arp') == 3
+
+        # And anything that might change the device makes us forget it all.
+        session.send('terminal no monitor')
+        assert len(cache) == 0
+        session.send('show ip arp')
+        assert sent('show ip arp') == 4
+        assert cache.hits == 4
+        session.close()
+
+
+@asyncssh_only
+def test_async_result_cache(host_keys):
+    cache = cliwrangler.ResultCache()
+
+    async def run(server):
+        session = cliwrangler.AsyncCLIWrangler(host_keys=host_keys, result_cache=cache, **SESSION_ARGS)
+        await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+        first = await session.send('show ip arp')
+        assert await session.send('show ip arp') == first
+        await session.enable('enable')
+        await session.close()
+
+    with fake_device() as server:
+        asyncio.run(run(server))
+        assert server.devices[-1].history.count('show ip arp') == 1
+    # Enabling changed the prompt, so the cache forgot about the device.
+    assert len(cache) == 0
+
+
+# send_batch()
+
+BATCH_COMMANDS = ['show version', 'show interfaces status', 'show ip arp', 'show failover', 'show clock']
+
+
+def test_send_batch_splits_like_send(host_keys):
+    with fake_device() as server:
+        session = connect(server, host_keys)
+        expected = [without_echo(session.send(command, graceful=True)) for command in BATCH_COMMANDS]
+
+        for batch_size in (None, 2):
+            outputs = session.send_batch(BATCH_COMMANDS, graceful=True, batch_size=batch_size)
+            assert [without_echo(output) for output in outputs] == expected
+            for output, command in zip(session.outputs, BATCH_COMMANDS):
+                assert output.split('\n')[0].endswith(command)
+            # session.outputs still has what the failed ones printed.
+            assert 'Invalid input' in session.outputs[3]
+        # The two that failed on the device come back as None.
+        assert outputs[3] is None and outputs[4] is None
+
+        with pytest.raises(Exception, match='Found error string'):
+            session.send_batch(BATCH_COMMANDS)
+        session.close()
+
+
+def test_send_batch_falls_back_to_send_on_iosxe(host_keys):
+    with fake_device('iosxe') as server:
+        session = connect(server, host_keys)
+        assert 'IOS-XE' in session.identifiers
+
+        sent = []
+        send = session.send
+
+        def counting_send(command, *args, **kwargs):
+            sent.append(command)
+            return send(command, *args, **kwargs)
+
+        session.send = counting_send
+        outputs = session.send_batch(BATCH_COMMANDS[:3])
+        assert sent == BATCH_COMMANDS[:3]
+        assert outputs == session.outputs
+        assert 'Cisco IOS XE Software' in outputs[0]
+        session.close()
+
+
+def test_send_batch_falls_back_to_send_while_paging(host_keys):
+    # The ARP table is more than a screenful.
+    with fake_device('asa', mac_rows=100) as server:
+        session = connect(server, host_keys)
+        # The ASA won't turn paging off until we enable.
+        assert session.paging
+        commands = ['show version', 'show ip arp', 'show version']
+        expected = [without_echo(session.send(command)) for command in commands]
+        assert len(expected[1].split('\n')) > 100
+
+        outputs = session.send_batch(commands, graceful=True)
+        assert [without_echo(output) for output in outputs] == expected
+        assert server.devices[-1].history[-3:] == commands
+        session.close()
+
+
+@asyncssh_only
+def test_async_send_batch_falls_back_to_send_while_paging(host_keys):
+    async def run(server):
+        async with await async_connect(server, host_keys) as session:
+            assert session.paging
+            return await session.send_batch(['show ip arp', 'show version'])
+
+    with fake_device('asa', mac_rows=100) as server:
+        outputs = asyncio.run(run(server))
+    assert len(outputs[0].split('\n')) > 100
+    assert 'Cisco Adaptive Security Appliance Software' in outputs[1]
+
+
+# send_parallel() and open_channel()
+
+PARALLEL_COMMANDS = ['show ip arp', 'show version', 'show interfaces status', 'show mac address-table',
+                     'show tech-support', 'show ip arp']
+
+
+def test_send_parallel_matches_send(host_keys):
+    # The device only allows three shells per connection, one less than
+    # the IOS driver would try for.
+    with fake_device(max_sessions=3) as server:
+        session = connect(server, host_keys)
+        expected = [without_echo(session.send(command)) for command in PARALLEL_COMMANDS]
+
+        outputs = session.send_parallel(PARALLEL_COMMANDS)
+        assert [without_echo(output) for output in outputs] == expected
+        assert session.outputs == outputs
+        assert len(server.devices) == 3
+        # The extra shells didn't identify the device all over again, and
+        # they stay open for next time.
+        for device in server.devices[1:]:
+            assert device.history[:len(session.prepare_commands)] == session.prepare_commands
+            assert device.history.count('show version') <= 1
+        session.send_parallel(PARALLEL_COMMANDS)
+        assert len(server.devices) == 3
+
+        outputs = session.send_parallel(['show ip arp', 'show bogus'], graceful=True)
+        assert outputs[0] is not None and outputs[1] is None
+        with pytest.raises(Exception, match='Found error string'):
+            session.send_parallel(['show ip arp', 'show bogus'])
+        session.close()
+
+
+def test_open_channel(host_keys):
+    with fake_device('asa') as server:
+        session = connect(server, host_keys, max_channels=2)
+        session.enable('enable')
+        channel = session.open_channel()
+        device = server.devices[-1]
+
+        # The new shell knows what the device is, and got enabled too.
+        assert channel.identifiers == session.identifiers
+        assert channel.driver is session.driver
+        assert channel.enabled and device.enabled
+        assert 'show version' not in device.history
+        assert without_echo(channel.send('show ip arp')) == without_echo(session.send('show ip arp'))
+
+        with pytest.raises(Exception, match="Can't open another shell"):
+            session.open_channel()
+        channel.close()
+        assert not session._channel_open(channel)
+        other = session.open_channel()
+        # Closing the session closes its extra shells too.
+        session.close()
+        assert not session._channel_open(other)
+
+
+@asyncssh_only
+def test_async_send_parallel_and_open_channel(host_keys):
+    async def run(server):
+        session = cliwrangler.AsyncCLIWrangler(host_keys=host_keys, **SESSION_ARGS)
+        await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+        await session.enable('enable')
+        channel = await session.open_channel()
+        assert channel.enabled and channel.identifiers == session.identifiers
+        await channel.close()
+
+        expected = [without_echo(await session.send(command)) for command in PARALLEL_COMMANDS]
+        outputs = await session.send_parallel(PARALLEL_COMMANDS)
+        assert [without_echo(output) for output in outputs] == expected
+        await session.close()
+
+    with fake_device(max_sessions=3) as server:
+        asyncio.run(run(server))
+        # The shell from open_channel(), then two more for send_parallel().
+        assert len(server.devices) == 4
+        assert 'show version' not in server.devices[1].history
+        assert server.devices[1].enabled
+
+
+# send_char()
+
+def wait_for_history(device, command):
+    """The fake device's history, once the command shows up in it."""
+
+    deadline = time.time() + 5
+    while command not in device.history and time.time() < deadline:
+        time.sleep(0.01)
+    return device.history
+
+
+def test_send_char(host_keys):
+    with fake_device() as server:
+        session = connect(server, host_keys)
+        for char in 'show ip arp' + session.newline:
+            assert session.send_char(char) is True
+        assert wait_for_history(server.devices[-1], 'show ip arp')[-1] == 'show ip arp'
+        session.close()
+
+
+@asyncssh_only
+def test_async_send_char(host_keys):
+    async def run(server):
+        session = cliwrangler.AsyncCLIWrangler(host_keys=host_keys, **SESSION_ARGS)
+        await session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+        for char in 'show ip arp' + session.newline:
+            assert await session.send_char(char) is True
+        # Get back to a prompt before we hang up.
+        await session.send('')
+        await session.close()
+
+    with fake_device() as server:
+        asyncio.run(run(server))
+        assert wait_for_history(server.devices[-1], 'show ip arp')[-1] == 'show ip arp'
+
+
+# send_table()
+
+def test_send_table_mac_address_table(host_keys):
+    with fake_device(mac_rows=500) as server:
+        session = connect(server, host_keys)
+        table = session.send_table('mac_address_table')
+
+        assert len(table) == 500
+        assert list(table.columns) == ['vlan', 'mac', 'type', 'ports']
+        assert table.row(0) == {'vlan': 1, 'mac': '0011.2200.0000', 'type': 'DYNAMIC', 'ports': 'Gi1/0/1'}
+        assert table['mac'][499] == '0011.2200.01f3'
+        assert len(list(table.where('ports', 'Gi1/0/24'))) == 20
+        session.close()
+
+
+def test_send_table_arp_ages(host_keys):
+    with fake_device(mac_rows=10) as server:
+        session = connect(server, host_keys)
+        table = session.send_table('arp')
+
+        assert len(table) == 10
+        # Age is in minutes on IOS and seconds in the table, and an entry of
+        # our own has no age at all.
+        assert table['age'][0] == -1
+        assert table.row(1) == {'address': '10.0.0.1', 'age': 60, 'mac': '0011.2200.0001', 'interface': 'Vlan11'}
+        session.close()
+
+
+def test_send_table_unknown_table(host_keys):
+    with fake_device() as server:
+        session = connect(server, host_keys)
+        with pytest.raises(Exception, match="Don't know how to parse route_table"):
+            session.send_table('route_table')
+        session.close()
+
+
+# Recording and replay
+
+@pytest.mark.parametrize('platform', ['ios', 'asa', 'fortios'])
+def test_replay_round_trip(platform, host_keys, tmp_path):
+    if platform == 'fortios':
+        commands = ['get system status']
+    else:
+        commands = ['show version', 'show interfaces status']
+    path = str(tmp_path / 'session.rec')
+
+    with fake_device(platform) as server:
+        session = connect(server, host_keys, record=path)
+        if platform == 'asa':
+            session.enable('enable')
+        outputs = [session.send(command) for command in commands]
+        identifiers = session.identifiers
+        session.close()
+
+    # The enable password never made it into the file.
+    if platform == 'asa':
+        assert b'enable\r' in cliwrangler.load_recordings(path)[-1].sent()
+        with open(path, 'rb') as f:
+            assert b'enable\renable' not in f.read()
+
+    session = cliwrangler.CLIWrangler(replay=path, replay_speed=None, **SESSION_ARGS)
+    session.connect('127.0.0.1', 'cisco', 'sekrit')
+    if platform == 'asa':
+        session.enable('anything')
+    assert [session.send(command) for command in commands] == outputs
+    assert session.identifiers == identifiers
+
+    # Anything the recording didn't do is off script.
+    with pytest.raises(Exception, match='went off script'):
+        session.send('show clock')
+    session.close()
+
+
+# ConnectionScheduler
+
+def test_scheduler_waits_for_a_free_vty_line(host_keys):
+    scheduler = cliwrangler.ConnectionScheduler(max_per_device=1)
+
+    with fake_device() as server:
+        first = connect(server, host_keys, scheduler=scheduler)
+        second = cliwrangler.CLIWrangler(scheduler=scheduler, host_keys=host_keys, **SESSION_ARGS)
+        thread = threading.Thread(target=second.connect, args=('127.0.0.1', 'cisco', 'sekrit', server.port))
+        thread.start()
+
+        time.sleep(0.3)
+        assert thread.is_alive()
+        assert scheduler.counts['127.0.0.1'] == 1
+        assert len(server.devices) == 1
+
+        first.close()
+        thread.join(10)
+        assert not thread.is_alive()
+        assert second.prompt == 'fake-ios>'
+        second.close()
+        assert scheduler.counts['127.0.0.1'] == 0
+
+
+def test_scheduler_retries_a_busy_device(host_keys):
+    scheduler = cliwrangler.ConnectionScheduler(retries=50, backoff=0.05, max_backoff=0.1)
+
+    with fake_device(vty_lines=1) as server:
+        first = connect(server, host_keys)
+        # The device hangs up on us until the first session goes away.
+        threading.Timer(0.3, first.close).start()
+        second = connect(server, host_keys, scheduler=scheduler)
+
+        assert server.dropped >= 1
+        assert scheduler.retried >= 1
+        assert scheduler.gave_up == 0
+        second.close()
+
+
+def test_scheduler_doesnt_retry_a_wrong_password(host_keys):
+    scheduler = cliwrangler.ConnectionScheduler(backoff=0.05)
+
+    with fake_device(password='right') as server:
+        session = cliwrangler.CLIWrangler(scheduler=scheduler, host_keys=host_keys, **SESSION_ARGS)
+        with pytest.raises(paramiko.AuthenticationException):
+            session.connect('127.0.0.1', 'cisco', 'wrong', port=server.port)
+        assert scheduler.retried == 0
+        assert scheduler.counts['127.0.0.1'] == 0
+
+
+def test_scheduler_doesnt_retry_once_the_device_let_us_in(host_keys, monkeypatch):
+    # This switch hangs up on us in the middle of the prep, after it's
+    # already let us in, so it can't be out of VTY lines. The latency makes
+    # sure we're waiting for output by the time it does.
+    class HangUpDriver(cliwrangler.CiscoIOSDriver):
+        prepare = ('terminal length 0', 'exit')
+
+    monkeypatch.setattr(cliwrangler, 'DRIVERS', [HangUpDriver()] + cliwrangler.DRIVERS)
+    scheduler = cliwrangler.ConnectionScheduler(backoff=0.05)
+
+    with fake_device(latency=0.05) as server:
+        session = cliwrangler.CLIWrangler(scheduler=scheduler, host_keys=host_keys, **SESSION_ARGS)
+        with pytest.raises(Exception, match='closed while we were waiting'):
+            session.connect('127.0.0.1', 'cisco', 'sekrit', port=server.port)
+        assert scheduler.retried == 0
+        assert len(server.devices) == 1
+        assert scheduler.counts['127.0.0.1'] == 0
+
+
+# SessionPool
+
+def test_pool_evicts_least_recently_used(host_keys):
+    session_args = dict(SESSION_ARGS, host_keys=host_keys)
+
+    with fake_device() as server, fake_device('nxos') as other:
+        with cliwrangler.SessionPool('cisco', 'sekrit', max_idle=1, keepalive=None,
+                                     session_args=session_args) as pool:
+            first = pool.acquire('127.0.0.1', port=server.port)
+            second = pool.acquire('127.0.0.1', port=other.port)
+            pool.release(first)
+            pool.release(second)
+
+            assert list(pool.idle) == [second]
+            assert not first.is_alive()
+            assert dict(pool.counts) == {('127.0.0.1', other.port, 'cisco'): 1}
+
+            # We get the idle one back, not a new one.
+            with pool.session('127.0.0.1', port=other.port) as session:
+                assert session is second
+
+
+def test_pool_expires_idle_sessions(host_keys):
+    session_args = dict(SESSION_ARGS, host_keys=host_keys)
+
+    with fake_device() as server:
+        with cliwrangler.SessionPool('cisco', 'sekrit', idle_timeout=0.1, keepalive=None,
+                                     session_args=session_args) as pool:
+            with pool.session('127.0.0.1', port=server.port) as session:
+                session.enable('enable')
+                session.send('configure terminal')
+            # Released sessions get out of config mode.
+            assert session.prompt == 'fake-ios#'
+            assert len(pool.idle) == 1
+
+            time.sleep(0.2)
+            pool.expire()
+            assert len(pool.idle) == 0
+            assert dict(pool.counts) == {}
+            assert not session.is_alive()
+
+
+# Host keys
+
+def test_host_key_match(host_keys, tmp_path):
+    with fake_device() as server:
+        session = connect(server, known_hosts(tmp_path, server, HOST_KEY))
+        assert session.prompt == 'fake-ios>'
+        session.close()
+
+
+def test_host_key_mismatch(tmp_path):
+    with fake_device() as server:
+        store = known_hosts(tmp_path, server, paramiko.RSAKey.generate(1024))
+        with pytest.raises(paramiko.BadHostKeyException):
+            connect(server, store)
+
+
+def test_unknown_host_key_is_remembered(host_keys):
+    with fake_device() as server:
+        connect(server, host_keys).close()
+        name = '[127.0.0.1]:%d' % (server.port)
+        assert host_keys.lookup(name)['ssh-rsa'].asbytes() == HOST_KEY.asbytes()
+
+
+@asyncssh_only
+def test_async_host_key_match(tmp_path):
+    async def run(server):
+        session = await async_connect(server, known_hosts(tmp_path, server, HOST_KEY))
+        await session.close()
+        return session.identifiers
+
+    with fake_device() as server:
+        assert asyncio.run(run(server)) == ['Cisco', 'IOS', 'C3750']
+
+
+@asyncssh_only
+def test_async_host_key_mismatch(tmp_path):
+    with fake_device() as server:
+        store = known_hosts(tmp_path, server, paramiko.RSAKey.generate(1024))
+        with pytest.raises(paramiko.BadHostKeyException):
+            asyncio.run(async_connect(server, store))
+
+
+@asyncssh_only
+def test_async_unknown_host_key_is_remembered(host_keys):
+    async def run(server):
+        await (await async_connect(server, host_keys)).close()
+        # Now that we know it, asyncssh checks it for us.
+        await (await async_connect(server, host_keys)).close()
+
+    with fake_device() as server:
+        asyncio.run(run(server))
+        name = '[127.0.0.1]:%d' % (server.port)
+        assert host_keys.lookup(name)['ssh-rsa'].asbytes() == HOST_KEY.asbytes()
+
+
+# AsyncCLIWrangler
+
+@asyncssh_only
+def test_async_session(host_keys):
+    async def run(server):
+        async with await async_connect(server, host_keys) as session:
+            assert session.prompt == 'fake-ios>'
+            version = await session.send('show version')
+            assert 'Cisco IOS Software' in version
+            with pytest.raises(Exception, match='Found error string'):
+                await session.send('show failover')
+
+            await session.enable('enable')
+            assert session.enabled
+            assert session.prompt == 'fake-ios#'
+            outputs = await session.send_batch(BATCH_COMMANDS[:3])
+            assert without_echo(outputs[0]) == without_echo(version)
+            assert await session.write_config()
+
+    with fake_device() as server:
+        asyncio.run(run(server))
+        assert server.devices[-1].history[-1] == 'write memory'